@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+#
+# Benchmark comparing the trial loop float_to_fixed_width we used to have
+# with the current version that computes the precision directly (and the
+# vectorized float_to_fixed_width_array used for loops).
+#
+# Note that TreRSMPCA and DesCSEPHB supply an explicit 'frmt' for their
+# floats, so they don't go through float_to_fixed_width at all and should
+# time the same either way. The "ephemeris (default format)" case is the
+# same ephemeris loop without a 'frmt', which is what the default
+# formatting is used for (e.g., TreBANDSB, TreHISTOA, TreMIMCSA).
+
+import io
+import timeit
+import numpy as np
+import pynitf.nitf_field as nitf_field
+import pynitf.nitf_field_codegen as nitf_field_codegen
+from pynitf import TreRSMPCA, DesCSEPHB, FieldStruct, NitfDesSegment
+
+def float_to_fixed_width_old(n, max_width, maximum_precision=False):
+    '''The original version of float_to_fixed_width, trying each
+    precision in turn.'''
+    s1 = '{:.{}f}'
+    if(maximum_precision and
+       (n < pow(10,-max_width+5) or
+        n > pow(10,max_width-5))):
+        s1 = '{:.{}e}'
+    for i in range(max_width - 2, -1, -1):
+        s = s1.format(n, i)
+        if len(s) <= max_width:
+            break
+    if(len(s) > max_width):
+        raise RuntimeError("Can't fit %f into length %d" % (n, max_width))
+    return s
+
+def float_to_fixed_width_array_old(v, max_width):
+    return [float_to_fixed_width_old(t, max_width) for t in v]
+
+class EphemerisDefault(FieldStruct):
+    desc = [['num_ephem', "Number of Ephemeris Vectors", 5, int],
+            [["loop", "f.num_ephem"],
+             ["ephem_x", "X-Coordinate", 12, float],
+             ["ephem_y", "Y-Coordinate", 12, float],
+             ["ephem_z", "Z-Coordinate", 12, float]]]
+
+def ephemeris(cls, n=1000):
+    d = cls()
+    d.num_ephem = n
+    t = np.linspace(0, 2 * np.pi, n)
+    x = 7000000.0 * np.cos(t)
+    y = 7000000.0 * np.sin(t)
+    z = 1000.0 * t
+    for i in range(n):
+        d.ephem_x[i] = x[i]
+        d.ephem_y[i] = y[i]
+        d.ephem_z[i] = z[i]
+    return d
+
+def csephb():
+    d = ephemeris(DesCSEPHB)
+    d.qual_flag_eph = 1
+    d.interp_type_eph = 1
+    d.ephem_flag = 1
+    d.eci_ecf_ephem = 0
+    d.dt_ephem = 900.5
+    d.date_ephem = 20170501
+    d.t0_ephem = 235959.100001000
+    d.reserved_len = 0
+    return NitfDesSegment(d)
+
+def rsmpca():
+    t = TreRSMPCA()
+    t.rsn = 1
+    t.csn = 1
+    for f in ("rnrmo", "cnrmo", "xnrmo", "ynrmo", "znrmo", "rnrmsf",
+              "cnrmsf", "xnrmsf", "ynrmsf", "znrmsf"):
+        setattr(t, f, 1234.5678)
+    for p in ("rn", "rd", "cn", "cd"):
+        for c in ("x", "y", "z"):
+            setattr(t, p + "pwr" + c, 3)
+        setattr(t, p + "trms", 64)
+        cf = getattr(t, p + "pcf")
+        for i in range(64):
+            cf[i] = 1.0 / (i + 1)
+    return t
+
+def write_segment(seg):
+    seg.write_to_file(io.BytesIO(), 0)
+
+def write_struct(t):
+    t.write_to_file(io.BytesIO())
+
+def run(name, func):
+    t = min(timeit.repeat(func, number=20, repeat=5)) / 20
+    print("  %-34s %10.1f us" % (name, t * 1e6))
+
+def run_all():
+    seg = csephb()
+    rsm = rsmpca()
+    eph = ephemeris(EphemerisDefault)
+    vals = [eph.ephem_x[i] for i in range(eph.num_ephem)]
+    run("float_to_fixed_width x1000",
+        lambda : [nitf_field.float_to_fixed_width(v, 12) for v in vals])
+    run("float_to_fixed_width_array x1000",
+        lambda : nitf_field_codegen.float_to_fixed_width_array(vals, 12))
+    run("RSMPCA write", lambda : write_struct(rsm))
+    run("CSEPHB write", lambda : write_segment(seg))
+    run("ephemeris (default format) write", lambda : write_struct(eph))
+
+def main():
+    new = (nitf_field.float_to_fixed_width,
+           nitf_field_codegen.float_to_fixed_width_array)
+    print("Old trial loop:")
+    nitf_field.float_to_fixed_width = float_to_fixed_width_old
+    nitf_field_codegen.float_to_fixed_width_array = \
+        float_to_fixed_width_array_old
+    try:
+        run_all()
+    finally:
+        (nitf_field.float_to_fixed_width,
+         nitf_field_codegen.float_to_fixed_width_array) = new
+    print("New:")
+    run_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+# This maintains a catalog of NITF files in a SQLite database, so we can
+# find files without rereading them.
+
+from .nitf_image_subheader import nitf_read_igeolo
+from .nitf_read_many import read_many
+import functools
+import fnmatch
+import json
+import os
+import sqlite3
+
+_catalog_version = 1
+
+_file_fields = ["fhdr", "fver", "ostaid", "fdt", "ftitle", "fsclas",
+                "numi", "nums", "numt", "numdes", "numres"]
+
+_image_fields = ["iid1", "iid2", "idatim", "isclas", "icat", "irep",
+                 "icords", "igeolo", "nrows", "ncols", "nbands"]
+
+_schema = '''
+create table if not exists config (key text primary key, value text);
+create table if not exists file (
+    id integer primary key, file_name text unique, mtime real, size integer,
+    error text, %s);
+create table if not exists image (
+    file_id integer references file(id) on delete cascade,
+    image_index integer, %s, min_lon real, max_lon real, min_lat real,
+    max_lat real);
+create table if not exists tre (
+    file_id integer references file(id) on delete cascade,
+    segment_type text, segment_index integer, tre_tag text, field text,
+    value numeric);
+create index if not exists image_file_id on image(file_id);
+create index if not exists tre_file_id on tre(file_id);
+create index if not exists tre_tag_field on tre(tre_tag, field, value);
+''' % (", ".join(_file_fields), ", ".join(_image_fields))
+
+def _tre_values(tre_list, tre_fields):
+    '''Return (tre_tag, field, value) for the TRE fields in tre_fields
+    found in the tre_list.'''
+    res = []
+    for t in tre_list:
+        for tag, field in tre_fields:
+            if(t.tre_tag != tag):
+                continue
+            try:
+                v = getattr(t, field)
+            except (AttributeError, RuntimeError, ValueError, IndexError):
+                continue
+            if(isinstance(v, (int, float, str, bytes))):
+                res.append((tag, field, v))
+    return res
+
+def _corner_bbox(ih):
+    '''Return min_lon, max_lon, min_lat, max_lat for the IGEOLO corners
+    of the image subheader ih, or all None if the image doesn't have
+    geographic corners.'''
+    if(ih.icords not in ('G', 'D')):
+        return (None, None, None, None)
+    try:
+        corners, _ = nitf_read_igeolo(ih.icords, ih.igeolo.encode('utf-8'))
+    except (RuntimeError, ValueError):
+        return (None, None, None, None)
+    lon = [c[0] for c in corners]
+    lat = [c[1] for c in corners]
+    return (min(lon), max(lon), min(lat), max(lat))
+
+def _catalog_record(f, tre_fields):
+    '''Extract the information we put in the catalog for the NitfFile f.
+    This is run in the read_many worker processes, so we return a dict
+    of plain values.'''
+    res = {"file" : [getattr(f.file_header, fld) for fld in _file_fields],
+           "image" : [], "tre" : []}
+    for tag, field, v in _tre_values(f.tre_list, tre_fields):
+        res["tre"].append(("file", None, tag, field, v))
+    for i, iseg in enumerate(f.image_segment):
+        ih = iseg.subheader
+        res["image"].append([i] + [getattr(ih, fld) for fld in _image_fields]
+                            + list(_corner_bbox(ih)))
+        for tag, field, v in _tre_values(iseg.tre_list, tre_fields):
+            res["tre"].append(("image", i, tag, field, v))
+    return res
+
+class NitfCatalog(object):
+    '''This is a catalog of NITF files, kept in a SQLite database. We
+    record the file header, the image subheaders (iid1, idatim, icords,
+    igeolo, nrows, ncols, etc.) and a configurable set of TRE fields, so
+    we can find the files we want without reading all of them again.
+
+    The TRE fields are given as a list of "TAG.field" strings, e.g.,
+    ["USE00A.angle_to_north", "STDIDC.mission"]. The list is saved in
+    the database, so you only need to pass it when you create the catalog
+    or want to change it. Changing it causes the next build to reread
+    all the files.
+
+    The catalog is updated incrementally by build, we only reread the
+    files that are new, or have a different modification time or size
+    than when we last read them.'''
+    def __init__(self, db_file_name, tre_fields=None):
+        self.db_file_name = db_file_name
+        self.connection = sqlite3.connect(db_file_name)
+        self.connection.execute("pragma foreign_keys = on")
+        self.connection.executescript(_schema)
+        with self.connection:
+            v = self._config("version")
+            if(v is not None and int(v) != _catalog_version):
+                raise RuntimeError("Catalog %s has version %s, we only support version %d" % (db_file_name, v, _catalog_version))
+            self._set_config("version", _catalog_version)
+            if(self._config("tre_fields") is None):
+                self._set_config("tre_fields", json.dumps([]))
+            if(tre_fields is not None and
+               list(tre_fields) != self.tre_fields):
+                for t in tre_fields:
+                    if(len(t.split(".")) != 2):
+                        raise RuntimeError("TRE field should be of the form TAG.field, got '%s'" % t)
+                self._set_config("tre_fields", json.dumps(list(tre_fields)))
+                # Force the files to be reread
+                self.connection.execute("update file set mtime = null")
+
+    def _config(self, key):
+        r = self.connection.execute("select value from config where key = ?",
+                                    (key,)).fetchone()
+        return r[0] if r is not None else None
+
+    def _set_config(self, key, value):
+        self.connection.execute("insert or replace into config values (?, ?)",
+                                (key, str(value)))
+
+    @property
+    def tre_fields(self):
+        '''The TRE fields we extract, as a list of "TAG.field" strings.'''
+        return json.loads(self._config("tre_fields"))
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("select count(*) from file").fetchone()[0]
+
+    @staticmethod
+    def find_files(path_list,
+                   pattern_list=("*.ntf", "*.nitf", "*.r0")):
+        '''Return the NITF files found in path_list. A file in path_list
+        is always returned, for a directory we search it recursively for
+        files matching one of pattern_list (ignoring case).'''
+        res = []
+        for p in path_list:
+            if(not os.path.isdir(p)):
+                res.append(os.path.abspath(p))
+                continue
+            for dirpath, dirnames, filenames in os.walk(p):
+                dirnames.sort()
+                for fname in sorted(filenames):
+                    if(any(fnmatch.fnmatch(fname.lower(), pat)
+                           for pat in pattern_list)):
+                        res.append(os.path.abspath(os.path.join(dirpath,
+                                                                fname)))
+        return res
+
+    def build(self, path_list, workers=None, prune=True):
+        '''Add the NITF files in path_list (files or directories, see
+        find_files) to the catalog, or update them if they have changed.
+        The files are read in parallel using read_many, and workers is
+        passed to it.
+
+        A file we can't read is recorded in the catalog with the error
+        message, so we don't try it again until it changes.
+
+        If prune is True, we also remove the files from the catalog that
+        no longer exist.
+
+        Returns the number of files read.'''
+        known = {fname : (mtime, size) for fname, mtime, size in
+                 self.connection.execute("select file_name, mtime, size from file")}
+        stat = {}
+        for fname in self.find_files(path_list):
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            if(known.get(fname) != (st.st_mtime, st.st_size)):
+                stat[fname] = (st.st_mtime, st.st_size)
+        func = functools.partial(_catalog_record,
+                                 tre_fields=[t.split(".") for t in
+                                             self.tre_fields])
+        with self.connection:
+            if(prune):
+                self.connection.executemany("delete from file where file_name = ?",
+                   [(fname,) for fname in known if not os.path.exists(fname)])
+            for fname, r in read_many(sorted(stat.keys()), workers=workers,
+                                      func=func, return_exceptions=True):
+                self._add(fname, stat[fname], r)
+        return len(stat)
+
+    def _add(self, fname, stat, r):
+        '''Add the results of _catalog_record for fname to the catalog,
+        replacing any existing entries.'''
+        c = self.connection
+        c.execute("delete from file where file_name = ?", (fname,))
+        if(isinstance(r, Exception)):
+            c.execute("insert into file (file_name, mtime, size, error) values (?, ?, ?, ?)", (fname, stat[0], stat[1], str(r) or type(r).__name__))
+            return
+        fid = c.execute("insert into file (file_name, mtime, size, %s) values (?, ?, ?, %s)" % (", ".join(_file_fields), ", ".join(["?"] * len(_file_fields))), [fname, stat[0], stat[1]] + r["file"]).lastrowid
+        ncol = 1 + len(_image_fields) + 4
+        c.executemany("insert into image (file_id, image_index, %s, min_lon, max_lon, min_lat, max_lat) values (%s)" % (", ".join(_image_fields), ", ".join(["?"] * (ncol + 1))), [[fid] + v for v in r["image"]])
+        c.executemany("insert into tre values (?, ?, ?, ?, ?, ?)",
+                      [(fid,) + v for v in r["tre"]])
+
+    def errors(self):
+        '''Return a list of (file_name, error) for the files in the catalog
+        that we couldn't read.'''
+        return self.connection.execute("select file_name, error from file where error is not null order by file_name").fetchall()
+
+    def query(self, iid1=None, after=None, before=None, bbox=None,
+              tre=None, where=None, params=()):
+        '''Return the sorted list of files that have an image matching
+        all the given conditions:
+
+        iid1 - A glob style pattern (e.g., "IMG*") for the image iid1.
+        after, before - Images with an idatim >= after or < before. These
+           are strings in the idatim form CCYYMMDDhhmmss, which can be
+           truncated (e.g., "20200101").
+        bbox - (min_lon, min_lat, max_lon, max_lat). Images with
+           geographic IGEOLO corners that overlap this.
+        tre - A dict of "TAG.field" to a value, for the TRE fields
+           extracted in the catalog. The TRE can be in the file header or
+           the image subheader. Values that look like numbers are
+           compared as numbers.
+        where, params - Any other SQL condition to add, with the "file" and
+           "image" tables available, e.g., where="image.nrows > ?",
+           params=(1000,).
+
+        If no conditions are given, all the files we could read are
+        returned.'''
+        cond = ["file.error is null"]
+        p = []
+        if(iid1 is not None):
+            cond.append("image.iid1 glob ?")
+            p.append(iid1)
+        if(after is not None):
+            cond.append("image.idatim >= ?")
+            p.append(str(after))
+        if(before is not None):
+            cond.append("image.idatim < ?")
+            p.append(str(before))
+        if(bbox is not None):
+            cond.append("image.min_lon <= ? and image.max_lon >= ? and image.min_lat <= ? and image.max_lat >= ?")
+            p.extend([bbox[2], bbox[0], bbox[3], bbox[1]])
+        for k, v in (tre or {}).items():
+            tag, field = k.split(".")
+            cond.append("exists (select 1 from tre where tre.file_id = file.id and (tre.segment_type = 'file' or tre.segment_index = image.image_index) and tre.tre_tag = ? and tre.field = ? and tre.value = ?)")
+            p.extend([tag, field, v])
+        if(where is not None):
+            cond.append("(%s)" % where)
+            p.extend(params)
+        if(len(cond) == 1):
+            sql = "select file_name from file where %s order by file_name" % cond[0]
+        else:
+            sql = "select distinct file.file_name from file join image on image.file_id = file.id where %s order by file.file_name" % " and ".join(cond)
+        return [r[0] for r in self.connection.execute(sql, p)]
+
+__all__ = ["NitfCatalog", ]
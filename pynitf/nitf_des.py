@@ -1,4 +1,5 @@
-from .nitf_field import FieldStruct, FieldStructDiff
+from .nitf_field import (FieldStruct, FieldStructDiff, BufferReader,
+                          BufferWriter)
 from .nitf_segment_data_handle import (NitfDes,
                                        NitfSegmentDataHandleSet)
 from .nitf_diff_handle import (NitfDiffHandle, NitfDiffHandleSet,
@@ -103,9 +104,9 @@ class NitfDesFieldStruct(NitfDes, FieldStruct):
 
     def update_raw_field(self):
         '''Update the raw fields after a change to des_implementation_field'''
-        fh = io.BytesIO()
+        fh = BufferWriter()
         self.write_to_file(fh)
-        fh2 = io.BytesIO(fh.getvalue())
+        fh2 = BufferReader(fh.getvalue())
         self.read_from_file(fh2, force_raw_read=True)
     
 class DesFieldStructDiff(FieldStructDiff):
@@ -153,6 +154,11 @@ class NitfDesCopy(NitfDes):
         if(self.data is None): 
             raise RuntimeError("Can only write data after we have read it in NitdDesCopy")
         fh.write(self.data)
+
+    def write_size(self):
+        if(self.data is None):
+            return None
+        return len(self.data)
     
 class TreOverflow(NitfDes):
     '''DES used to handle TRE overflow.'''
@@ -177,6 +183,9 @@ class TreOverflow(NitfDes):
     def write_to_file(self, fh):
         '''Write to a file.'''
         fh.write(self.data)
+
+    def write_size(self):
+        return len(self.data)
         
     def __str__(self):
         '''Text description of structure, e.g., something you can print
@@ -0,0 +1,131 @@
+from .nitf_field import BytesFieldData, BufferReader, BufferWriter
+from .nitf_des import NitfDesFieldStruct
+from .nitf_file_header import NitfFileHeader
+from .nitf_segment_data_handle import NitfSegmentDataHandleSet
+import io
+
+hlp = '''This is a NITF STREAMING_FILE_HEADER DES. The field names can be
+pretty cryptic, but these are documented in detail in the NITF 2.10
+documentation (MIL-STD-2500C, available at http://www.gwg.nga.mil/ntb/baseline/docs/2500c/2500C.pdf).
+
+A NITF file written in the streaming mode has a file length (fl) of
+999999999999, and the segment sizes in the file header that weren't known
+when the header was written are all 9s. This DES is placed at the end of
+the file, and contains a replacement file header with the correct values.
+'''
+
+_sfh_delim1 = b'\x0a\x6e\x1d\x97'
+_sfh_delim2 = b'\x0e\xca\x14\xbf'
+
+desc = [['sfh_l1', "SFH Length 1", 7, int],
+        ['sfh_delim1', "SFH Delimiter 1", 4, bytes, {"default" : _sfh_delim1}],
+        ['sfh_dr', "SFH Data Replacement", 'f.sfh_l1', None,
+         {'field_value_class' : BytesFieldData}],
+        ['sfh_delim2', "SFH Delimiter 2", 4, bytes, {"default" : _sfh_delim2}],
+        ['sfh_l2', "SFH Length 2", 7, int],
+        ]
+
+class DesStreamingFileHeader(NitfDesFieldStruct):
+    __doc__ = hlp
+    desc = desc
+    des_tag = "STREAMING_FILE_HEADER"
+    des_ver = 1
+
+    @property
+    def file_header(self):
+        '''The replacement NitfFileHeader.'''
+        h = NitfFileHeader()
+        h.read_from_file(BufferReader(self.sfh_dr))
+        return h
+
+    @file_header.setter
+    def file_header(self, h):
+        fh = BufferWriter()
+        h.write_to_file(fh)
+        self.sfh_l1 = len(fh.data)
+        self.sfh_dr = fh.getvalue()
+        self.sfh_l2 = len(fh.data)
+
+    def summary(self):
+        res = io.StringIO()
+        print("STREAMING_FILE_HEADER", file=res)
+        return res.getvalue()
+
+NitfSegmentDataHandleSet.add_default_handle(DesStreamingFileHeader)
+
+def read_streaming_file_header(fh):
+    '''Read the replacement file header found in the STREAMING_FILE_HEADER
+    DES at the end of a streaming NITF file. We find this from the end of
+    the file using the length at the end of the DES data (sfh_l2), so we
+    don't need to know the segment sizes to find it.
+
+    This returns the replacement NitfFileHeader and the offset in the
+    file where the DES data starts. The position of fh is changed.'''
+    fh.seek(0, 2)
+    end = fh.tell()
+    fh.seek(max(end - 7, 0))
+    try:
+        sfh_l2 = int(fh.read(7))
+    except ValueError:
+        sfh_l2 = -1
+    start = end - 22 - sfh_l2
+    if(sfh_l2 < 0 or start < 0):
+        raise RuntimeError("Streaming NITF file doesn't end with a STREAMING_FILE_HEADER DES")
+    fh.seek(start)
+    d = DesStreamingFileHeader()
+    try:
+        d.read_from_file(BufferReader(fh.read(end - start)))
+    except (RuntimeError, ValueError):
+        raise RuntimeError("Streaming NITF file doesn't end with a STREAMING_FILE_HEADER DES")
+    if(d.sfh_delim1 != _sfh_delim1 or d.sfh_delim2 != _sfh_delim2 or
+       d.sfh_l1 != d.sfh_l2):
+        raise RuntimeError("Streaming NITF file doesn't end with a STREAMING_FILE_HEADER DES")
+    return d.file_header, start
+
+def convert_streaming_file(file_name, out_file_name, chunk_size=16*1024*1024):
+    '''Convert a streaming NITF file to a normal NITF file. This doesn't
+    read the segments, we just write the replacement file header and copy
+    the segments over in a single sequential pass through the file. If
+    the replacement file header includes the STREAMING_FILE_HEADER DES,
+    it is dropped since we don't need it in the normal file.'''
+    with open(file_name, 'rb') as fh:
+        h = NitfFileHeader()
+        h.read_from_file(fh)
+        start = fh.tell()
+        if(h.fl != 999999999999):
+            raise RuntimeError("%s isn't a streaming NITF file" % file_name)
+        hnew, sfh_start = read_streaming_file_header(fh)
+        offsets = hnew.segment_offsets(start)
+        seg_range = [(offset, hsize + dsize)
+                     for seg_type, num, lsh, l in hnew.segment_size_fields
+                     for offset, hsize, dsize in offsets[seg_type]]
+        sfh_index = [i for i, (offset, hsize, dsize)
+                     in enumerate(offsets["des"]) if offset + hsize == sfh_start]
+        if(len(sfh_index) > 0):
+            # Drop the STREAMING_FILE_HEADER DES
+            i = sfh_index[0]
+            seg_range.remove((offsets["des"][i][0],
+                              offsets["des"][i][1] + offsets["des"][i][2]))
+            ldsh = [hnew.ldsh[j] for j in range(hnew.numdes) if j != i]
+            ld = [hnew.ld[j] for j in range(hnew.numdes) if j != i]
+            hnew.numdes = len(ldsh)
+            for j in range(hnew.numdes):
+                hnew.ldsh[j] = ldsh[j]
+                hnew.ld[j] = ld[j]
+        hnew.hl = hnew.serialized_size()
+        hnew.fl = hnew.hl + sum(sz for offset, sz in seg_range)
+        fh.seek(start)
+        with open(out_file_name, 'wb') as fout:
+            hnew.write_to_file(fout)
+            for offset, sz in seg_range:
+                if(fh.tell() != offset):
+                    fh.seek(offset)
+                while sz > 0:
+                    d = fh.read(min(sz, chunk_size))
+                    if(len(d) == 0):
+                        raise RuntimeError("Streaming NITF file %s is truncated" % file_name)
+                    fout.write(d)
+                    sz -= len(d)
+
+__all__ = ["DesStreamingFileHeader", "read_streaming_file_header",
+           "convert_streaming_file"]
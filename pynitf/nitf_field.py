@@ -1,13 +1,18 @@
 from .nitf_diff_handle import NitfDiffHandle
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 import itertools
+import re
+import bisect
+import ast
 import operator
 import weakref
+import types
 import copy
 import math
 from struct import pack, unpack
 import logging
 import io
+import mmap
 import numpy as np
 
 # Add a bunch of debugging if you are diagnosing a problem
@@ -17,6 +22,22 @@ DEBUG = False
 # We used to use the utf-8 codec but that couldn't deal w extended ASCII characters
 _text_codec = "latin-1" #"utf-8"
 
+# Powers of 10 that are exactly representable as floats. Used to count the
+# digits in the integer part of a float, see float_to_fixed_width.
+_pow10 = [10.0 ** i for i in range(16)]
+_pow10_array = np.array(_pow10)
+
+def _float_to_fixed_width_search(n, max_width, s1):
+    '''Search for the largest precision that fits, trying each precision
+    in turn. This is the general fallback for float_to_fixed_width.'''
+    for i in range(max_width - 2, -1, -1):
+        s = s1.format(n, i)
+        if len(s) <= max_width:
+            break
+    if(len(s) > max_width):
+        raise RuntimeError("Can't fit %f into length %d" % (n, max_width))
+    return s
+
 def float_to_fixed_width(n, max_width, maximum_precision=False):
     '''Utility function that tries to fit a float with maximum precision into
     other a fixed point string, or optionally an exponent string'''
@@ -25,13 +46,49 @@ def float_to_fixed_width(n, max_width, maximum_precision=False):
        (n < pow(10,-max_width+5) or
         n > pow(10,max_width-5))):
         s1 = '{:.{}e}'
-    for i in range(max_width - 2, -1, -1):
+        return _float_to_fixed_width_search(n, max_width, s1)
+    if(max_width < 2 or not isinstance(n, (float, int)) or
+       not math.isfinite(n)):
+        return _float_to_fixed_width_search(n, max_width, s1)
+    # The integer part (with sign) always takes at least ndigit characters,
+    # and a precision i > 0 adds i + 1 more. So the precision below is the
+    # largest that can fit. It only fails to fit if rounding carries into
+    # another digit (e.g., 9.999 to 10.00), in which case we drop one more.
+    a = abs(n)
+    if(a < 1e15):
+        ndigit = max(bisect.bisect_right(_pow10, a), 1)
+    else:
+        ndigit = len("%d" % a)
+    if(n < 0 or (n == 0 and math.copysign(1, n) < 0)):
+        ndigit += 1
+    for i in range(max(max_width - 1 - ndigit, 0), -1, -1):
         s = s1.format(n, i)
         if len(s) <= max_width:
-            break
-    if(len(s) > max_width):
-        raise RuntimeError("Can't fit %f into length %d" % (n, max_width))
-    return s
+            return s
+    raise RuntimeError("Can't fit %f into length %d" % (n, max_width))
+
+def float_to_fixed_width_array(v, max_width):
+    '''Vectorized version of float_to_fixed_width (without
+    maximum_precision), taking an array or list of floats and returning a list
+    of strings. The results are identical to calling float_to_fixed_width on
+    each value.'''
+    a = np.asarray(v, dtype=np.float64).ravel()
+    if(max_width < 2 or a.size == 0):
+        return [float_to_fixed_width(t, max_width) for t in v]
+    t = np.abs(a)
+    ndigit = (np.maximum(np.searchsorted(_pow10_array, t, side="right"), 1) +
+              np.signbit(a))
+    prec = np.maximum(max_width - 1 - ndigit, 0)
+    vlist = a.tolist()
+    res = ["%.*f" % (i, t) for i, t in zip(prec.tolist(), vlist)]
+    # Handle values too large for the table, inf, nan, and rounding
+    # carries with the scalar version
+    for i in np.flatnonzero(~(t < 1e15)).tolist():
+        res[i] = float_to_fixed_width(vlist[i], max_width)
+    for i, s in enumerate(res):
+        if(len(s) > max_width):
+            res[i] = float_to_fixed_width(vlist[i], max_width)
+    return res
 
 class NitfLiteral(object):
     '''Sometimes we have a field with a particularly odd format, and it 
@@ -44,30 +101,280 @@ class NitfLiteral(object):
         else:
             self.value = bytes(value)[0:(trunc_size-1)]
 
+class BufferReader(object):
+    '''A file like object for reading from data we already have in
+    memory (e.g., the TRE data in a header, or a mmap of a file). This
+    can be used anywhere we read from a file handle. FieldStruct reads
+    directly from the data, rather than calling read for each field.
+
+    The data can be bytes, a mmap, or something we can convert to bytes
+    (e.g., a bytearray). Slicing bytes and a mmap gives bytes, which is
+    what the fields are read as. A memoryview of a whole bytes or mmap
+    object uses the underlying object, anything else is copied to bytes.
+
+    pos is the current position in the data.'''
+    def __init__(self, data, pos=0):
+        if(isinstance(data, memoryview) and
+           isinstance(data.obj, (bytes, mmap.mmap)) and
+           data.nbytes == len(data.obj)):
+            data = data.obj
+        if(not isinstance(data, (bytes, mmap.mmap))):
+            data = bytes(data)
+        self.data = data
+        self.pos = pos
+
+    def read(self, n=-1):
+        if(n is None or n < 0):
+            t = self.data[self.pos:]
+        else:
+            t = self.data[self.pos:(self.pos + n)]
+        self.pos += len(t)
+        return t
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if(whence == io.SEEK_CUR):
+            offset += self.pos
+        elif(whence == io.SEEK_END):
+            offset += len(self.data)
+        if(offset < 0):
+            raise ValueError("negative seek position %d" % offset)
+        self.pos = offset
+        return self.pos
+
+class BufferWriter(object):
+    '''A file like object for writing to memory, the counterpart of
+    BufferReader. The data is written to a bytearray data. This is like a
+    io.BytesIO, but FieldStruct recognizes it and appends each field
+    directly to the data.
+
+    Writing after a seek overwrites the data, so updating a field we
+    have already written (e.g., FieldStruct.update_field) is just a slice
+    assignment.
+
+    If the data is going to be written at some location in a file,
+    offset can be given as that location. Positions (e.g., tell, and
+    the field locations used by update_field) are then the locations in
+    the file, so offset gets subtracted from these to get the position
+    in the data.'''
+    def __init__(self, offset=0):
+        self.data = bytearray()
+        self.offset = offset
+        self.pos = 0
+
+    def write(self, b):
+        n = len(b)
+        if(self.pos == len(self.data)):
+            self.data += b
+        else:
+            self.data[self.pos:(self.pos + n)] = b
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.offset + self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if(whence == io.SEEK_SET):
+            offset -= self.offset
+        elif(whence == io.SEEK_CUR):
+            offset += self.pos
+        elif(whence == io.SEEK_END):
+            offset += len(self.data)
+        if(offset < 0):
+            raise ValueError("negative seek position %d" % offset)
+        if(offset > len(self.data)):
+            # Like a file, fill in a gap with nulls
+            self.data += b'\0' * (offset - len(self.data))
+        self.pos = offset
+        return self.tell()
+
+    def getvalue(self):
+        return bytes(self.data)
+
+# Expressions found in a description (sizes, conditions, loop shapes) are
+# evaluated for every field we read or write, so we compile each one only
+# once and cache the resulting function here, keyed by the expression string.
+_expr_cache = {}
+_assign_cache = {}
+_exec_cache = {}
+
+def _compile_expr(expr):
+    '''Compile an expression such as "f.foo[i1,i2]" or "f.udhdl != 0"
+    into a function func(f, i1, i2, i3, i4). The index variables are 
+    optional, so a scalar key can just call func(f).
+
+    We use the globals of this module, so the expression sees the same
+    names it would have seen with a plain eval.'''
+    func = _expr_cache.get(expr)
+    if(func is None):
+        src = ("lambda f, i1=None, i2=None, i3=None, i4=None, *_: (\n%s\n)"
+               % expr)
+        func = eval(compile(src, "<expression %s>" % expr, "eval"),
+                    globals())
+        _expr_cache[expr] = func
+    return func
+
+def _compile_assign(expr):
+    '''Compile a function func(f, v, i1, i2, i3, i4) that assigns v to the
+    expression (e.g., the size expression "f.udhdl"). This is done
+    separately from _compile_expr, because not every expression can
+    be assigned to (e.g., "f.nxpts[i1] * f.nypts[i1]").'''
+    func = _assign_cache.get(expr)
+    if(func is None):
+        src = ("def _assign(f, v, i1=None, i2=None, i3=None, i4=None, *_):\n"
+               "    %s = v\n" % expr)
+        ns = {}
+        exec(compile(src, "<assignment %s>" % expr, "exec"), globals(), ns)
+        func = ns["_assign"]
+        _assign_cache[expr] = func
+    return func
+
 def _eval_or_exec_expr(fs, key, expr, do_eval):
     '''We have a few places where we evaluate or execute an expression,
     with various local variables set up for the evaluation context. As
     a convenience we centralize this to one place, so there is only
     one function to update if we add new variables (e.g., add to the number
-    of index variables).'''
-    f = fs
-    if(len(key) > 0):
-        i1 = key[0]
-    if(len(key) > 1):
-        i2 = key[1]
-    if(len(key) > 2):
-        i3 = key[2]
-    if(len(key) > 3):
-        i4 = key[3]
+    of index variables).
+
+    The expression is compiled once and cached, so calling this repeatedly
+    with the same expression doesn't reparse the python source.'''
     if(do_eval):
-        return eval(expr)
-    else:
-        exec(expr)
+        return _compile_expr(expr)(fs, *key)
+    code = _exec_cache.get(expr)
+    if(code is None):
+        code = compile(expr, "<statement %s>" % expr, "exec")
+        _exec_cache[expr] = code
+    ldict = {"f" : fs}
+    for i, nm in enumerate(("i1", "i2", "i3", "i4")):
+        if(len(key) > i):
+            ldict[nm] = key[i]
+    exec(code, globals(), ldict)
     
+class _FieldValueDict(dict):
+    '''Dictionary that supplies a default value for missing keys. This
+    is like a defaultdict, but doesn't need a factory function (so for
+    example it can be pickled).
+
+    This also handles a lazy read (see FieldStruct.read_from_file),
+    where we only save the raw bytes for each field. If we have raw (the
+    raw_value_dict of the field), a missing key found there is converted
+    with decode the first time it is accessed.'''
+    __slots__ = ("default", "raw", "decode")
+    def __init__(self, default, raw=None, decode=None):
+        self.default = default
+        self.raw = raw
+        self.decode = decode
+
+    def __missing__(self, key):
+        if(self.raw is not None and key in self.raw):
+            v = self.decode(self.raw[key])
+        else:
+            v = self.default
+        self[key] = v
+        return v
+
+    def __reduce__(self):
+        # Only pickle the values, not the raw data
+        return (_FieldValueDict, (self.default,), None, None,
+                iter(self.items()))
+
+class _ArrayValueDict(object):
+    '''Alternative to _FieldValueDict for int and float fields in a
+    rectangular loop, where the values are stored in a numpy array
+    (see NitfField.as_array).
+
+    We handle the same key/value lookup as a dict. Keys outside of the
+    array, or values that can't be stored in it (e.g., None or a 
+    NitfLiteral) get stored in a normal dict "extra".'''
+    __slots__ = ("array", "default", "extra")
+    def __init__(self, array, default):
+        self.array = array
+        self.default = default
+        self.extra = {}
+
+    def _in_array(self, key):
+        if(len(key) != self.array.ndim):
+            return False
+        for i, sz in zip(key, self.array.shape):
+            if(not isinstance(i, (int, np.integer)) or i < 0 or i >= sz):
+                return False
+        return True
+
+    def __getitem__(self, key):
+        if(self.extra and key in self.extra):
+            return self.extra[key]
+        if(self._in_array(key)):
+            return self.array[key]
+        return self.default
+
+    def __setitem__(self, key, v):
+        if(isinstance(v, (int, float, np.number)) and self._in_array(key)):
+            try:
+                self.array[key] = v
+                if(self.extra):
+                    self.extra.pop(key, None)
+                return
+            except (OverflowError, TypeError, ValueError):
+                pass
+        self.extra[key] = v
+
+class _ArrayRawDict(object):
+    '''Alternative to a dict for the raw bytes of a field in a loop that
+    was read all at once (see _ArrayLoop in nitf_field_codegen). Rather
+    than splitting the data up for each index, we keep the bytes for
+    the whole loop and pull out the field when it is asked for.
+
+    Keys that get set or deleted are stored in a normal dict "extra"
+    (with None for a deleted key).'''
+    __slots__ = ("data", "offset", "stride", "size", "n", "extra")
+    def __init__(self, data, offset, stride, size, n):
+        self.data = data
+        self.offset = offset
+        self.stride = stride
+        self.size = size
+        self.n = n
+        self.extra = {}
+
+    def __contains__(self, key):
+        if(key in self.extra):
+            return self.extra[key] is not None
+        return (len(key) == 1 and isinstance(key[0], (int, np.integer)) and
+                0 <= key[0] < self.n)
+
+    def __getitem__(self, key):
+        if(key not in self):
+            raise KeyError(key)
+        if(key in self.extra):
+            return self.extra[key]
+        i = self.offset + key[0] * self.stride
+        return self.data[i:(i+self.size)]
+
+    def __setitem__(self, key, v):
+        self.extra[key] = v
+
+    def __delitem__(self, key):
+        if(key not in self):
+            raise KeyError(key)
+        self.extra[key] = None
+
 class NitfField(object):
     '''A NITF field is complicated enough that we have a separate class
     to handle it. This class worries about the looping structure, conditional
-    and optional fields, etc.'''
+    and optional fields, etc.
+
+    For a FieldStruct, the NitfField objects are created once for each
+    class as part of the FieldStructSchema. These describe the field, but
+    don't hold any values. Each FieldStruct object then gets a light
+    weight "bound" copy of each field (see bind), which shares everything
+    that comes from the description and just has the values read or set
+    for that object.'''
+    # The values for a particular object. Everything else is part of the
+    # description, and shared between all the objects for a FieldStruct
+    # class.
+    __slots__ = ("fs", "value_dict", "raw_value_dict", "fh_loc", "__dict__")
     def __init__(self, fs, field_name, size, ty, loop, options):
         '''Give the size, type, loop structure, and options to to use. If
         default is given as None, we use a default default value of
@@ -85,6 +392,10 @@ class NitfField(object):
             self.fs_name = type(fs).__name__
         self.field_name = field_name
         self._size = size
+        # Compiled size expression, or None if the size is a fixed value
+        self._size_func = None
+        if(isinstance(size, str)):
+            self._size_func = _compile_expr(size)
         self.size_offset = options.get("size_offset", 0)
         self.size_not_updated = options.get("size_not_updated", False)
         self.ty = ty
@@ -94,6 +405,9 @@ class NitfField(object):
         self.frmt = options.get("frmt", None)
         self.default = options.get("default", None)
         self.condition = options.get("condition", None)
+        self._condition_func = None
+        if(self.condition is not None):
+            self._condition_func = _compile_expr(self.condition)
         self.optional = options.get("optional", False)
         self.optional_char = options.get("optional_char", " ")
         self.hardcoded_value = options.get("hardcoded_value", False)
@@ -102,19 +416,18 @@ class NitfField(object):
         # To prevent needing special handling, a single value is still
         # treated as a dict with a key of (). You
         # get the value by self.value_dict[key].  
-        if(self.field_name is None):
-            self.value_dict = None
         if(self.default is not None):
-            self.value_dict = defaultdict(lambda : self.default)
+            self._default_value = self.default
         elif(self.optional):
-            self.value_dict = defaultdict(lambda : None)
+            self._default_value = None
         elif(self.ty == str):
-            self.value_dict = defaultdict(lambda : "")
+            self._default_value = ""
         else:
-            self.value_dict = defaultdict(lambda : 0)
+            self._default_value = 0
+        self.value_dict = _FieldValueDict(self._default_value)
         # Second version that saves the raw data. I don't think saving
         # data twice will be a problem, but if it is we can come back
-        # to this.
+        # to this. This holds the bytes read from the file.
         self.raw_value_dict = {}
         # Location data was written in file, used by update_file.
         self.fh_loc = {}
@@ -122,6 +435,46 @@ class NitfField(object):
         # This is really meant for the derived class FieldData where
         # we separately handling going to and from bytes.
         self._check_or_set_size = False
+        # Index in FieldStruct._field_list, filled in by FieldStructSchema
+        self._findex = None
+        # True if this field is used in a size, condition, or loop
+        # expression, so changing it can change the size of the
+        # FieldStruct (see FieldStruct.serialized_size). Filled in by
+        # FieldStructSchema.
+        self._layout = False
+        # True if the shape of a loop depends on this field, so changing
+        # it clears the cached loop shapes (see NitfLoop.shape). Filled
+        # in by FieldStructSchema.
+        self._shape_dep = False
+
+    def bind(self, fs):
+        '''Return a NitfField for the FieldStruct fs, with the same
+        description as this field but its own values.
+
+        The description is stored as class attributes of a class created
+        for this field (the first time we need it), so the returned object
+        only holds the values.'''
+        cls = self.__dict__.get("_bound_cls")
+        if(cls is None):
+            base = type(self)
+            # Functions (e.g., compiled expressions, frmt) need to be
+            # static, otherwise they get turned into methods
+            ns = {k : (staticmethod(v) if isinstance(v, types.FunctionType)
+                       else v) for k, v in self.__dict__.items()}
+            ns.update(__slots__=(), __module__=base.__module__,
+                      __qualname__=base.__qualname__)
+            # _decode only depends on the description, so we can use the
+            # one from this field for all the objects
+            ns["_schema_decode"] = staticmethod(self._decode)
+            cls = type(base.__name__, (base,), ns)
+            self._bound_cls = cls
+        res = cls.__new__(cls)
+        res.fs = fs
+        res.raw_value_dict = {}
+        res.value_dict = _FieldValueDict(self._default_value,
+                                         res.raw_value_dict, cls._schema_decode)
+        res.fh_loc = {}
+        return res
 
     @property
     def has_loop(self):
@@ -134,50 +487,194 @@ class NitfField(object):
         return self.loop.dim_size
 
     def shape(self, key):
-        return self.loop.shape(key)
+        return self.loop.shape(self.fs, key)
 
     @classmethod
     def is_shape_equal(cls, fld1, fld2, lead=()):
         '''Return True if the shape of fld1 and fld2 are the same,
         False otherwise'''
-        return NitfLoop.is_shape_equal(fld1.loop, fld2.loop)
+        return NitfLoop.is_shape_equal(fld1.fs, fld1.loop, fld2.fs, fld2.loop)
     
     def to_list(self):
         '''Return the data as a nested list. Scalar items as returned as a 
         scalar'''
         return self.loop.to_list(self)
 
+    def _column(self, keys):
+        '''Return the values for the given keys as a 1d numpy array, see
+        FieldStruct.to_numpy.'''
+        may_be_none = (self.optional or self.condition is not None or
+                       self.value_func is not None)
+        if(self.ty in (int, float) and not isinstance(self, FieldData)):
+            dtype = (np.int64 if self.ty == int and not may_be_none
+                     else np.float64)
+        elif(self.ty == str and not isinstance(self, FieldData)):
+            dtype = str
+        else:
+            dtype = object
+        n = len(keys)
+        if(dtype is not object and dtype is not str and not may_be_none and
+           self.dim_size == 1):
+            # Use the array we already have, or convert the bytes we read
+            # directly
+            vd = self.value_dict
+            raw = self.raw_value_dict
+            if(isinstance(vd, _ArrayValueDict) and not vd.extra and
+               vd.array.shape == (n,)):
+                return vd.array.astype(dtype)
+            if(isinstance(raw, _ArrayRawDict) and not raw.extra and
+               raw.n == n and b'\0' not in raw.data and
+               not self._modified()):
+                try:
+                    return np.ndarray((n,), dtype="S%d" % raw.size,
+                                      buffer=raw.data, offset=raw.offset,
+                                      strides=(raw.stride,)).astype(dtype)
+                except (ValueError, OverflowError):
+                    # Let the normal code report the error
+                    pass
+        vals = [self[k] for k in keys]
+        if(may_be_none and dtype is not object):
+            missing = "" if dtype is str else np.nan
+            vals = [missing if v is None else v for v in vals]
+        if(dtype is object):
+            res = np.empty((n,), dtype=object)
+            res[:] = vals
+            return res
+        return np.array(vals, dtype=dtype)
+
+    def _array_shape(self):
+        '''Return the shape of the array holding the values of this field.
+        This is an error if the loop isn't rectangular.'''
+        shape = []
+        leads = [()]
+        for d in range(self.loop.dim_size):
+            sizes = set(self.loop.shape(self.fs, lead) for lead in leads)
+            if(len(sizes) > 1):
+                raise RuntimeError("The loop for field %s isn't rectangular, so it can't be used as an array" % self.field_name)
+            sz = sizes.pop() if sizes else 0
+            shape.append(sz)
+            leads = [(*lead, i) for lead in leads for i in range(sz)]
+        return tuple(shape)
+
+    def _check_array(self):
+        '''Check that we can return this field as a numpy array, returning
+        the dtype of the array.'''
+        if(self.loop is None or not self.has_loop):
+            raise RuntimeError("Field %s isn't in a loop, so it can't be used as an array" % self.field_name)
+        if(isinstance(self, IntFieldData)):
+            return np.int64
+        if(isinstance(self, FloatFieldData)):
+            return np.float64
+        if(self.ty not in (int, float) or self.value_func is not None or
+           self.field_name is None or isinstance(self, FieldData)):
+            raise RuntimeError("Field %s isn't an int or float field, so it can't be used as an array" % self.field_name)
+        return np.int64 if self.ty == int else np.float64
+
+    def as_array(self):
+        '''Return the values of a looped int or float field as a numpy
+        array. The loop needs to be rectangular (so for a 2d loop the inner
+        loop needs to be the same size for every value of the outer loop),
+        and the field must be present for every index.
+
+        After this is called, the values of the field are stored in
+        the returned array. So you can modify values through the array,
+        e.g., tre.rnpcf.as_array()[:] = coeff. This is much faster than
+        accessing each element for large loops. Note that if the size of
+        the loop changes you need to call as_array again to get the
+        new array.
+
+        Binary data (IntFieldData and FloatFieldData) is also supported,
+        but for these we return a copy of the data.'''
+        dtype = self._check_array()
+        shape = self._array_shape()
+        vd = self.value_dict
+        if(isinstance(vd, _ArrayValueDict) and not vd.extra and
+           vd.array.shape == shape):
+            # The array might get modified, so we can't use the raw
+            # values any longer
+            self.raw_value_dict = {}
+            self._array_exposed()
+            return vd.array
+        res = np.empty(shape, dtype=dtype)
+        for k in np.ndindex(shape):
+            v = self[k]
+            if(v is None):
+                raise RuntimeError("Field %s%s doesn't have a value, so it can't be used as an array" % (self.field_name, self.loop.key_to_str(k)))
+            res[k] = v
+        if(not isinstance(self, FieldData)):
+            self._set_array_storage(res)
+            self._array_exposed()
+        return res
+
+    def _array_exposed(self):
+        '''Called when as_array returns the array holding our values. This
+        can be modified without us knowing, so if a loop shape depends on
+        this field we can't cache the shapes any longer.'''
+        if(self._shape_dep):
+            self.fs._loop_cache = None
+
+    def set_array(self, v):
+        '''Set the values of a looped int or float field from an array. 
+        The array needs to be the same shape as the loop, so you should
+        set the loop size first (e.g., set tre.num_ephem before setting
+        tre.ephem_x).
+
+        Like as_array, the values are then stored in a numpy array.'''
+        dtype = self._check_array()
+        self._check_settable()
+        if(self.condition is not None):
+            raise RuntimeError("Can't set conditional field %s from an array" % self.field_name)
+        shape = self._array_shape()
+        if(np.shape(v) != shape):
+            raise RuntimeError("Array for field %s should have shape %s, but has shape %s" % (self.field_name, shape, np.shape(v)))
+        v = np.array(v, dtype=dtype)
+        if(isinstance(self, FieldData)):
+            for k in np.ndindex(shape):
+                self[k] = v[k].item()
+        else:
+            self._set_array_storage(v)
+
+    def _set_array_storage(self, v):
+        self.value_dict = _ArrayValueDict(v, self._default_value)
+        # The raw values might get out of date if the array is changed.
+        # So just drop them, get_raw_bytes will use the formatted value
+        # instead.
+        self.raw_value_dict = {}
+        if(self._layout):
+            self.fs._serialized_size = None
+        if(self._shape_dep and self.fs._loop_cache):
+            self.fs._loop_cache.clear()
+        
     def values(self):
         '''Iterate through values. This uses the 'C' like order, where we
         vary the last index the fastest. This is like doing a flatten on 
         the results of to_list'''
-        for k in self.loop.keys():
+        for k in self.loop.keys(self.fs):
             yield self[k]
                         
     def items(self):
         '''Likes values(), but iterator through a tuple of the (index,value)
         instead of just values.'''
-        for k in self.loop.keys():
+        for k in self.loop.keys(self.fs):
             yield (k, self[k])
     
     def size(self, key):
         '''Return the size. In the simplest case, this is just self._size,
         but if self._size is an expression then we evaluate it. We also
         apply size_offset'''
-        if (type(self._size) == int):
+        if (self._size_func is None):
             sz = self._size
         else:
-            sz = self.eval_expr(self.key_as_tuple(key), self._size)
+            sz = self._size_func(self.fs, *self.key_as_tuple(key))
         if(sz != 0):
             sz -= self.size_offset
         return sz
 
     def _set_size(self, key, sz):
         '''Set the value given by the sz expression'''
-        if(sz == 0):
-            self.exec_expr(key, "%s = 0" % self._size)
-        else:
-            self.exec_expr(key, "%s = %d" % (self._size, sz + self.size_offset))
+        if(sz != 0):
+            sz += self.size_offset
+        _compile_assign(self._size)(self.fs, sz, *key)
 
     def _format_val(self, v, sz):
         '''Format a value to a given size.'''
@@ -223,9 +720,9 @@ class NitfField(object):
     def check_condition(self, key):
         '''Evaluate the condition (if present) and return False if it isn't
         met, True if it is or if there is no condition'''
-        if(self.condition is None):
+        if(self._condition_func is None):
             return True
-        v = self.eval_expr(key, self.condition)
+        v = self._condition_func(self.fs, *key)
         if(DEBUG):
             print("Condition: " + self.condition)
             print("eval: " + str(v))
@@ -243,7 +740,7 @@ class NitfField(object):
         without converting to the field type.'''
         k = self.key_as_tuple(key)
         if(k in self.raw_value_dict):
-            return self.raw_value_dict[k].value
+            return self.raw_value_dict[k]
         return self.bytes(k)
     
     def __getitem__(self, key):
@@ -251,54 +748,66 @@ class NitfField(object):
             return ''
         k = self.key_as_tuple(key)
         if(self.loop is not None):
-            self.loop.check_index(k)
+            self.loop.check_index(self.fs, k)
         if(not self.check_condition(k)):
             return None
+        v = None
         try:
-            v = None
             if(self.value_func is not None):
                 v = self.value_func(self.fs, k)
             else:
                 v = self.value_dict[k]
-            if(self.optional and v is None):
-                return None
-            if(isinstance(v, NitfLiteral)):
-                v = v.value
-                if(self.optional and
-                   v.rstrip(self.optional_char.encode(_text_codec) + b' ') == b''):
-                    return None
-            if(self.ty == str):
-                if(isinstance(v, bytes)):
-                    return v.decode(_text_codec).rstrip()
-                return self.ty(v).rstrip()
-            else:
-                return self.ty(v)
+            return self._convert(v)
         except Exception as e:
-            if(self.loop is None):
-                raise RuntimeError("Error occurred getting '%s' from '%s'. Value '%s'" % (self.field_name, self.fs_name, v)) from e
-            else:
-                raise RuntimeError("Error occurred getting '%s[%s]' from '%s'. Value '%s'" % (self.field_name, key, self.fs_name, v)) from e
+            self._getitem_error(key, v, e)
+
+    def _convert(self, v):
+        '''Convert a value as stored in value_dict to the value we
+        return for the field.'''
+        if(self.optional and v is None):
+            return None
+        if(isinstance(v, NitfLiteral)):
+            v = v.value
+            if(self.optional and
+               v.rstrip(self.optional_char.encode(_text_codec) + b' ') == b''):
+                return None
+        if(self.ty == str):
+            if(isinstance(v, bytes)):
+                return v.decode(_text_codec).rstrip()
+            return self.ty(v).rstrip()
+        else:
+            return self.ty(v)
+
+    def _getitem_error(self, key, v, e):
+        if(self.loop is None):
+            raise RuntimeError("Error occurred getting '%s' from '%s'. Value '%s'" % (self.field_name, self.fs_name, v)) from e
+        else:
+            raise RuntimeError("Error occurred getting '%s[%s]' from '%s'. Value '%s'" % (self.field_name, key, self.fs_name, v)) from e
             
     def __setitem__(self, key, v):
         if(self.field_name is None):
             raise RuntimeError("Can't set a reserved field")
         k = self.key_as_tuple(key)
         if(self.loop is not None):
-            self.loop.check_index(k)
+            self.loop.check_index(self.fs, k)
         if(not self.check_condition(k)):
             raise RuntimeError("Can't set value for field %s because the condition '%s' isn't met" % (self.field_name, self.condition))
-        if(self.hardcoded_value or self.value_func):
-            raise RuntimeError("Can't set value for field " + self.field_name)
-        # If we are implementing the TRE in its own object, don't allow
-        # the raw values to be set
-        if(self.fs and hasattr(self.fs, "tre_implementation_field") and
-           self.fs.tre_implementation_field is not None):
-            raise RuntimeError("You can't directly set fields in %s TRE. Instead, set this through the %s object" % (self.fs.cetag_value(), self.fs.tre_implementation_field))
+        self._set(k, v)
+
+    def _set(self, k, v):
+        '''The rest of __setitem__, once we have checked the index and
+        condition. _FieldAttribute calls this directly for a scalar field
+        without a condition.'''
+        self._check_settable()
         if(v is None and not self.optional):
             raise RuntimeError("Can only set a field to 'None' if it is marked as being optional")
         self.value_dict[k] = v
         if k in self.raw_value_dict:
             del self.raw_value_dict[k]
+        if(self._layout):
+            self.fs._serialized_size = None
+        if(self._shape_dep and self.fs._loop_cache):
+            self.fs._loop_cache.clear()
         if self._check_or_set_size:
             if(self.size_not_updated):
                 sz = self.size(k)
@@ -307,22 +816,62 @@ class NitfField(object):
             else:
                 self._set_size(k, len(v))
  
+    def _check_settable(self):
+        '''Check that the value of the field is allowed to be set.'''
+        if(self.hardcoded_value or self.value_func):
+            raise RuntimeError("Can't set value for field " + self.field_name)
+        # If we are implementing the TRE in its own object, don't allow
+        # the raw values to be set
+        # Check the class first, which is much faster than hasattr for a
+        # FieldStruct that doesn't have this (since that goes through
+        # FieldStruct.__getattr__)
+        if(self.fs is not None and
+           hasattr(self.fs.__class__, "tre_implementation_field") and
+           self.fs.tre_implementation_field is not None):
+            raise RuntimeError("You can't directly set fields in %s TRE. Instead, set this through the %s object" % (self.fs.cetag_value(), self.fs.tre_implementation_field))
+
     def bytes(self, key=()):
         '''Return bytes version of this value, formatted and padded as
         NITF will store this.'''
         # If we have a NitfLiteral we assume some sort of funky formating
         # that is handled outside of this class. Pad, but otherwise don't
         # process this.
+        #
+        # If the value hasn't been set since we read it, we just return
+        # the bytes we read. This avoids reformatting (so for example
+        # a float read as "1.50" doesn't get written as "1.5000"), and is
+        # faster.
         k = self.key_as_tuple(key)
         sz = self.size(k)
-        if(isinstance(self.value_dict[k], NitfLiteral)):
-            t = self.value_dict[k].value.ljust(sz)
+        raw = self.raw_value_dict
+        if(k in raw and self.value_func is None):
+            t = raw[k]
+            if(len(t) == sz):
+                return t
+        return self._encode(self.value_dict[k], sz, k)
+
+    def _encode(self, v, sz, k, checked=False):
+        '''Return the bytes for the given value as stored in value_dict
+        (for the key k), with the given size. This is the bulk of the
+        bytes function, separated out so the generated write functions
+        can call it directly. If checked is True, the caller has already
+        checked the index and condition for k.'''
+        literal = isinstance(v, NitfLiteral)
+        if(literal):
+            t = v.value.ljust(sz)
         else:
             # Otherwise, get the value and do the formatting that has been
             # supplied to us. Note that we have the explicit getitem in call
             # here because FieldData may override this, but we want this low
             # level raw value
-            v = NitfField.__getitem__(self,k)
+            if(checked and self.value_func is None and
+               self.field_name is not None):
+                try:
+                    v = self._convert(v)
+                except Exception as e:
+                    self._getitem_error(k, v, e)
+            else:
+                v = NitfField.__getitem__(self,k)
             if(v is None and self.optional):
                 t = ("{:%ds}" % sz).format("").replace(" ", self.optional_char)
             elif self.ty == bytes:
@@ -331,11 +880,23 @@ class NitfField(object):
                 t = self._format_val(v, sz)
         if(len(t) != sz):
             raise RuntimeError("Formatting error. String '%s' is not right length for NITF field %s" % (t, self.field_name))
-        if(self.ty == bytes or isinstance(self.value_dict[k], NitfLiteral)):
+        if(self.ty == bytes or literal):
             return t
         else:
             return t.encode(_text_codec)
         
+    def serialized_size(self, key):
+        '''Return the number of bytes write_to_file writes for the
+        given key, without formatting the value.'''
+        k = self.key_as_tuple(key)
+        if(type(self).write_to_file is not NitfField.write_to_file):
+            fh = BufferWriter()
+            self.write_to_file(fh, k)
+            return len(fh.data)
+        if(not self.check_condition(k)):
+            return 0
+        return self.size(k)
+    
     def write_to_file(self, fh, key):
         k = self.key_as_tuple(key)
         if(not self.check_condition(k)):
@@ -361,7 +922,7 @@ class NitfField(object):
         fh.write(self.bytes(k))
         fh.seek(last_pos)
         
-    def read_from_file(self, fh, nitf_literal, key):
+    def read_from_file(self, fh, nitf_literal, key, lazy=False):
         k = self.key_as_tuple(key)
         if(not self.check_condition(k)):
             return
@@ -373,27 +934,110 @@ class NitfField(object):
             print("Value: " + str(t))
         if(len(t) != sz):
             raise RuntimeError("Not enough bytes left to read %d bytes for field %s" % (sz, self.field_name))
+        # We save the raw bytes even for reserved fields, so we write
+        # them back out unchanged (see bytes)
+        self.raw_value_dict[k] = bytes(t)
         if(self.field_name is not None):
-            try:
-                self.raw_value_dict[k] = NitfLiteral(t)
-                if(nitf_literal):
-                    self.value_dict[k] = NitfLiteral(t)
-                elif(self.optional and
-                 t.rstrip(self.optional_char.encode(_text_codec) + b' ') == b''):
-                    self.value_dict[k] = None
-                elif(self.ty == str):
-                    self.value_dict[k] = t.rstrip().decode(_text_codec, "replace")
-                elif(self.ty == bytes):
-                    # Don't strip spaces or nulls, since these are valid
-                    # byte values
-                    self.value_dict[k] = self.ty(t)
-                else:
-                    v = t.rstrip()
-                    if(v == b''):
-                        raise RuntimeError("Empty string read for field %s" % self.field_name)
-                    self.value_dict[k] = self.ty(v)
-            except Exception as e:
-                raise Exception("Exception while parsing ", self.field_name, " from ", t.rstrip(), "underlying error: ", e)
+            if(nitf_literal):
+                self.value_dict[k] = NitfLiteral(t)
+            elif(not lazy):
+                self.value_dict[k] = self._decode(t)
+
+    def _decode(self, t):
+        '''Convert the bytes t read from a file to the value of the field.'''
+        try:
+            if(self.optional and
+               t.rstrip(self.optional_char.encode(_text_codec) + b' ') == b''):
+                return None
+            elif(self.ty == str):
+                return t.rstrip().decode(_text_codec, "replace")
+            elif(self.ty == bytes):
+                # Don't strip spaces or nulls, since these are valid
+                # byte values
+                return self.ty(t)
+            else:
+                v = t.rstrip()
+                if(v == b''):
+                    raise RuntimeError("Empty string read for field %s" % self.field_name)
+                return self.ty(v)
+        except Exception as e:
+            raise Exception("Exception while parsing ", self.field_name, " from ", t.rstrip(), "underlying error: ", e)
+
+    def _copy_values(self, other):
+        '''Copy the values (and raw bytes) from the NitfField other, which
+        has the same description. Used by FieldStruct.__deepcopy__.'''
+        vd = other.value_dict
+        raw = other.raw_value_dict
+        if(not raw and type(vd) is _FieldValueDict and not vd):
+            return
+        if(isinstance(raw, _ArrayRawDict)):
+            r = _ArrayRawDict(raw.data, raw.offset, raw.stride, raw.size,
+                              raw.n)
+            r.extra = dict(raw.extra)
+        else:
+            r = dict(raw)
+        if(isinstance(vd, _ArrayValueDict)):
+            self.value_dict = _ArrayValueDict(vd.array.copy(), vd.default)
+            self.value_dict.extra = dict(vd.extra)
+            self.raw_value_dict = r
+        else:
+            self._set_lazy(r if vd.raw is raw else {})
+            self.value_dict.update(vd)
+
+    def _value_state(self):
+        '''Return the values of this field for pickling, see
+        FieldStruct.__getstate__. This is None if nothing has been set.
+
+        Like __deepcopy__, this includes the raw bytes we read, so the
+        unpickled field writes out the same bytes (see bytes). This also
+        includes the raw bytes of a lazy read that haven't been converted
+        yet.'''
+        vd = self.value_dict
+        raw = self.raw_value_dict
+        if(not raw):
+            raw = None
+        if(isinstance(vd, _ArrayValueDict)):
+            return (vd.array, vd.extra or None, raw)
+        if(not vd and raw is None):
+            return None
+        return (dict(vd), raw)
+
+    def _set_value_state(self, state):
+        '''Set the values from the results of _value_state.'''
+        if(state is None):
+            return
+        if(isinstance(state[0], np.ndarray)):
+            # Older pickles didn't have the raw bytes for an array
+            values, extra, r = state if len(state) == 3 else (*state, None)
+            self.value_dict = _ArrayValueDict(values, self._default_value)
+            if(extra):
+                self.value_dict.extra = extra
+            self.raw_value_dict = r if r is not None else {}
+        else:
+            values, r = state
+            self._set_lazy(r if r is not None else {})
+            self.value_dict.update(values)
+
+    def _modified(self):
+        '''True if a value of this field was set since it was read, see
+        FieldStruct.modified_fields. Setting a value removes the raw
+        bytes we read for it, so this is a value that doesn't have raw
+        bytes.'''
+        vd = self.value_dict
+        raw = self.raw_value_dict
+        if(isinstance(vd, _ArrayValueDict)):
+            if(isinstance(raw, _ArrayRawDict)):
+                return bool(raw.extra)
+            return any(k not in raw for k in
+                       itertools.chain(np.ndindex(vd.array.shape), vd.extra))
+        return any(k not in raw for k in vd)
+
+    def _set_lazy(self, raw):
+        '''Use raw for the raw_value_dict, with the values converted
+        from it when they are accessed (see _FieldValueDict).'''
+        self.raw_value_dict = raw
+        self.value_dict = _FieldValueDict(self._default_value, raw,
+                                          self._schema_decode)
 
 class FieldData(NitfField):
     '''Class to handle generic variable size data, which in some cases
@@ -536,10 +1180,14 @@ class NitfLoop(object):
     having parent_list None.
 
     The keys of the pseudo loop are just the list [(),]
+
+    Like NitfField, this is part of the FieldStructSchema and is shared
+    by all the objects of a FieldStruct class. So functions that depend
+    on the values (e.g., the shape of the loop) take the FieldStruct fs
+    as an argument.
     ''' 
-    def __init__(self, fs, parent_loop, desc, field):
+    def __init__(self, parent_loop, desc, field):
         '''Note, this also fills in data in the OrderedDict field.'''
-        self.fs = fs
         self.parent_list = None
         if(parent_loop):
             if(parent_loop.parent_list):
@@ -552,33 +1200,52 @@ class NitfLoop(object):
             if(desc[0][0] != "loop"):
                 raise RuntimeError("Error parsing looping structure:\n" + desc)
             self._shape = desc[0][1]
+            self._shape_func = _compile_expr(str(self._shape))
             desc_rest = desc[1:]
         else:
             self._shape = None
+            self._shape_func = None
             desc_rest = desc
+        # True if the shape (or the keys) only depend on fields, so we
+        # can cache them in the FieldStruct. Filled in by
+        # FieldStructSchema.
+        self._shape_cacheable = False
+        self._keys_cacheable = False
         for row in desc_rest:
             if(isinstance(row[0], list)):
-                self.field_list.append(NitfLoop(self.fs, self, row, field))
+                self.field_list.append(NitfLoop(self, row, field))
             else:
                 field_name, desc, size, ty, rest = row[0],row[1],row[2],row[3],row[4:]
                 options = {}
                 if(len(rest) > 0):
                     options = rest[0]
-                fv = options.get("field_value_class", NitfField)(self.fs,
+                fv = options.get("field_value_class", NitfField)(None,
                               field_name, size, ty, self, options)
                 if(field_name):
                     field[field_name] = fv
                 self.field_list.append(fv)
                 
-    def shape(self, key):
-        '''Return size of this dimension.'''
+    def shape(self, fs, key):
+        '''Return size of this dimension.
+
+        The shape is cached in the FieldStruct (see
+        FieldStruct._loop_cache), so we don't evaluate the shape
+        expression again until a field it depends on is set.'''
         if(len(key) >= self.dim_size - 1):
-            t = _eval_or_exec_expr(self.fs, key, self._shape, True)
+            cache = fs._loop_cache if self._shape_cacheable else None
+            if(cache is not None):
+                k = (self, key[:self.dim_size - 1])
+                t = cache.get(k)
+                if(t is not None):
+                    return t
+            t = self._shape_func(fs, *key)
             if(t is None):
                 t = 0
+            if(cache is not None):
+                cache[k] = t
             return t
         else:
-            return self.parent_list[len(key)+1].shape(key)
+            return self.parent_list[len(key)+1].shape(fs, key)
 
     @property
     def dim_size(self):
@@ -587,7 +1254,7 @@ class NitfLoop(object):
             return 0
         return len(self.parent_list)
     
-    def check_index(self, key):
+    def check_index(self, fs, key):
         '''Check if key is within the range of the loops'''
         # Skip if we are null outer loop
         if(self.parent_list is None):
@@ -596,25 +1263,38 @@ class NitfLoop(object):
             raise IndexError()
         if(isinstance(key[-1], slice)):
             raise RuntimeError("FieldStruct doesn't support slices in arrays")
-        if(key[-1] < 0 or key[-1] >= self.shape(key[:-1])):
+        if(key[-1] < 0 or key[-1] >= self.shape(fs, key[:-1])):
             raise IndexError()
 
-    def key_subloop(self, lead):
+    def key_subloop(self, fs, lead):
         '''Iterate through the set of keys for this specific loop.'''
         if(self.dim_size == 0):
             yield ()
             return
-        for i in range(self.shape(lead)):
+        for i in range(self.shape(fs, lead)):
             yield (*lead,i)
         
-    def keys(self,lead=()):
-        '''Iterate through all the key tuples.'''
-        for k2 in self.key_subloop(lead):
+    def keys(self, fs, lead=()):
+        '''Iterate through all the key tuples.
+
+        The full list of keys (lead of ()) is cached in the FieldStruct,
+        like the shape.'''
+        if(len(lead) == 0 and self._keys_cacheable):
+            cache = fs._loop_cache
+            if(cache is not None):
+                res = cache.get(self)
+                if(res is None):
+                    res = tuple(self._keys(fs, lead))
+                    cache[self] = res
+                return res
+        return self._keys(fs, lead)
+
+    def _keys(self, fs, lead):
+        for k2 in self.key_subloop(fs, lead):
             if(len(k2) == self.dim_size):
                 yield k2
             else:
-                for j in self.keys(k2):
-                    yield j
+                yield from self._keys(fs, k2)
                     
     def key_to_str(self, key):
         '''Write out key as a string (with handling for key = ())'''
@@ -622,17 +1302,55 @@ class NitfLoop(object):
             return ""
         return "[" + ", ".join(str(i) for i in key) + "]"
         
-    def write_to_file(self, fh, lead=()):
+    def all_fields(self):
+        '''Iterate through all the NitfField in this loop, including those
+        in nested loops and reserved fields, in the order they appear
+        in the NITF file.'''
+        for fv in self.field_list:
+            if(isinstance(fv, NitfLoop)):
+                yield from fv.all_fields()
+            else:
+                yield fv
+                
+    def all_loops(self):
+        '''Iterate through all the loops nested in this loop, in the
+        order they appear in the NITF file.'''
+        for fv in self.field_list:
+            if(isinstance(fv, NitfLoop)):
+                yield fv
+                yield from fv.all_loops()
+
+    def write_to_file(self, fs, fh, lead=()):
         '''Write data stored in the loop to a file'''
-        for k in self.key_subloop(lead):
+        fvs = fs._field_list
+        for k in self.key_subloop(fs, lead):
             for fv in self.field_list:
-                fv.write_to_file(fh, k)
+                if(isinstance(fv, NitfLoop)):
+                    fv.write_to_file(fs, fh, k)
+                else:
+                    fvs[fv._findex].write_to_file(fh, k)
+            
+    def serialized_size(self, fs, lead=()):
+        '''Return the number of bytes write_to_file writes'''
+        fvs = fs._field_list
+        res = 0
+        for k in self.key_subloop(fs, lead):
+            for fv in self.field_list:
+                if(isinstance(fv, NitfLoop)):
+                    res += fv.serialized_size(fs, k)
+                else:
+                    res += fvs[fv._findex].serialized_size(k)
+        return res
             
-    def read_from_file(self, fh, nitf_literal=False, lead=()):
+    def read_from_file(self, fs, fh, nitf_literal=False, lead=(), lazy=False):
         '''Read data from a file for the fields in this loop'''
-        for k in self.key_subloop(lead):
+        fvs = fs._field_list
+        for k in self.key_subloop(fs, lead):
             for fv in self.field_list:
-                fv.read_from_file(fh, nitf_literal, k)
+                if(isinstance(fv, NitfLoop)):
+                    fv.read_from_file(fs, fh, nitf_literal, k, lazy)
+                else:
+                    fvs[fv._findex].read_from_file(fh, nitf_literal, k, lazy)
 
     def to_list(self, fld,lead=()):
         '''Return the data in NitfField fld as a nested list. Scalar items 
@@ -640,31 +1358,31 @@ class NitfLoop(object):
         if(self.dim_size == 0):
             return fld[()]
         if(len(lead) == self.dim_size - 1):
-            return [fld[(*lead, i)] for i in range(self.shape(lead))]
+            return [fld[(*lead, i)] for i in range(self.shape(fld.fs, lead))]
         return [self.to_list(fld, lead=(*lead, i))
-                for i in range(self.shape(lead))]
+                for i in range(self.shape(fld.fs, lead))]
 
     @classmethod
-    def is_shape_equal(cls, loop1, loop2, lead=()):
+    def is_shape_equal(cls, fs1, loop1, fs2, loop2, lead=()):
         '''Check if two loops have the same shape.'''
         try:
             if(loop1.dim_size != loop2.dim_size):
                 return False
             if(len(lead) == loop1.dim_size - 1):
-                return loop1.shape(lead) == loop2.shape(lead)
-            for k in loop1.key_subloop(lead):
-                if not cls.is_shape_equal(loop1, loop2, lead=k):
+                return loop1.shape(fs1, lead) == loop2.shape(fs2, lead)
+            for k in loop1.key_subloop(fs1, lead):
+                if not cls.is_shape_equal(fs1, loop1, fs2, loop2, lead=k):
                     return False
             return True
         except IndexError:
             return False
 
-    def print_to_fh(self, fh):
+    def print_to_fh(self, fs, fh):
         '''Print a description of fields in this loop'''
         max_len = max((len(fld.field_name) for fld in self.field_list
                        if(not isinstance(fld, NitfLoop)) and
                        fld.field_name is not None),default=10)
-        max_len += max((len(self.key_to_str(k)) for k in self.keys()),
+        max_len += max((len(self.key_to_str(k)) for k in self.keys(fs)),
                        default=0)
         if(self.dim_size > 0):
             print("  " * (self.dim_size-1) + "Loop - %s" % self._shape,
@@ -672,12 +1390,153 @@ class NitfLoop(object):
         lead_space = "  " * self.dim_size
         for f in self.field_list:
             if(isinstance(f, NitfLoop)):
-                f.print_to_fh(fh)
+                f.print_to_fh(fs, fh)
             elif(f.field_name is not None):
-                for k in self.keys():
+                f = fs._field_list[f._findex]
+                for k in self.keys(fs):
                     print(lead_space +
                           (f.field_name + self.key_to_str(k)).ljust(max_len) +
                           ": " + f.get_print(k), file=fh)
+
+class _FieldAttribute(object):
+    '''Attribute for a field of a FieldStruct class (e.g., tre.rsn),
+    added to the class by FieldStructSchema.add_attributes. This gives the
+    same value as FieldStruct.__getattr__ (the value for a scalar field,
+    the NitfField for a looped one), but is faster since we go directly
+    to the NitfField.
+
+    This isn't a data descriptor (there is no __set__), so like with
+    __getattr__ an attribute in the object's __dict__ takes priority.
+    Setting the field is handled by FieldStruct.__setattr__.'''
+    __slots__ = ("name", "findex", "schema", "scalar", "plain")
+    def __init__(self, name, fv, schema):
+        self.name = name
+        self.findex = fv._findex
+        self.schema = schema
+        self.scalar = (fv.loop.dim_size == 0)
+        # True if we can skip the index and condition checks in
+        # NitfField.__getitem__ and __setitem__
+        self.plain = (self.scalar and fv.condition is None and
+                      fv.value_func is None and
+                      type(fv).__getitem__ is NitfField.__getitem__ and
+                      type(fv).__setitem__ is NitfField.__setitem__)
+
+    def __get__(self, fs, cls=None):
+        if(fs is None):
+            return self
+        d = fs.__dict__
+        # Fall back to __getattr__ if the object doesn't use our schema
+        # (e.g., it has an explicit description) or has a delayed read
+        if(d.get("_field_schema") is not self.schema or d["_delayed_read"]):
+            return fs.__getattr__(self.name)
+        fv = d["_field_list"][self.findex]
+        if(not self.plain):
+            return fv[()] if self.scalar else fv
+        v = None
+        try:
+            v = fv.value_dict[()]
+            return fv._convert(v)
+        except Exception as e:
+            fv._getitem_error((), v, e)
+
+class FieldStructSchema(object):
+    '''The layout of a FieldStruct, built from its description. This
+    has the NitfLoop and NitfField objects, which don't depend on the
+    values in a particular FieldStruct object. We create this once
+    for each FieldStruct class, and then share it between all the
+    objects of that class.'''
+    def __init__(self, desc, fs_name):
+        self.desc = desc
+        field = OrderedDict()
+        # Note this also fills in field
+        self.pseudo_outer_loop = NitfLoop(None, desc, field)
+        # Flat list of all the NitfField, in file order.
+        self.field_list = list(self.pseudo_outer_loop.all_fields())
+        for i, fv in enumerate(self.field_list):
+            fv._findex = i
+            fv.fs_name = fs_name
+        self.field_names = list(field.keys())
+        self.field_index = [field[nm]._findex for nm in self.field_names]
+        # Fields that determine the layout, see NitfField._layout
+        loops = list(self.pseudo_outer_loop.all_loops())
+        expr = [str(lp._shape) for lp in loops]
+        for fv in self.field_list:
+            if(isinstance(fv._size, str)):
+                expr.append(fv._size)
+            if(fv.condition is not None):
+                expr.append(fv.condition)
+        names = self._depends_on(expr, field)[0]
+        self.layout_index = [field[nm]._findex for nm in self.field_names
+                             if nm in names]
+        for i in self.layout_index:
+            self.field_list[i]._layout = True
+        # Loop shapes we can cache, see NitfLoop.shape
+        for lp in loops:
+            names, complete = self._depends_on([str(lp._shape)], field)
+            lp._shape_cacheable = complete
+            for nm in names:
+                field[nm]._shape_dep = True
+        for lp in loops:
+            lp._keys_cacheable = all(p._shape_cacheable
+                                     for p in (*lp.parent_list[1:], lp))
+        # A value function can depend on any other field, so we don't
+        # know what changes the layout.
+        self.size_cacheable = all(fv.value_func is None
+                                  for fv in self.field_list)
+        # FieldStructCodeGen, filled in by FieldStruct._codegen
+        self.codegen = None
+
+    def add_attributes(self, cls):
+        '''Add a _FieldAttribute to the FieldStruct class cls for each
+        field. We skip names that are already attributes of the class
+        (e.g., a property with the same name as a field), these are
+        found before __getattr__ so they already take priority over the
+        field.'''
+        for nm, v in list(cls.__dict__.items()):
+            if(isinstance(v, _FieldAttribute)):
+                delattr(cls, nm)
+        for nm, i in zip(self.field_names, self.field_index):
+            v = None
+            for c in cls.__mro__:
+                if(nm in c.__dict__):
+                    v = c.__dict__[nm]
+                    break
+            if(v is None or isinstance(v, _FieldAttribute)):
+                setattr(cls, nm, _FieldAttribute(nm, self.field_list[i],
+                                                 self))
+
+    def _depends_on(self, expr, field):
+        '''Return the names of the fields that the value of the expressions
+        depend on. This includes the fields used in the conditions and
+        loop shapes of those fields, since these change the value we get.
+
+        We also return False if the expressions might depend on 
+        something else (e.g., a property or a value_func), so we don't
+        know all the fields they depend on.'''
+        res = set()
+        complete = True
+        todo = list(expr)
+        while(todo):
+            e = todo.pop()
+            if(re.search(r"\bf\b(?!\.)", e)):
+                complete = False
+            for nm in re.findall(r"\bf\.(\w+)", e):
+                if(nm in res):
+                    continue
+                fv = field.get(nm)
+                if(fv is None):
+                    complete = False
+                    continue
+                res.add(nm)
+                if(fv.value_func is not None):
+                    complete = False
+                if(fv.condition is not None):
+                    todo.append(fv.condition)
+                if(fv.loop.parent_list):
+                    todo.extend(str(p._shape) for p in
+                                (*fv.loop.parent_list[1:], fv.loop))
+        return res, complete
+
                 
 class FieldStruct(object):
     '''This class is used to handle NITF field structure (e.g., 
@@ -783,6 +1642,12 @@ class FieldStruct(object):
     a conditional isn't met). It isn't really clear what a slice means
     when some of the data might not be there, or when different indices
     have different dimensions.
+
+    For the common case of an int or float field in a rectangular loop
+    (e.g., polynomial coefficients or ephemeris vectors), you can instead
+    get the values as a numpy array with fs.foo.as_array(), and set them
+    with fs.foo.set_array(v). The values are then stored in the numpy array,
+    which is much faster for large loops than accessing each element.
     '''
     def __init__(self, description = None):
         '''If description is not passed in, we use self.desc. This is
@@ -802,42 +1667,152 @@ class FieldStruct(object):
         # We can do delayed reads, useful for data that we might never
         # actual use
         self._delayed_read = False
+
+        # Cached value for serialized_size
+        self._serialized_size = None
+
+        # Cached loop shapes and keys, see NitfLoop.shape. This gets
+        # cleared when a field a loop shape depends on is set, and is
+        # None if we can't cache these (see NitfField._array_exposed).
+        self._loop_cache = {}
         
-        # Note that as of python 3.7 the normal dict preserved insert
-        # order. However, we don't want to assume we are using that new
-        # of a version. So for now, we use a OrderedDict.
-        
-        self.field = OrderedDict()
         self._desc_init_none = True
         if(description is not None):
             self.desc = copy.deepcopy(description)
             self._desc_init_none = False
-        # Note this also fills in self.field
-        self.pseudo_outer_loop = NitfLoop(weakref.proxy(self), None, self.desc,
-                                          self.field)
+        schema = self._schema()
+        self.pseudo_outer_loop = schema.pseudo_outer_loop
+        # Flat list of all the NitfField for this object, in file
+        # order. This is what the generated read and write functions use.
+        fs = weakref.proxy(self)
+        self._field_list = [fv.bind(fs) for fv in schema.field_list]
+        # Note that as of python 3.7 the normal dict preserved insert
+        # order. However, we don't want to assume we are using that new
+        # of a version. So for now, we use a OrderedDict.
+        self.field = OrderedDict(zip(schema.field_names,
+                                     [self._field_list[i]
+                                      for i in schema.field_index]))
+        # Used by _FieldAttribute, to check that this object uses the
+        # schema of the class
+        self._field_schema = schema
+
+    def _schema(self):
+        '''Return the FieldStructSchema for this object.
+
+        This only depends on the description, so it is created once for a
+        class and cached there. If we were passed an explicit description
+        in the constructor we create a schema just for this object.'''
+        if(not self._desc_init_none):
+            return FieldStructSchema(self.desc, type(self).__name__)
+        cls = type(self)
+        res = cls.__dict__.get("_field_struct_schema")
+        # Check desc in case it gets changed after we create the schema
+        if(res is None or res.desc is not self.desc):
+            res = FieldStructSchema(self.desc, cls.__name__)
+            cls._field_struct_schema = res
+            res.add_attributes(cls)
+        return res
+
+    def _codegen(self):
+        '''Return the FieldStructCodeGen used to read and write this
+        object, or None if we should use the slower interpreted code.
 
-    def __deepcopy__(self, dict):
+        The generated code only depends on the description, so it is
+        created once for a class and cached in the FieldStructSchema. If we
+        were passed an explicit description in the constructor we just use
+        the interpreted code.'''
+        if(DEBUG or not self._desc_init_none):
+            return None
+        schema = self._schema()
+        if(schema.codegen is None):
+            from .nitf_field_codegen import FieldStructCodeGen
+            schema.codegen = FieldStructCodeGen(schema)
+        return schema.codegen
+
+    def _read_fields(self, fh, nitf_literal, lazy=False):
+        '''Read all the fields from the file handle fh'''
+        lazy = lazy and not nitf_literal
+        if(self._loop_cache):
+            self._loop_cache.clear()
+        if(lazy):
+            # Clear out any values from before, we get them from the
+            # raw bytes
+            for fv in self._field_list:
+                vd = fv.value_dict
+                if(type(vd) is _FieldValueDict and
+                   vd.raw is fv.raw_value_dict):
+                    vd.clear()
+                else:
+                    fv._set_lazy({})
+        g = self._codegen() if not nitf_literal else None
+        if(g is not None):
+            g.read_function(lazy, isinstance(fh, BufferReader))(self, fh)
+        else:
+            self.pseudo_outer_loop.read_from_file(self, fh, nitf_literal,
+                                                  lazy=lazy)
+        # Shapes found while reading might have used a field before it
+        # was read
+        if(self._loop_cache):
+            self._loop_cache.clear()
+
+    def __deepcopy__(self, memo):
         '''Generate a deepcopy. 
 
-        This implementation isn't particularly efficient, if we end
-        up doing this a lot we can try to do something more intelligent'''
+        If the only state is the field values (see _has_values_only) we
+        copy these directly, there is no need to write the object out and
+        read it back in.'''
+        if(not self._has_values_only()):
+            return self._copy_by_bytes()
+        res = self._new_empty()
+        res._copy_values(self)
+        return res
+
+    def _has_values_only(self):
+        '''Return True if the state of this object is just the values
+        of the fields, so we can copy and pickle those directly.
+
+        If a derived class overrides read_from_file or write_to_file
+        (e.g., to parse a field into other attributes), we assume it may
+        have other state and copy and pickle it by writing it out and
+        reading it back in.'''
+        cls = type(self)
+        return (cls.read_from_file in self._values_only_io and
+                cls.write_to_file in self._values_only_io)
+
+    def _new_empty(self):
+        '''Create a new object of the same type and description as this
+        one, with no values set.'''
         if(self._desc_init_none):
-            res = self.__class__()
-        else:
-            res = self.__class__(self.desc)
-        fh = io.BytesIO()
+            return self.__class__()
+        return self.__class__(self.desc)
+
+    def _copy_values(self, other):
+        '''Copy the field values from other, which should have the same
+        description as this object.'''
+        other._finish_delayed_read()
+        for fv, fv2 in zip(self._field_list, other._field_list):
+            fv._copy_values(fv2)
+
+    def _copy_by_bytes(self):
+        '''Generate a copy by writing this object out and reading it back
+        in. This is used by __deepcopy__ if we have other state that gets created as the object is read.'''
+        res = self._new_empty()
+        fh = BufferWriter()
         self.write_to_file(fh)
-        fh2 = io.BytesIO(fh.getvalue())
+        fh2 = BufferReader(fh.getvalue())
         res.read_from_file(fh2)
         return res
-        
-            
-    def __getattr__(self, nm):
-        if('_delayed_read' in self.__dict__ and self._delayed_read):
+
+    def _finish_delayed_read(self):
+        '''If we have a delayed read (see read_from_file), do the read
+        now.'''
+        if(self.__dict__.get("_delayed_read")):
             self._delayed_read = False
             self._fh.seek(self._start_pos)
-            self.pseudo_outer_loop.read_from_file(self._fh,
-                                                  self._nitf_literal)
+            self._read_fields(self._fh, self._nitf_literal, self._lazy)
+            
+    def __getattr__(self, nm):
+        self._finish_delayed_read()
         if("field" not in self.__dict__):
             raise AttributeError()
         fld = self.__dict__["field"]
@@ -854,6 +1829,18 @@ class FieldStruct(object):
         return fld[nm].get_raw_bytes(key)
     
     def __setattr__(self, nm, value):
+        a = type(self).__dict__.get(nm)
+        if(type(a) is _FieldAttribute and
+           self.__dict__.get("_field_schema") is a.schema):
+            # Fast path, see _FieldAttribute
+            fv = self.__dict__["_field_list"][a.findex]
+            if(not a.scalar):
+                raise RuntimeError("Need to supply index to %s" % nm)
+            if(a.plain):
+                fv._set((), value)
+            else:
+                fv[()] = value
+            return
         if("field" in self.__dict__ and nm in self.__dict__["field"]):
             t = self.field[nm]
             if(t.has_loop):
@@ -868,6 +1855,55 @@ class FieldStruct(object):
             if(f.field_name is not None):
                 yield f.field_name
 
+    def to_numpy(self, loop=None):
+        '''Return the fields of a loop as a numpy structured array, with
+        one column for each field directly in the loop (fields in a nested
+        loop get their own array). The loop is given by the name of
+        any field in it, e.g., tre.to_numpy("ephem_x"). If loop is None,
+        we return a dict going from the name of the first field of each
+        loop to its array.
+
+        There is one row for each index of the loop. For a nested loop the
+        rows go through all the indices (in the same order as
+        NitfField.values), and we add columns "i1", "i2", ... with the
+        indices of the outer loops.
+
+        int and float fields are stored as int64 and float64, and str as
+        a numpy string. A value that isn't present (an optional field, or
+        a conditional field where the condition isn't met) is NaN or ""
+        (an int field that might not be present uses float64, so it can
+        hold NaN). Anything else (e.g., bytes or FieldData) is stored as
+        an object.
+
+        This is much faster than going through items() or to_list() for
+        a large loop. Where we can, the values are converted directly from
+        the bytes we read.'''
+        self._finish_delayed_read()
+        if(loop is None):
+            res = {}
+            for lp in self.pseudo_outer_loop.all_loops():
+                nm = next((fv.field_name for fv in lp.field_list
+                           if(not isinstance(fv, NitfLoop) and
+                              fv.field_name is not None)), None)
+                if(nm is not None):
+                    res[nm] = self.to_numpy(nm)
+            return res
+        if(loop not in self.field or not self.field[loop].has_loop):
+            raise RuntimeError("%s isn't a field in a loop" % loop)
+        lp = self.field[loop].loop
+        keys = list(lp.keys(self))
+        cols = [("i%d" % (j+1), np.array([k[j] for k in keys],
+                                         dtype=np.int64))
+                for j in range(lp.dim_size - 1)]
+        for fv in lp.field_list:
+            if(not isinstance(fv, NitfLoop) and fv.field_name is not None):
+                cols.append((fv.field_name,
+                             self._field_list[fv._findex]._column(keys)))
+        res = np.empty((len(keys),), dtype=[(nm, c.dtype) for nm, c in cols])
+        for nm, c in cols:
+            res[nm] = c
+        return res
+
     def items(self, array_as_list = True):
         '''Return an iterator that gives returns tuples with the field name
         and value of that field. 
@@ -896,26 +1932,51 @@ class FieldStruct(object):
                     yield (f.field_name, getattr(self, f.field_name))
                 
     def __getstate__(self):
-        fh = io.BytesIO()
-        self.write_to_file(fh)
-        # We can't use decode here, because the byte data might not be
-        # utf-8 (although it is suppose to, NITF has all kinds of bizarre
-        # exceptions). Instead we convert this to the same expression
-        # python uses with printing this
-        return { "field_data" : str(fh.getvalue())}
+        '''We pickle just the values of the fields (see
+        NitfField._value_state), not the NitfField objects. If we have
+        other state (see _has_values_only), we instead pickle the bytes
+        from write_to_file.'''
+        if(not self._has_values_only()):
+            fh = BufferWriter()
+            self.write_to_file(fh)
+            return { "field_data" : fh.getvalue() }
+        self._finish_delayed_read()
+        res = { "field_values" : [fv._value_state()
+                                  for fv in self._field_list] }
+        if(not self._desc_init_none):
+            res["desc"] = self.desc
+        return res
 
     def __setstate__(self, d):
-        fh = io.BytesIO(eval(d["field_data"]))
-        self.__init__()
-        self.read_from_file(fh)
+        if("desc" in d):
+            self.__init__(d["desc"])
+        else:
+            self.__init__()
+        if("field_data" in d):
+            # Data written by write_to_file. Older versions saved this as the string representation of the bytes
+            t = d["field_data"]
+            if(isinstance(t, str)):
+                t = ast.literal_eval(t)
+            self.read_from_file(BufferReader(t))
+        else:
+            for fv, v in zip(self._field_list, d["field_values"]):
+                fv._set_value_state(v)
         
     def write_to_file(self, fh):
-        '''Write to a file stream.'''
-        self.pseudo_outer_loop.write_to_file(fh)
+        '''Write to a file stream. This can also be a BufferWriter, which
+        is faster if we are writing to memory.'''
+        g = self._codegen()
+        if(g is not None):
+            g.write_function(isinstance(fh, BufferWriter) and
+                             fh.pos == len(fh.data))(self, fh)
+        else:
+            self.pseudo_outer_loop.write_to_file(self, fh)
 
-    def read_from_file(self, fh, nitf_literal=False, delayed_read=False):
+    def read_from_file(self, fh, nitf_literal=False, delayed_read=False,
+                       lazy=False):
         '''
-        Read from a file stream.
+        Read from a file stream. This can also be a BufferReader, which
+        is faster if we already have the data in memory.
 
         nitf_literal set to True is to handle odd formatting rules,
         where we want to read the values from a file as a string and
@@ -923,15 +1984,77 @@ class FieldStruct(object):
         NitfLiteral objects. Normally you don't want this option, but
         it can be useful for cases hard to capture otherwise (e.g.,
         heritage systems that depend on specific formatting).
+
+        lazy set to True only saves the raw bytes for each field, and
+        converts a field to its value the first time it is accessed. The
+        fields needed to find the layout (e.g., loop counts, conditions)
+        get converted as we read, but other fields are only converted
+        if we use them. This is faster and uses less memory if only a few
+        fields are looked at (e.g., reading a summary of a lot of files).
+        Note that this means that an error parsing a field is only
+        reported when the field is accessed.
         '''
+        self._serialized_size = None
         if(delayed_read):
             self._delayed_read = True
             self._fh = fh
             self._start_pos = fh.tell()
             self._nitf_literal = nitf_literal
+            self._lazy = lazy
         else:
-            self.pseudo_outer_loop.read_from_file(fh, nitf_literal)
+            self._read_fields(fh, nitf_literal, lazy)
             
+    def serialized_size(self):
+        '''Return the number of bytes for the fields (what
+        FieldStruct.write_to_file writes), without formatting any of the
+        values. This just adds up the field sizes from the description,
+        loop sizes, and conditions. Note that a derived class may write
+        more than this, e.g., a Tre also writes the tag and length (see
+        Tre.cel_value).
+
+        This is cached, and only recalculated when a field that changes
+        the layout (e.g., a loop count) is set.
+
+        If a derived class overrides write_to_file (see _has_values_only),
+        we can't get the size from the description. In that case we
+        write the object to memory and return the size of that.'''
+        self._finish_delayed_read()
+        if(type(self).write_to_file not in self._values_only_io):
+            fh = BufferWriter()
+            self.write_to_file(fh)
+            return len(fh.data)
+        res = self._serialized_size
+        if(res is not None):
+            return res
+        g = self._codegen()
+        if(g is not None):
+            res = g.size_function()(self)
+        else:
+            res = self.pseudo_outer_loop.serialized_size(self)
+        if(not self._desc_init_none):
+            return res
+        schema = self._schema()
+        # A layout field stored in a numpy array (see NitfField.as_array)
+        # can be changed without us knowing, so don't cache in that case
+        if(schema.size_cacheable and
+           not any(isinstance(self._field_list[i].value_dict,
+                              _ArrayValueDict)
+                   for i in schema.layout_index)):
+            self._serialized_size = res
+        return res
+
+    def modified_fields(self):
+        '''Return the names of the fields that have been set since the
+        FieldStruct was read (or the fields that have been set at all,
+        if it wasn't read). 
+
+        The other fields get written out with exactly the bytes that were
+        read (see NitfField.bytes), so an unmodified FieldStruct is
+        written back out byte for byte.'''
+        self._finish_delayed_read()
+        return [fv.field_name for fv in self._field_list
+                if fv.field_name is not None and fv._modified()]
+        
     def update_field(self, fh, field_name, value, key = ()):
         '''Update a field name in an open file'''
         fv = self.field[field_name]
@@ -942,13 +2065,18 @@ class FieldStruct(object):
         '''Text description of structure, e.g., something you can print
         out.'''
         res = io.StringIO()
-        self.pseudo_outer_loop.print_to_fh(res)
+        self.pseudo_outer_loop.print_to_fh(self, res)
         return res.getvalue()
 
     def summary(self):
         return "FieldStruct with %d fields" % len(self.field)
                 
 
+# The versions of read_from_file and write_to_file that just handle the
+# field values, see FieldStruct._has_values_only. Tre adds its versions.
+FieldStruct._values_only_io = {FieldStruct.read_from_file,
+                               FieldStruct.write_to_file}
+
 logger = logging.getLogger('nitf_diff')
 class FieldStructDiff(NitfDiffHandle):
     '''Base class for comparing the various NITF Field Structure objects
@@ -972,6 +2100,9 @@ class FieldStructDiff(NitfDiffHandle):
                         tolerance. Only used for fields with float type.
     abs_tol           - a dictionary going from field name to absolute
                         tolerance. Only used for fields with float type.
+    max_detail        - the maximum number of element differences to list
+                        for an array/loop field (default 10). The number
+                        of elements that are different is always reported.
 
     If a function isn't otherwise defined in eq_fun, we use operator.eq, 
     except for floating point numbers. For floating point numbers we use
@@ -979,7 +2110,9 @@ class FieldStructDiff(NitfDiffHandle):
     values are used for math.isclose if not supplied (so 1e-9 and 0.0).
     
     For array/loop fields we compare the shape, and if the same we compare
-    each element in the array.
+    each element in the array. For int and float fields without an eq_fun
+    this is done with numpy on the whole array at once, which is much
+    faster for large arrays.
     '''
     def configuration(self, nitf_diff):
         '''Derived class should extract out the appropriate configuration
@@ -1019,20 +2152,67 @@ class FieldStructDiff(NitfDiffHandle):
             def_eq_fun = operator.eq
         return eq_fun.get(fn1, def_eq_fun)
 
-    def _cmp_nitf_field(self, fn1, v1, v2, cmp_func, rep_diff):
+    def _cmp_array(self, fn1, v1, v2, keys, c):
+        '''Compare the values of the fields v1 and v2 for all the keys
+        using numpy. This returns an array that is True where the values
+        are the same, or None if we can't do this (e.g., the field has an
+        eq_fun, or might not be present).
+
+        This gives the same results as the function from _cmp_func.'''
+        if(fn1 in c.get('eq_fun', {})):
+            return None
+        for v in (v1, v2):
+            if(v.ty not in (int, float) or isinstance(v, FieldData) or
+               v.optional or v.condition is not None or
+               v.value_func is not None):
+                return None
+        try:
+            a1 = v1._column(keys)
+            a2 = v2._column(keys)
+        except (OverflowError, TypeError):
+            # E.g., an int too large for int64
+            return None
+        if(v1.ty != float):
+            return a1 == a2
+        rel_tol = c.get('rel_tol', {}).get(fn1, 1e-9)
+        abs_tol = c.get('abs_tol', {}).get(fn1, 0.0)
+        # Same test as math.isclose
+        with np.errstate(invalid="ignore", over="ignore"):
+            tol = np.maximum(rel_tol * np.maximum(np.abs(a1), np.abs(a2)),
+                             abs_tol)
+            return ((a1 == a2) |
+                    (np.isfinite(a1) & np.isfinite(a2) &
+                     (np.abs(a1 - a2) <= tol)))
+
+    def _cmp_nitf_field(self, fn1, v1, v2, cmp_func, rep_diff, c=None):
         '''Compare a field, which is like an array'''
         if(not NitfField.is_shape_equal(v1, v2)):
             rep_diff("%s: array shapes are different", fn1)
             return
-        diff_count = 0
-        total_count = 0
-        for (ind, av1), av2 in itertools.zip_longest(v1.items(), v2.values()):
-            total_count += 1
-            if(not np.all(cmp_func(av1, av2))):
-                ind_str = ", ".join(str(i) for i in ind)
-                logger.difference_detail("%s[%s]: %s != %s", fn1, ind_str,
-                                         av1, av2)
-                diff_count += 1
+        c = c if c is not None else {}
+        max_detail = c.get('max_detail', 10)
+        keys = list(v1.loop.keys(v1.fs))
+        total_count = len(keys)
+        same = self._cmp_array(fn1, v1, v2, keys, c)
+        if(same is not None):
+            diff = [(keys[i], v1[keys[i]], v2[keys[i]])
+                    for i in np.flatnonzero(~same)[:max_detail]]
+            diff_count = int(np.count_nonzero(~same))
+        else:
+            diff = []
+            diff_count = 0
+            for ind, av1, av2 in zip(keys, v1.values(), v2.values()):
+                if(not np.all(cmp_func(av1, av2))):
+                    if(diff_count < max_detail):
+                        diff.append((ind, av1, av2))
+                    diff_count += 1
+        for ind, av1, av2 in diff:
+            ind_str = ", ".join(str(i) for i in ind)
+            logger.difference_detail("%s[%s]: %s != %s", fn1, ind_str,
+                                     av1, av2)
+        if(diff_count > len(diff)):
+            logger.difference_detail("%s: %d more differences not listed",
+                                     fn1, diff_count - len(diff))
         if(diff_count > 0):
             rep_diff("%s: array had %d of %d different", fn1, diff_count,
                      total_count)
@@ -1060,7 +2240,7 @@ class FieldStructDiff(NitfDiffHandle):
                 rep_diff = self._is_diff
             cmp_func = self._cmp_func(fn1, v1, c)
             if(isinstance(v1, NitfField)):
-                self._cmp_nitf_field(fn1, v1, v2, cmp_func, rep_diff)
+                self._cmp_nitf_field(fn1, v1, v2, cmp_func, rep_diff, c)
             elif not cmp_func(v1, v2):
                 rep_diff("%s: %s != %s", fn1, v1, v2)
         return self.is_same
@@ -1068,4 +2248,6 @@ class FieldStructDiff(NitfDiffHandle):
     
 __all__ = ["FieldStruct", "NitfField", "FieldData", "BytesFieldData",
            "StringFieldData", "FloatFieldData", "IntFieldData",
-           "FieldStructDiff", "float_to_fixed_width", "NitfLiteral"]
+           "FieldStructDiff", "float_to_fixed_width",
+           "float_to_fixed_width_array", "NitfLiteral",
+           "BufferReader", "BufferWriter"]
@@ -0,0 +1,671 @@
+# This generates specialized python code for reading and writing a
+# FieldStruct. The normal NitfLoop/NitfField code interprets the
+# description for every field (checking the type, loop structure,
+# conditions, etc.). For structures we read and write a lot (file
+# headers, subheaders, TREs) it is noticeably faster to instead generate
+# one function per class that has all of this worked out ahead of time.
+#
+# Loops that just contain fixed width int and float fields (e.g.,
+# ephemeris vectors, polynomial coefficients) are handled all at once by
+# _ArrayLoop, which converts the whole loop with numpy.
+#
+# Runs of fixed width fields without conditions (e.g., the security
+# fields in the file header and subheaders) are read with a single read,
+# and each field is pulled out at a precomputed offset. Likewise they
+# get written with a single write.
+#
+# The generated code should behave exactly the same as the interpreted
+# code in NitfLoop.read_from_file and NitfLoop.write_to_file. If you are
+# diagnosing a problem, you can look at read_source and write_source
+# of the FieldStructCodeGen for a class, or set nitf_field.DEBUG to True
+# which turns off the generated code.
+
+from .nitf_field import (NitfField, NitfLoop, _text_codec, _ArrayValueDict,
+                         _ArrayRawDict, float_to_fixed_width_array)
+import itertools
+import io
+import numpy as np
+
+_index_names = ("i1", "i2", "i3", "i4")
+
+def _short_read(sz, field_name):
+    raise RuntimeError("Not enough bytes left to read %d bytes for field %s" %
+                       (sz, field_name))
+
+def _short_run(t, run):
+    '''Report the same error we would get reading the fields of a
+    fixed width run one at a time.'''
+    for start, sz, field_name in run:
+        if(start + sz > len(t)):
+            _short_read(sz, field_name)
+
+def _nonempty(v, field_name):
+    if(v == b''):
+        raise RuntimeError("Empty string read for field %s" % field_name)
+    return v
+
+def _parse_error(field_name, t, e):
+    raise Exception("Exception while parsing ", field_name, " from ",
+                    t.rstrip(), "underlying error: ", e)
+
+class FieldStructCodeGen(object):
+    '''This generates a read and write function for a FieldStruct. The
+    functions are generated from the FieldStructSchema, so we generate
+    this once for each FieldStruct class and then use it for all the
+    objects of that class.
+
+    The generated functions take the FieldStruct and a file handle,
+    e.g., self.read_func(fs, fh) and self.write_func(fs, fh). There
+    are also variations of the read function for a lazy read, and
+    reading from a BufferReader (see read_function), and of the write
+    function for writing to a BufferWriter (see write_function), and a
+    function returning the size that would be written without
+    formatting anything (see size_function).'''
+    def __init__(self, schema):
+        # Names available in the generated code. We add compiled
+        # expressions, types, etc. to this as we generate the code.
+        self.ns = {"_text_codec" : _text_codec,
+                   "_short_read" : _short_read,
+                   "_short_run" : _short_run,
+                   "_nonempty" : _nonempty,
+                   "_parse_error" : _parse_error}
+        self.schema = schema
+        self.lazy = False
+        self.buffer = False
+        self.read_source = self._source("_read", schema.pseudo_outer_loop,
+                                        "read")
+        self.write_source = self._source("_write", schema.pseudo_outer_loop,
+                                         "write")
+        self.read_func = self._compile("_read", self.read_source)
+        self.write_func = self._compile("_write", self.write_source)
+        # The other variations of the read function, generated when
+        # they are first needed. This is indexed by (lazy, buffer).
+        self.read_variant_source = {(False, False) : self.read_source}
+        self.read_variant_func = {(False, False) : self.read_func}
+        self.write_buffer_source = None
+        self.write_buffer_func = None
+        self.size_source = None
+        self.size_func = None
+
+    def read_function(self, lazy=False, buffer=False):
+        '''Return the read function to use. If lazy is True, this only
+        saves the raw bytes of each field (see
+        FieldStruct.read_from_file). If buffer is True, this reads from a
+        BufferReader, slicing the data directly rather than calling read
+        for each field.'''
+        k = (lazy, buffer)
+        func = self.read_variant_func.get(k)
+        if(func is None):
+            fname = "_read" + ("_lazy" if lazy else "") + \
+                ("_buffer" if buffer else "")
+            self.lazy, self.buffer = k
+            try:
+                src = self._source(fname, self.schema.pseudo_outer_loop,
+                                   "read")
+            finally:
+                self.lazy = self.buffer = False
+            func = self._compile(fname, src)
+            self.read_variant_source[k] = src
+            self.read_variant_func[k] = func
+        return func
+
+    def write_function(self, buffer=False):
+        '''Return the write function to use. If buffer is True, this
+        writes to a BufferWriter, which must be positioned at the end of
+        its data. We then append directly to the data, and calculate the
+        file locations from the length of the data rather than calling
+        tell.'''
+        if(not buffer):
+            return self.write_func
+        if(self.write_buffer_func is None):
+            self.buffer = True
+            try:
+                src = self._source("_write_buffer",
+                                   self.schema.pseudo_outer_loop, "write")
+            finally:
+                self.buffer = False
+            self.write_buffer_func = self._compile("_write_buffer", src)
+            self.write_buffer_source = src
+        return self.write_buffer_func
+
+    def size_function(self):
+        '''Return the function giving the number of bytes the write
+        function writes, see FieldStruct.serialized_size. This just 
+        takes the FieldStruct, e.g., self.size_function()(fs).'''
+        if(self.size_func is None):
+            self.size_source = self._source("_size",
+                                            self.schema.pseudo_outer_loop,
+                                            "size")
+            self.size_func = self._compile("_size", self.size_source)
+        return self.size_func
+    
+    def _const(self, v):
+        '''Add a value to the namespace of the generated code, returning the
+        name to use for it.'''
+        nm = "_c%d" % len(self.ns)
+        self.ns[nm] = v
+        return nm
+
+    def _compile(self, fname, src):
+        exec(compile(src, "<FieldStructCodeGen %s>" % fname, "exec"), self.ns)
+        return self.ns[fname]
+
+    def _source(self, fname, loop, mode):
+        '''Generate the source for a function. The mode is "read",
+        "write", or "size", which selects the _read_xxx, _write_xxx or
+        _size_xxx functions we use to generate the code.'''
+        # The header lines get filled in as we find the fields we use
+        self.header = []
+        self.header_done = set()
+        self.field_func = getattr(self, "_%s_field" % mode)
+        self.run_func = getattr(self, "_%s_run" % mode)
+        self.fixed_func = getattr(self, "_fixed_%s" % mode)
+        self.mode = mode
+        body = []
+        self._loop(loop, body, 1, 0)
+        if(mode == "size"):
+            lines = ["def %s(f):" % fname,
+                     "    fvs = f._field_list",
+                     "    res = 0"]
+            lines.extend(self.header)
+            lines.extend(body)
+            lines.append("    return res")
+            return "\n".join(lines) + "\n"
+        lines = ["def %s(f, fh):" % fname,
+                 "    fvs = f._field_list"]
+        if(mode == "write" and self.buffer):
+            # We append to data, see _fh_call and _tell
+            lines.extend(["    data = fh.data",
+                          "    write = data.extend",
+                          "    base = fh.offset"])
+        elif(mode == "write"):
+            lines.extend(["    write = fh.write",
+                          "    tell = fh.tell"])
+        elif(self.buffer):
+            # We keep the position in p while reading, see _fh_call
+            lines.extend(["    data = fh.data",
+                          "    p = fh.pos"])
+        else:
+            lines.append("    read = fh.read")
+        lines.extend(self.header)
+        lines.extend(body)
+        if(mode == "read" and self.buffer):
+            lines.append("    fh.pos = p")
+        elif(self.buffer):
+            lines.append("    fh.pos = len(data)")
+        lines.append("    return")
+        return "\n".join(lines) + "\n"
+
+    def _use_field(self, fv, dict_names=()):
+        '''Make the NitfField available in the generated code as fv<i>,
+        along with any of its dicts we need (e.g., ("val", "value_dict")
+        makes fv.value_dict available as val<i>). Returns the index i.'''
+        i = fv._findex
+        if(i not in self.header_done):
+            self.header_done.add(i)
+            self.header.append("    fv%d = fvs[%d]" % (i, i))
+            for prefix, attr in dict_names:
+                self.header.append("    %s%d = fv%d.%s" % (prefix, i, i, attr))
+        return i
+
+    def _fh_call(self, lines, sp, call):
+        '''Add a call to a function that reads from fh. When reading a
+        buffer, we need to update the position of fh before the call
+        and get the new position after.'''
+        if(self.mode == "read" and self.buffer):
+            lines.append("%sfh.pos = p" % sp)
+            lines.append(sp + call)
+            lines.append("%sp = fh.pos" % sp)
+        elif(self.buffer):
+            # Function writes to the end of data using fh.write
+            lines.append("%sfh.pos = len(data)" % sp)
+            lines.append(sp + call)
+        else:
+            lines.append(sp + call)
+
+    def _tell(self):
+        '''Expression for the current file location when writing.'''
+        if(self.buffer):
+            return "base + len(data)"
+        return "tell()"
+
+    def _loop(self, loop, lines, indent, depth):
+        sp = "    " * indent
+        if(loop._shape_func is not None):
+            idx = _index_names[depth-1]
+            args = ", ".join(("f",) + _index_names[:depth-1])
+            lines.append("%sn%d = %s(%s)" % (sp, depth,
+                                             self._const(loop._shape_func),
+                                             args))
+            aloop = _ArrayLoop.create(loop)
+            if(aloop is not None and self.mode == "size"):
+                lines.append("%sres += %d * max(0 if n%d is None else n%d, 0)"
+                             % (sp, aloop.row_size, depth, depth))
+                return
+            if(aloop is not None):
+                # Handle the whole loop at once, see _ArrayLoop
+                self._fh_call(lines, sp,
+                              "%s.%s(f, fh, 0 if n%d is None else n%d)" %
+                              (self._const(aloop),
+                               "lazy_read" if self.lazy else self.mode,
+                               depth, depth))
+                return
+            lines.append("%sfor %s in range(0 if n%d is None else n%d):" %
+                         (sp, idx, depth, depth))
+            indent += 1
+        key = "(" + "".join("%s, " % i for i in _index_names[:depth]) + ")"
+        # Collect runs of fixed width fields, which we handle all at once
+        run = []
+        for fv in loop.field_list + [None]:
+            if(fv is not None and not isinstance(fv, NitfLoop) and
+               self.fixed_func(fv)):
+                run.append(fv)
+                continue
+            if(len(run) == 1):
+                self.field_func(run[0], lines, indent, depth, key)
+            elif(len(run) > 1):
+                self.run_func(run, lines, indent, depth, key)
+            run = []
+            if(fv is None):
+                break
+            if(isinstance(fv, NitfLoop)):
+                self._loop(fv, lines, indent, depth + 1)
+            else:
+                self.field_func(fv, lines, indent, depth, key)
+        if(len(loop.field_list) == 0):
+            lines.append("    " * indent + "pass")
+
+    def _condition(self, fv, lines, indent, depth):
+        '''Add the condition check if needed, returning the new indent'''
+        if(fv._condition_func is None):
+            return indent
+        args = ", ".join(("f",) + _index_names[:depth])
+        lines.append("%sif %s(%s):" % ("    " * indent,
+                                      self._const(fv._condition_func), args))
+        return indent + 1
+
+    def _size(self, fv, depth):
+        if(fv._size_func is None):
+            sz = fv._size
+            if(sz != 0):
+                sz -= fv.size_offset
+            return "%d" % sz
+        args = ", ".join(("f",) + _index_names[:depth])
+        if(fv.size_offset == 0):
+            return "%s(%s)" % (self._const(fv._size_func), args)
+        return "%s(%s, %d)" % (self._const(_size_with_offset),
+                               self._const(fv._size_func) + "(%s)" % args,
+                               fv.size_offset)
+
+    def _decode(self, fv):
+        '''Expression to convert bytes t to the value for field fv'''
+        if(fv.ty == str):
+            res = 't.rstrip().decode(_text_codec, "replace")'
+        elif(fv.ty == bytes):
+            res = "t"
+        else:
+            ty = fv.ty.__name__ if fv.ty in (int, float) else self._const(fv.ty)
+            res = "%s(_nonempty(t.rstrip(), %r))" % (ty, fv.field_name)
+        if(fv.optional):
+            res = "(None if t.rstrip(%r) == b'' else %s)" % \
+                (fv.optional_char.encode(_text_codec) + b' ', res)
+        return res
+
+    def _fixed_read(self, fv):
+        '''True if fv can be read as part of a fixed width run'''
+        return (type(fv).read_from_file is NitfField.read_from_file and
+                fv._size_func is None and fv._condition_func is None)
+
+    def _fixed_write(self, fv):
+        '''True if fv can be written as part of a fixed width run'''
+        return (type(fv).write_to_file is NitfField.write_to_file and
+                fv._size_func is None and fv._condition_func is None)
+
+    def _store(self, fv, lines, sp, key):
+        '''Store the value read into bytes t'''
+        if(self.lazy or fv.field_name is None):
+            # For a reserved field we just save the raw bytes, so we can
+            # write them back out unchanged
+            # Value gets converted when accessed, see _FieldValueDict
+            i = self._use_field(fv, (("raw", "raw_value_dict"),))
+            lines.append("%sraw%d[%s] = t" % (sp, i, key))
+            return
+        i = self._use_field(fv, (("val", "value_dict"),
+                                 ("raw", "raw_value_dict")))
+        lines.append("%stry:" % sp)
+        lines.append("%s    raw%d[%s] = t" % (sp, i, key))
+        lines.append("%s    val%d[%s] = %s" % (sp, i, key,
+                                                self._decode(fv)))
+        lines.append("%sexcept Exception as e:" % sp)
+        lines.append("%s    _parse_error(%r, t, e)" % (sp, fv.field_name))
+
+    def _read_field(self, fv, lines, indent, depth, key):
+        if(type(fv).read_from_file is not NitfField.read_from_file):
+            # Derived class has its own reading, so just call that
+            i = self._use_field(fv)
+            self._fh_call(lines, "    " * indent,
+                          "fv%d.read_from_file(fh, False, %s)" % (i, key))
+            return
+        indent = self._condition(fv, lines, indent, depth)
+        sp = "    " * indent
+        lines.append("%ssz = %s" % (sp, self._size(fv, depth)))
+        if(self.buffer):
+            lines.append("%st = data[p:p + sz]" % sp)
+        else:
+            lines.append("%st = read(sz)" % sp)
+        lines.append("%sif len(t) != sz: _short_read(sz, %r)" %
+                     (sp, fv.field_name))
+        if(self.buffer):
+            lines.append("%sp += sz" % sp)
+        self._store(fv, lines, sp, key)
+
+    def _read_run(self, run, lines, indent, depth, key):
+        '''Read a run of fixed width fields with a single read, and then
+        pull each field out of the bytes at its precomputed offset.'''
+        sp = "    " * indent
+        layout = []
+        start = 0
+        for fv in run:
+            sz = int(self._size(fv, depth))
+            layout.append((start, sz, fv.field_name))
+            start += sz
+        if(self.buffer):
+            # Slice each field directly out of the data
+            lines.append("%sif len(data) - p < %d: _short_run(data[p:p + %d], %s)" %
+                         (sp, start, start, self._const(tuple(layout))))
+            tr = "data"
+            off = "p + "
+        else:
+            lines.append("%str = read(%d)" % (sp, start))
+            lines.append("%sif len(tr) != %d: _short_run(tr, %s)" %
+                         (sp, start, self._const(tuple(layout))))
+            tr = "tr"
+            off = ""
+        total = start
+        for fv, (start, sz, field_name) in zip(run, layout):
+            lines.append("%st = %s[%s%d:%s%d]" % (sp, tr, off, start, off,
+                                                 start + sz))
+            self._store(fv, lines, sp, key)
+        if(self.buffer):
+            lines.append("%sp += %d" % (sp, total))
+
+    def _write_expr(self, fv, depth, key, sz=None):
+        '''Expression giving the bytes to write for fv. Returns the
+        expression and the index of the field if we need to record
+        its location in the file (or None).
+
+        Like NitfField.bytes, we use the raw bytes we read if the value
+        hasn't been set since then. For a field that isn't fixed size,
+        sz is the name of the variable holding the size, since the raw
+        bytes are only used if they are the right size.'''
+        if(fv.field_name is None and type(fv) is NitfField and
+           fv.ty == str and fv.frmt is None and fv.default is None and
+           not fv.optional and fv._size_func is None):
+            # Reserved field, which is just filled with spaces if we
+            # didn't read it
+            i = self._use_field(fv, (("raw", "raw_value_dict"),))
+            return ("(raw%d[%s] if %s in raw%d else %r)" %
+                    (i, key, key, i, b' ' * int(self._size(fv, depth))),
+                    None)
+        if(fv.field_name is None or fv.value_func is not None or
+           type(fv).bytes is not NitfField.bytes):
+            i = self._use_field(fv, (("loc", "fh_loc"),))
+            return ("fv%d.bytes(%s)" % (i, key),
+                    i if fv.field_name is not None else None)
+        i = self._use_field(fv, (("loc", "fh_loc"), ("val", "value_dict"),
+                                 ("raw", "raw_value_dict"),
+                                 ("enc", "_encode")))
+        if(sz is None):
+            sz = self._size(fv, depth)
+            passthrough = "%s in raw%d" % (key, i)
+        else:
+            passthrough = "%s in raw%d and len(raw%d[%s]) == %s" % \
+                (key, i, i, key, sz)
+        return ("(raw%d[%s] if %s else enc%d(val%d[%s], %s, %s, True))" %
+                (i, key, passthrough, i, i, key, sz, key), i)
+
+    def _write_field(self, fv, lines, indent, depth, key):
+        if(type(fv).write_to_file is not NitfField.write_to_file):
+            i = self._use_field(fv)
+            self._fh_call(lines, "    " * indent,
+                          "fv%d.write_to_file(fh, %s)" % (i, key))
+            return
+        indent = self._condition(fv, lines, indent, depth)
+        sp = "    " * indent
+        if(fv._size_func is None):
+            expr, i = self._write_expr(fv, depth, key)
+        else:
+            lines.append("%ssz = %s" % (sp, self._size(fv, depth)))
+            expr, i = self._write_expr(fv, depth, key, "sz")
+        if(i is not None):
+            lines.append("%sloc%d[%s] = %s" % (sp, i, key, self._tell()))
+        lines.append("%swrite(%s)" % (sp, expr))
+
+    def _write_run(self, run, lines, indent, depth, key):
+        '''Write a run of fixed width fields with a single write. The
+        file locations are at precomputed offsets from the start.'''
+        sp = "    " * indent
+        lines.append("%sp = %s" % (sp, self._tell()))
+        exprs = []
+        start = 0
+        for fv in run:
+            expr, i = self._write_expr(fv, depth, key)
+            if(i is not None):
+                lines.append("%sloc%d[%s] = p + %d" % (sp, i, key, start))
+            exprs.append(expr)
+            start += int(self._size(fv, depth))
+        lines.append("%swrite(b\"\".join((%s,)))" % (sp, ", ".join(exprs)))
+
+    def _fixed_size(self, fv):
+        '''True if fv is always the same size'''
+        return (type(fv).write_to_file is NitfField.write_to_file and
+                fv._size_func is None and fv._condition_func is None)
+
+    def _size_field(self, fv, lines, indent, depth, key):
+        if(type(fv).write_to_file is not NitfField.write_to_file):
+            i = self._use_field(fv)
+            lines.append("%sres += fv%d.serialized_size(%s)" %
+                         ("    " * indent, i, key))
+            return
+        indent = self._condition(fv, lines, indent, depth)
+        lines.append("%sres += %s" % ("    " * indent,
+                                      self._size(fv, depth)))
+
+    def _size_run(self, run, lines, indent, depth, key):
+        lines.append("%sres += %d" % ("    " * indent,
+                                      sum(int(self._size(fv, depth))
+                                          for fv in run)))
+
+class _ArrayLoop(object):
+    '''This handles a 1d loop that only has fixed width int and float
+    fields. Rather than going through each field for each index, we
+    read all the data for the loop and then convert each field with
+    numpy. The values are stored in _ArrayValueDict, so we can use the
+    data directly as a numpy array (see NitfField.as_array).
+
+    Likewise we format each field for the whole loop in one pass, and
+    do a single write.
+
+    If anything unusual happens (e.g., a value can't be parsed) we fall
+    back to handling each field one at a time, so we give exactly the
+    same results and errors as the normal code.'''
+    def __init__(self, loop):
+        self.findex = [fv._findex for fv in loop.field_list]
+        self.field_size = [fv._size - fv.size_offset
+                           for fv in loop.field_list]
+        self.offset = list(itertools.accumulate([0] + self.field_size[:-1]))
+        self.row_size = sum(self.field_size)
+        self.read_dtype = np.dtype({"names" : ["f%d" % i for i in
+                                               range(len(self.findex))],
+                                    "formats" : ["S%d" % sz for sz in
+                                                 self.field_size],
+                                    "offsets" : self.offset,
+                                    "itemsize" : self.row_size})
+
+    @classmethod
+    def create(cls, loop):
+        '''Return a _ArrayLoop if we can use one for the given loop,
+        or None otherwise.'''
+        if(loop.dim_size != 1 or len(loop.field_list) == 0):
+            return None
+        for fv in loop.field_list:
+            if(isinstance(fv, NitfLoop) or type(fv) is not NitfField or
+               fv.field_name is None or fv.ty not in (int, float) or
+               fv._size_func is not None or fv._condition_func is not None or
+               fv.optional or fv.value_func is not None or
+               fv._size - fv.size_offset <= 0):
+                return None
+        return cls(loop)
+
+    def read(self, f, fh, n):
+        fvs = f._field_list
+        # Negative loop sizes are treated as 0, like range does
+        n = max(n, 0)
+        sz = n * self.row_size
+        t = fh.read(sz)
+        # Note that numpy strips trailing nulls, so we let the normal
+        # code handle those
+        if(len(t) == sz and b'\0' not in t):
+            try:
+                d = np.frombuffer(t, dtype=self.read_dtype, count=n)
+                vals = [d["f%d" % j].astype(np.int64 if fvs[i].ty == int
+                                            else np.float64)
+                        for j, i in enumerate(self.findex)]
+            except (ValueError, OverflowError, TypeError):
+                vals = None
+            if(vals is not None):
+                for i, v, off, fsz in zip(self.findex, vals, self.offset,
+                                          self.field_size):
+                    fv = fvs[i]
+                    fv.value_dict = _ArrayValueDict(v, fv._default_value)
+                    fv.raw_value_dict = _ArrayRawDict(t, off, self.row_size,
+                                                      fsz, n)
+                return
+        fh2 = io.BytesIO(t)
+        for k in range(n):
+            for i in self.findex:
+                fvs[i].read_from_file(fh2, False, (k,))
+
+    def lazy_read(self, f, fh, n):
+        '''Like read, but just save the raw bytes for the loop and
+        convert the values when they are accessed.'''
+        fvs = f._field_list
+        n = max(n, 0)
+        sz = n * self.row_size
+        t = fh.read(sz)
+        if(len(t) != sz):
+            # Let the normal code report the error
+            fh2 = io.BytesIO(t)
+            for k in range(n):
+                for i in self.findex:
+                    fvs[i].read_from_file(fh2, False, (k,), True)
+            return
+        for i, off, fsz in zip(self.findex, self.offset, self.field_size):
+            fvs[i]._set_lazy(_ArrayRawDict(t, off, self.row_size, fsz, n))
+
+    def _raw(self, fv, off):
+        '''Return the _ArrayRawDict for fv if it holds the bytes read
+        for this loop, or None otherwise.'''
+        raw = fv.raw_value_dict
+        if(isinstance(raw, _ArrayRawDict) and raw.offset == off and
+           raw.stride == self.row_size and
+           len(raw.data) == raw.n * raw.stride):
+            return raw
+        return None
+
+    def _values(self, fv, n):
+        '''Return the values for fv as a list, or None if we can't handle
+        this.'''
+        vd = fv.value_dict
+        if(isinstance(vd, _ArrayValueDict) and not vd.extra and
+           vd.array.shape == (n,)):
+            return vd.array.tolist()
+        res = [vd[(k,)] for k in range(n)]
+        for v in res:
+            if(not isinstance(v, (int, float, np.number))):
+                return None
+        return [fv.ty(v) for v in res]
+
+    def _format(self, fv, sz, vals):
+        '''Format the values, the same way NitfField._format_val does.'''
+        frmt = fv.frmt
+        if(frmt is None):
+            if(fv.ty == int):
+                frmt = "%%0%dd" % sz
+                return [frmt % v for v in vals]
+            return [v.ljust(sz) for v in float_to_fixed_width_array(vals, sz)]
+        if(isinstance(frmt, str)):
+            res = [frmt % v for v in vals]
+        else:
+            res = [frmt(v) for v in vals]
+        if(fv.ty != int):
+            res = [v.ljust(sz) for v in res]
+        return res
+        
+    def write(self, f, fh, n):
+        fvs = f._field_list
+        n = max(n, 0)
+        # If none of the fields have been set since we read the loop,
+        # just write the data we read
+        raw = [self._raw(fvs[i], off)
+               for i, off in zip(self.findex, self.offset)]
+        if(n > 0 and all(r is not None and not r.extra and r.n == n and
+                         r.data is raw[0].data for r in raw)):
+            self._write_data(fvs, fh, n, raw[0].data)
+            return
+        col = []
+        try:
+            for i, sz, r in zip(self.findex, self.field_size, raw):
+                if(r is not None and not r.extra and r.n == n):
+                    # Use the bytes we read for this field
+                    t = r.data.decode(_text_codec)
+                    col.append([t[j:(j+sz)] for j in
+                                range(r.offset, len(t), r.stride)])
+                    continue
+                vals = self._values(fvs[i], n)
+                if(vals is None):
+                    break
+                t = self._format(fvs[i], sz, vals)
+                if(len(t) > 0 and set(map(len, t)) != {sz}):
+                    break
+                if(r is not None):
+                    # Keep the bytes we read for the values that haven't
+                    # been set
+                    for k in range(min(n, r.n)):
+                        if((k,) in r):
+                            t[k] = r[(k,)].decode(_text_codec)
+                col.append(t)
+            if(len(col) == len(self.findex)):
+                if(len(col) == 1):
+                    t = "".join(col[0])
+                else:
+                    t = "".join(itertools.chain.from_iterable(zip(*col)))
+                t = t.encode(_text_codec)
+            else:
+                t = None
+        except (ValueError, TypeError, OverflowError, UnicodeError):
+            t = None
+        if(t is None):
+            for k in range(n):
+                for i in self.findex:
+                    fvs[i].write_to_file(fh, (k,))
+            return
+        self._write_data(fvs, fh, n, t)
+
+    def _write_data(self, fvs, fh, n, t):
+        '''Write the bytes t for the whole loop, and record the file
+        location of each value.'''
+        start = fh.tell()
+        fh.write(t)
+        keys = [(k,) for k in range(n)]
+        for i, off in zip(self.findex, self.offset):
+            fvs[i].fh_loc = dict(zip(keys, range(start + off,
+                                                 start + off + n * self.row_size,
+                                                 self.row_size)))
+        
+def _size_with_offset(sz, size_offset):
+    if(sz != 0):
+        sz -= size_offset
+    return sz
+
+__all__ = ["FieldStructCodeGen",]
@@ -4,16 +4,21 @@
 # file doc/Nitf_file.xmi (e.g., use umbrello) to see the design.
 
 from .nitf_file_header import NitfFileHeader
-from .nitf_tre import read_tre, prepare_tre_write, add_find_tre_function
+from .nitf_tre import (read_tre, read_tre_data, prepare_tre_write,
+                        add_find_tre_function)
 from .nitf_tre_engrda import add_engrda_function
 from .nitf_security import security_unclassified
 from .nitf_segment import (NitfSegment, NitfImageSegment, NitfGraphicSegment,
                            NitfTextSegment, NitfDesSegment,
                            NitfResSegment)
 from .nitf_segment_hook import NitfSegmentHookSet
+from .nitf_des_streaming_file_header import read_streaming_file_header
 from .nitf_segment_user_subheader_handle import NitfSegmentUserSubheaderHandleSet
 from .nitf_segment_data_handle import NitfSegmentDataHandleSet
+from .nitf_field import BufferReader, BufferWriter
 import io,copy,weakref
+import shutil
+import tempfile
 import copy
 import collections
 
@@ -25,10 +30,161 @@ class ListNitfFileReference(collections.UserList):
         self.nitf_file = weakref.ref(f)
     def append(self, v):
         super().append(v)
+        self._after_append(v)
+
+    def _after_append(self, v):
         v._nitf_file = self.nitf_file
         if(v.nitf_file):
             v.nitf_file.segment_hook_set.after_append_hook(v, v.nitf_file)
         
+class LazySegmentList(ListNitfFileReference):
+    '''List of segments used by NitfFile when reading with lazy=True.
+    We know where each segment is in the file from the file header, and
+    we only read a segment (subheader, user subheader, TREs and data)
+    the first time it is accessed.
+
+    Indexing, iterating and len only read the segments needed. Anything
+    else that goes through the list (e.g., append or sort) reads all the
+    segments first, so it behaves the same as a normal list.
+
+    If we already have the bytes for each subheader (e.g., read_many reads
+    these in another process), these can be passed as subheader_data. We
+    then parse the subheader from these rather than reading the file, and
+    the data is read from the file the first time it is used.'''
+    def __init__(self, f, seg_cls, file_name, offsets, subheader_data=None):
+        super().__init__(f)
+        self._seg_cls = seg_cls
+        self._file_name = file_name
+        self._offsets = offsets
+        self._subheader_data = subheader_data
+        self._data = [None] * len(offsets)
+
+    @property
+    def data(self):
+        '''The list of segments, reading any we haven't already read.'''
+        for i, seg in enumerate(self._data):
+            if(seg is None):
+                self[i]
+        return self._data
+
+    @data.setter
+    def data(self, v):
+        self._data = v
+
+    def is_read(self, i):
+        '''Return True if we have already read the given segment.'''
+        return self._data[i] is not None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, i):
+        if(isinstance(i, slice)):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        seg = self._data[i]
+        if(seg is None):
+            i = i if i >= 0 else i + len(self)
+            seg = self.read_segment(i)
+            self._data[i] = seg
+        return seg
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, v):
+        '''Append a segment. Unlike most list operations this doesn't
+        read the segments already in the list, so we can add a segment
+        to a file opened with NitfFile.open_for_update.'''
+        self._data.append(v)
+        self._after_append(v)
+
+    def read_segment(self, i):
+        '''Read segment i from the file. Note that this doesn't save the
+        segment in this list, normally you just want to index the list
+        instead.'''
+        f = self.nitf_file()
+        if(f is None):
+            raise RuntimeError("The NitfFile has been deleted, so we can't read the segment. Keep a reference to the NitfFile when using lazy=True")
+        offset, header_size, data_size = self._offsets[i]
+        i = i if i >= 0 else i + len(self)
+        seg = self._seg_cls(header_size=header_size, data_size=data_size,
+                            nitf_file = f)
+        if(self._subheader_data is not None):
+            seg._read_subheader(BufferReader(self._subheader_data[i]))
+            seg._read_user_subheader()
+            seg._read_data_later(self._file_name, offset + header_size, i)
+        else:
+            with open(self._file_name, 'rb') as fh:
+                fh.seek(offset)
+                seg.read_from_file(fh, i)
+        seg.read_tre(f.des_segment, lazy=True)
+        f.segment_hook_set.after_read_hook(seg, f)
+        return seg
+
+def _move_file_range(fh, start, stop, shift, chunk_size):
+    '''Move the bytes from start to stop in the open file fh by shift
+    bytes (which can be negative). Used by NitfFile.update.'''
+    if(shift > 0):
+        # Go backwards, so we don't write over data we haven't moved yet
+        pos = stop
+        while(pos > start):
+            n = min(chunk_size, pos - start)
+            pos -= n
+            fh.seek(pos)
+            d = fh.read(n)
+            fh.seek(pos + shift)
+            fh.write(d)
+    elif(shift < 0):
+        pos = start
+        while(pos < stop):
+            n = min(chunk_size, stop - pos)
+            fh.seek(pos)
+            d = fh.read(n)
+            fh.seek(pos + shift)
+            fh.write(d)
+            pos += n
+
+class _SequentialWriter(object):
+    '''File like object used by NitfFile.write_stream. This keeps track
+    of the position so we can support tell even if the underlying file
+    handle doesn't, and collects the small writes (e.g., each field in a
+    FieldStruct) into larger ones.
+
+    We don't support fileno or seek, so code that tries to memory map or
+    update the file (e.g., NitfImageWriteDataOnDemand) skips that.'''
+    def __init__(self, fh, buffer_size=1024*1024):
+        self.fh = fh
+        self.buffer_size = buffer_size
+        self.buf = bytearray()
+        self.pos = 0
+
+    def write(self, d):
+        n = len(d)
+        if(n >= self.buffer_size):
+            self.flush()
+            self.fh.write(d)
+        else:
+            self.buf += d
+            if(len(self.buf) >= self.buffer_size):
+                self.flush()
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        if(len(self.buf) > 0):
+            self.fh.write(bytes(self.buf))
+            self.buf = bytearray()
+
+    def fileno(self):
+        raise io.UnsupportedOperation("fileno")
+
+    def seek(self, offset, whence=0):
+        raise io.UnsupportedOperation("seek")
+
 class NitfFile(object):
     '''This is used to read and write a NITF File.
 
@@ -48,11 +204,25 @@ class NitfFile(object):
        :ivar tre_list:         List of Tre objects for the file level TREs.
 
     '''        
-    def __init__(self, file_name = None, security = security_unclassified):
+    # The segment types, the class used for them, and the attribute
+    # holding the list of segments. This is in the order things appear
+    # in the file.
+    segment_types = [["image", NitfImageSegment, "image_segment"],
+                     ["graphic", NitfGraphicSegment, "graphic_segment"],
+                     ["text", NitfTextSegment, "text_segment"],
+                     ["des", NitfDesSegment, "des_segment"],
+                     ["res", NitfResSegment, "res_segment"]]
+
+    def __init__(self, file_name = None, security = security_unclassified,
+                 lazy = False):
         '''Create a NitfFile for reading or writing. Because it is common, if
         you give a file_name we read from that file to populate the Nitf 
         structure. Otherwise we start with a default file (a file header, but
-        no segments) - which you can then populate before calling write'''
+        no segments) - which you can then populate before calling write.
+
+        If lazy is True, we only read the file header and file level TREs
+        up front, and read each segment the first time it is accessed
+        (see read).'''
         self.file_header = NitfFileHeader()
         self.file_name = file_name
         self.report_raw = False
@@ -68,8 +238,12 @@ class NitfFile(object):
         # These are the file level TREs. There can also be TREs at the
         # image segment level
         self.tre_list = []
+        # Used by write, see NitfSegment._update_file_header
+        self._file_header_fh = None
+        # Set by open_for_update
+        self._update_mode = False
         if(file_name is not None):
-            self.read(file_name)
+            self.read(file_name, lazy=lazy)
         if(file_name is None):
             self.security = security
 
@@ -142,18 +316,26 @@ class NitfFile(object):
                 print("-------------------------------------------------------------",
                       file=res)
         return res.getvalue()
-    def read(self, file_name):
-        '''Read the given file.'''
+    def read(self, file_name, lazy=False):
+        '''Read the given file.
+
+        If lazy is True, we only read the file header and the file level
+        TREs. The segment lists are LazySegmentList, which read a segment
+        (and run after_read_hook on it) the first time it is accessed,
+        using the offsets we get from the segment sizes in the file header.
+        This is much faster if you only need a few segments out of a
+        file with lots of them. The TREs are also read with lazy=True (see
+        read_tre_data), so a TRE field is only converted when it is used.'''
         self.file_name = file_name
         with open(file_name, 'rb') as fh:
-            self.file_header.read_from_file(fh)
-            # We don't currently support streaming file format. This is
-            # indicated by fl being 999999999999 (the maximum file size
-            # allowed is 999999999998). Report this. We could perhaps add
-            # support for this if needed, but for now just catch that we
-            # encountered this and give up
-            if(self.file_header.fl == 999999999999):
-                raise RuntimeError("We don't currently support reading streaming NITF files")
+            start = self._read_file_header(fh)
+            if(lazy):
+                self._create_lazy_segment_list(file_name, start)
+                self.tre_list = read_tre(self.file_header, self.des_segment,
+                                         [["xhdl", "xhdlofl", "xhd"],
+                                          ["udhdl", "udhofl", "udhd"]],
+                                         lazy=True)
+                return
             self.image_segment = \
                [NitfImageSegment(header_size=self.file_header.lish[i],
                                  data_size=self.file_header.li[i],
@@ -188,42 +370,431 @@ class NitfFile(object):
                 seg.read_tre(self.des_segment)
             for seg in self.segments():
                 self.segment_hook_set.after_read_hook(seg, self)
-    def write(self, file_name):
-        '''Write to the given file'''
+    def _read_file_header(self, fh):
+        '''Read the file header, and return the offset in the file where
+        the segments start (with fh left there).
+
+        A file in the streaming format is indicated by fl being
+        999999999999 (the maximum file size allowed is 999999999998). The
+        segment sizes that weren't known when the file header was written
+        are all 9s, and the correct file header is in a
+        STREAMING_FILE_HEADER DES at the end of the file. For these files
+        we replace file_header with that one.'''
+        self.file_header.read_from_file(fh)
+        start = fh.tell()
+        if(self.file_header.fl == 999999999999):
+            self.file_header, _ = read_streaming_file_header(fh)
+            fh.seek(start)
+        return start
+
+    def _create_lazy_segment_list(self, file_name, start):
+        '''Set up the segment lists as LazySegmentList, using the file
+        header we have already read.'''
+        offsets = self.file_header.segment_offsets(start)
+        for seg_type, seg_cls, attr in self.segment_types:
+            setattr(self, attr, LazySegmentList(self, seg_cls, file_name,
+                                                offsets[seg_type]))
+
+    @classmethod
+    def open_segment(cls, file_name, seg_type, seg_index):
+        '''Read a single segment from a file, e.g.,
+        NitfFile.open_segment(file_name, "image", 17). The seg_type is
+        "image", "graphic", "text", "des" or "res", and seg_index is the
+        0 based index for that type of segment (like the index into
+        NitfFile.image_segment).
+
+        We only read the file header, and then go directly to the segment
+        using the segment sizes in the header. A TRE_OVERFLOW DES is only
+        read if the segment's TREs overflow into it. This is much faster
+        than reading the whole file if we just want one segment (e.g.,
+        a server returning individual image segments).
+
+        The segment is read the same way NitfFile.read would, including
+        its TREs and after_read_hook. The NitfFile used to read it is
+        available as seg.nitf_file, which is kept around as long as the
+        segment is. This NitfFile doesn't have the file level TREs read,
+        its other segments are read if accessed (see read with lazy=True).
+        '''
+        seg_attr = {t[0] : t[2] for t in cls.segment_types}
+        if(seg_type not in seg_attr):
+            raise RuntimeError("Unknown segment type '%s'" % seg_type)
+        f = cls()
+        f.file_name = file_name
+        with open(file_name, 'rb') as fh:
+            start = f._read_file_header(fh)
+        f._create_lazy_segment_list(file_name, start)
+        seg = getattr(f, seg_attr[seg_type]).read_segment(seg_index)
+        # Nothing else refers to f, so have the segment keep it around.
+        # We don't store seg in f's segment list, so this doesn't create
+        # a reference cycle.
+        seg._nitf_file = lambda : f
+        return seg
+
+    @classmethod
+    def open_for_update(cls, file_name):
+        '''Open a file to update in place, e.g., change a classification
+        field or add a TRE in a large file without rewriting it.
+
+        This reads the file with lazy=True. You can then change the file
+        header, the file level TREs, and the subheaders and TREs of any
+        segments, and call update to write the changes back to the file.
+        Only the file header and the subheaders of the segments that have
+        been read are written. If these are the same size as before, they
+        are just written over the old ones. If the size changes, we shift
+        the rest of the file (everything after the subheader) and update
+        the lengths in the file header.
+
+        Segments can also be appended to the segment lists, see update.
+        Segments can't be removed, and the data of existing segments
+        isn't written - use write for that.'''
+        h = NitfFileHeader()
+        with open(file_name, 'rb') as fh:
+            h.read_from_file(fh)
+        if(h.fl == 999999999999):
+            raise RuntimeError("Can't update the streaming NITF file %s, use convert_streaming_file first" % file_name)
+        f = cls()
+        f.read(file_name, lazy=True)
+        f._update_mode = True
+        return f
+
+    @classmethod
+    def append_segments(cls, file_name, seg_list, spool_size=64*1024*1024):
+        '''Add the segments in seg_list (e.g., a NitfImageSegment and a
+        NitfDesSegment) to an existing file, without reading or rewriting
+        the segments already there. This is just a shortcut for
+        open_for_update, appending to the segment lists, and update.
+
+        Note that the file header grows with each segment added (for the
+        segment lengths), and everything in NITF comes after the file
+        header. So the segments already in the file still get moved,
+        although this is just copying the bytes in one pass through the
+        file.'''
+        f = cls.open_for_update(file_name)
+        for seg in seg_list:
+            attr = [attr for seg_type, seg_cls, attr in cls.segment_types
+                    if isinstance(seg, seg_cls)]
+            if(len(attr) == 0):
+                raise RuntimeError("Unknown segment type %s" % type(seg))
+            getattr(f, attr[0]).append(seg)
+        f.update(spool_size=spool_size)
+        return f
+
+    def update(self, spool_size=64*1024*1024):
+        '''Write the changes made to a file opened with open_for_update
+        back to the file. This can be called more than once.
+
+        Segments appended to the segment lists (e.g.,
+        f.image_segment.append(iseg)) are written after the last segment
+        of the same type. If the data handle doesn't know the size of the
+        data (see NitfData.write_size) we first write it to a temporary
+        file (kept in memory up to spool_size bytes) to get the size.
+
+        Note that if something before it changes size, data from a segment
+        that was already read (e.g., a memory mapped image in
+        NitfImageReadNumpy) isn't valid any more. Open the file again to
+        read it.'''
+        if(not self._update_mode):
+            raise RuntimeError("update can only be used with a file opened with open_for_update")
+        for seg_type, seg_cls, attr in self.segment_types:
+            lst = getattr(self, attr)
+            if(not isinstance(lst, LazySegmentList) or
+               len(lst._data) < len(lst._offsets)):
+                raise RuntimeError("update doesn't support removing segments, use write instead")
+        # We work with a copy of the file header, and save the new sizes in
+        # pending, so nothing changes if we fail before the file is
+        # updated (and update can be called again).
+        h = copy.deepcopy(self.file_header)
+        hl_old = h.hl
+        # List of (offset, old size, pieces) for each part of the file
+        # we want to write. The pieces are either bytes, or a
+        # (seg, seg_index, data size, spool) for segment data.
+        edits = []
+        # List of (object, attribute, value) to set once the file is updated
+        pending = []
+        self._prepare_tre_update(self.tre_list, h,
+                                 [["xhdl", "xhdlofl", "xhd"],
+                                  ["udhdl", "udhofl", "udhd"]], 0, edits,
+                                 pending)
+        num_field = {seg_type : num for seg_type, num, lsh, l
+                     in h.segment_size_fields}
+        offset_end = hl_old
+        try:
+            for seg_type, seg_cls, attr in self.segment_types:
+                lst = getattr(self, attr)
+                num_old = len(lst._offsets)
+                setattr(h, num_field[seg_type], len(lst))
+                new_pieces = []
+                for i in range(len(lst)):
+                    if(i < num_old):
+                        offset, header_size, data_size = lst._offsets[i]
+                        offset_end = offset + header_size + data_size
+                        if(not lst.is_read(i)):
+                            continue
+                    seg = lst[i]
+                    self.segment_hook_set.before_write_hook(seg, self)
+                    if(seg._type_support_tre):
+                        self._prepare_tre_update(seg.tre_list, seg.subheader,
+                                                 seg._tre_field_list, i,
+                                                 edits, pending)
+                    shfh = BufferWriter()
+                    sz_header = seg._write_subheader(shfh)
+                    pending.append((seg, "header_size", sz_header))
+                    getattr(h, seg._update_file_header_field[0])[i] = sz_header
+                    if(i < num_old):
+                        edits.append((offset, header_size, [shfh.data]))
+                    else:
+                        sz_data, spool = self._data_size(seg, i, spool_size)
+                        pending.append((seg, "data_size", sz_data))
+                        getattr(h, seg._update_file_header_field[1])[i] = sz_data
+                        new_pieces.extend([shfh.data,
+                                           (seg, i, sz_data, spool)])
+                if(len(new_pieces) > 0):
+                    edits.append((offset_end, 0, new_pieces))
+            h.hl = h.serialized_size()
+            h.fl = h.hl + sum(getattr(h, lsh)[i] + getattr(h, l)[i]
+                              for seg_type, num, lsh, l
+                              in h.segment_size_fields
+                              for i in range(getattr(h, num)))
+            hfh = BufferWriter()
+            h.write_to_file(hfh)
+            edits.append((0, hl_old, [hfh.data]))
+            # Inserted segments go before a subheader at the same offset
+            edits.sort(key=lambda e: (e[0], e[1] > 0))
+            with open(self.file_name, 'r+b') as fh:
+                self._apply_edits(fh, edits)
+        finally:
+            for offset, old_size, pieces in edits:
+                for p in pieces:
+                    if(isinstance(p, tuple) and p[3] is not None):
+                        p[3].close()
+        self.file_header = h
+        for obj, attr, v in pending:
+            setattr(obj, attr, v)
+        offsets = h.segment_offsets()
+        for seg_type, seg_cls, attr in self.segment_types:
+            getattr(self, attr)._offsets = offsets[seg_type]
+
+    def _apply_edits(self, fh, edits, chunk_size=16*1024*1024):
+        '''Write the edits from update to the file. The edits should be
+        sorted by offset.
+
+        We first move the parts of the file between the edits to where
+        they end up, in one pass through the file. The parts that move
+        towards the start of the file are moved first, going forward
+        through the file, and then the parts moving towards the end of
+        the file going backwards. Since the final positions don't overlap,
+        this never writes over something we haven't moved yet. We then
+        write the edits in the space left for them.'''
+        fh.seek(0, 2)
+        end = fh.tell()
+        sizes = [sum(len(p) if isinstance(p, (bytes, bytearray)) else p[2]
+                     for p in pieces) for offset, old_size, pieces in edits]
+        # Gaps between the edits, as (start, end, shift)
+        gaps = []
+        pos = 0
+        shift = 0
+        for (offset, old_size, pieces), sz in zip(edits, sizes):
+            if(offset > pos):
+                gaps.append((pos, offset, shift))
+            shift += sz - old_size
+            pos = offset + old_size
+        if(end > pos):
+            gaps.append((pos, end, shift))
+        for start, stop, shift in gaps:
+            if(shift < 0):
+                _move_file_range(fh, start, stop, shift, chunk_size)
+        for start, stop, shift in reversed(gaps):
+            if(shift > 0):
+                _move_file_range(fh, start, stop, shift, chunk_size)
+        shift = 0
+        for (offset, old_size, pieces), sz in zip(edits, sizes):
+            fh.seek(offset + shift)
+            if(sz != old_size or
+               not all(isinstance(p, (bytes, bytearray)) for p in pieces) or
+               fh.read(old_size) != b''.join(pieces)):
+                fh.seek(offset + shift)
+                for p in pieces:
+                    if(isinstance(p, (bytes, bytearray))):
+                        fh.write(p)
+                    else:
+                        self._write_data(fh, *p)
+            shift += sz - old_size
+        if(shift < 0):
+            fh.truncate(end + shift)
+
+    def _prepare_tre_update(self, tre_list, header, field_list, seg_index,
+                            edits, pending):
+        '''Put the TREs in header for update. We can't add or remove
+        a TRE_OVERFLOW DES, but we can rewrite one that is already in the
+        file if the size doesn't change. If the TRE_OVERFLOW DES changes,
+        we add it to the list of edits, and the new DES data to pending.'''
+        h_len, h_ofl, h_data = field_list[0]
+        ofl_old = getattr(header, h_ofl) if getattr(header, h_len) > 0 else 0
+        if(ofl_old > 0):
+            # read_tre puts the TREs from the TRE_OVERFLOW DES first. Move
+            # them back to the end, so prepare_tre_write puts them back
+            # in the DES.
+            n = len(read_tre_data(self.des_segment[ofl_old - 1].des.data))
+            tre_list = tre_list[n:] + tre_list[:n]
+        des_list = []
+        prepare_tre_write(tre_list, header, des_list, field_list, seg_index)
+        if(len(des_list) == 0 and ofl_old == 0):
+            return
+        if(len(des_list) == 0 or ofl_old == 0):
+            raise RuntimeError("update can't add or remove a TRE_OVERFLOW DES, use write instead")
+        dseg = self.des_segment[ofl_old - 1]
+        d = des_list[0].des.data
+        if(len(d) != len(dseg.des.data)):
+            raise RuntimeError("update can't change the size of a TRE_OVERFLOW DES, use write instead")
+        setattr(header, h_ofl, ofl_old)
+        if(d != dseg.des.data):
+            pending.append((dseg.des, "data", d))
+            offset, header_size, data_size = \
+                self.des_segment._offsets[ofl_old - 1]
+            edits.append((offset + header_size, data_size, [d]))
+
+    def _prepare_write(self):
+        '''Common set up for write and write_stream. We call the
+        before_write_hook, create the TRE_OVERFLOW DES as needed and
+        fill in the segment counts in the file header.'''
         for seg in self.segments():
             self.segment_hook_set.before_write_hook(seg, self)
+        # We regenerate the TRE_OVERFLOW DES as needed. We also drop any
+        # STREAMING_FILE_HEADER DES from reading a streaming file, since
+        # we write a normal file with the correct file header.
+        self.des_segment = \
+            ListNitfFileReference(self, [dseg for dseg in self.des_segment
+                                   if(dseg.subheader.desid.encode("utf-8")
+                                      not in (b'TRE_OVERFLOW',
+                                              b'STREAMING_FILE_HEADER'))])
+        h = self.file_header
+        prepare_tre_write(self.tre_list, h, self.des_segment,
+                          [["xhdl", "xhdlofl", "xhd"],
+                           ["udhdl", "udhofl", "udhd"]])
+        for i, seg in self.segments(include_seg_index=True):
+            seg.prepare_tre_write(i, self.des_segment)
+        h.numi = len(self.image_segment)
+        h.nums = len(self.graphic_segment)
+        h.numt = len(self.text_segment)
+        h.numdes = len(self.des_segment)
+        h.numres = len(self.res_segment)
+
+    def _remove_tre_overflow(self):
+        '''Special handling for the TRE overflow DES. We create these as
+        needed for the TREs that we already have stored various places.
+        Clear out any that generated during our write'''
         self.des_segment = \
             ListNitfFileReference(self, [dseg for dseg in self.des_segment
                                    if(dseg.subheader.desid.encode("utf-8") !=
                                       b'TRE_OVERFLOW')])
+
+    def write(self, file_name):
+        '''Write to the given file'''
+        self._prepare_write()
         with open(file_name, 'w+b') as fh:
             h = self.file_header
-            prepare_tre_write(self.tre_list, h, self.des_segment,
-                              [["xhdl", "xhdlofl", "xhd"],
-                               ["udhdl", "udhofl", "udhd"]])
-            for i, seg in self.segments(include_seg_index=True):
-                seg.prepare_tre_write(i, self.des_segment)
-            h.numi = len(self.image_segment)
-            h.nums = len(self.graphic_segment)
-            h.numt = len(self.text_segment)
-            h.numdes = len(self.des_segment)
-            h.numres = len(self.res_segment)
-            h.write_to_file(fh)
+            # The file header has the size of the header, each segment
+            # and the file, which we only know after writing. So we
+            # write the header to memory, update the sizes there as we go
+            # (see NitfSegment._update_file_header) and then write the
+            # final header to the file at the end.
+            hfh = BufferWriter()
+            h.write_to_file(hfh)
             # Might be a cleaner way to do this, but for now we just "know"
             # we need to update the header length
-            h.update_field(fh, "hl", fh.tell())
+            h.update_field(hfh, "hl", hfh.tell())
+            fh.write(hfh.data)
             # Write out each segment, updating the subheader and data sizes
-            for i, seg in self.segments(include_seg_index=True):
-                seg.write_to_file(fh, i)
+            self._file_header_fh = hfh
+            try:
+                for i, seg in self.segments(include_seg_index=True):
+                    seg.write_to_file(fh, i)
+            finally:
+                self._file_header_fh = None
             # Now we have to update the file length
-            h.update_field(fh, "fl", fh.tell())
-        # Special handling for the TRE overflow DES. We create these as
-        # needed for the TREs that we already have stored various places.
-        # Clear out any that generated during our write
-        self.des_segment = \
-            ListNitfFileReference(self, [dseg for dseg in self.des_segment
-                                   if(dseg.subheader.desid.encode("utf-8") !=
-                                      b'TRE_OVERFLOW')])
+            h.update_field(hfh, "fl", fh.tell())
+            fh.seek(0)
+            fh.write(hfh.data)
+        self._remove_tre_overflow()
+
+    def write_stream(self, fh, spool_size=64*1024*1024):
+        '''Write to a file handle that we can only write to sequentially,
+        e.g., a pipe, a socket, or a compressor like gzip.GzipFile. The
+        file handle only needs to support write.
+
+        Unlike write, we can't go back and fill in the sizes in the file
+        header after writing the segments. So we do this in two passes.
+        First we write each subheader to memory, and get the size of the
+        data from NitfData.write_size. If the data handle doesn't know the
+        size, we write the data to a temporary file (kept in memory up to
+        spool_size bytes) and get the size from that. We then write the
+        file header and each segment in order.
+
+        Note that the data can't be memory mapped as it is written, so
+        NitfImageWriteDataOnDemand doesn't set data_written when writing
+        with this function.'''
+        self._prepare_write()
+        h = self.file_header
+        seg_list = []
+        try:
+            for i, seg in self.segments(include_seg_index=True):
+                shfh = BufferWriter()
+                sz_header = seg._write_subheader(shfh)
+                sz_data, spool = self._data_size(seg, i, spool_size)
+                seg_list.append((i, seg, shfh.data, sz_data, spool))
+                getattr(h, seg._update_file_header_field[0])[i] = sz_header
+                getattr(h, seg._update_file_header_field[1])[i] = sz_data
+            hfh = BufferWriter()
+            h.write_to_file(hfh)
+            h.update_field(hfh, "hl", hfh.tell())
+            h.update_field(hfh, "fl", hfh.tell() +
+                           sum(len(sh) + sz for i, seg, sh, sz, spool
+                               in seg_list))
+            out = _SequentialWriter(fh)
+            out.write(hfh.data)
+            for i, seg, sh, sz, spool in seg_list:
+                out.write(sh)
+                self._write_data(out, seg, i, sz, spool)
+            out.flush()
+        finally:
+            for i, seg, sh, sz, spool in seg_list:
+                if(spool is not None):
+                    spool.close()
+        self._remove_tre_overflow()
+
+    def _data_size(self, seg, seg_index, spool_size):
+        '''Return the size of the data for a segment and a spool file,
+        used by write_stream and update. If the data handle doesn't know
+        the size (see NitfData.write_size), we write the data to a
+        temporary file which is returned as spool. Otherwise spool is
+        None.'''
+        sz = seg.data.write_size()
+        if(sz is not None):
+            return sz, None
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        sfh = _SequentialWriter(spool)
+        self._write_segment_data(sfh, seg, seg_index)
+        sfh.flush()
+        spool.seek(0)
+        return sfh.tell(), spool
+
+    def _write_data(self, fh, seg, seg_index, sz, spool):
+        '''Write the data for a segment, from the spool file if we have
+        one, checking that we wrote the size returned by _data_size.'''
+        start_pos = fh.tell()
+        if(spool is not None):
+            shutil.copyfileobj(spool, fh)
+        else:
+            self._write_segment_data(fh, seg, seg_index)
+        if(fh.tell() - start_pos != sz):
+            raise RuntimeError("Segment number %d (zero-based index) wrote %d bytes of data, but write_size returned %d" % (seg_index, fh.tell() - start_pos, sz))
+
+    def _write_segment_data(self, fh, seg, seg_index):
+        '''Write the data for a segment, used by write_stream and update'''
+        try:
+            seg.data.write_to_file(fh)
+        except Exception as ex:
+            raise(RuntimeError("Exception occurred while writing out segment number %d (zero-based index): \n\n%s" % (seg_index, str(ex))))
 
     def segments(self, include_seg_index=False):
         '''Iterator to go through all the segments in a file. We often also
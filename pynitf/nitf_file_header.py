@@ -3,6 +3,7 @@ from .nitf_security import NitfSecurity
 from .nitf_diff_handle import NitfDiffHandle, NitfDiffHandleSet
 
 import io
+import numpy as np
 
 hlp = '''This is a NITF File header. The field names can be pretty
 cryptic, but these are documented in detail in the NITF 2.10 documentation
@@ -78,6 +79,41 @@ desc = [['fhdr', "File Profile Name", 4, str, {"default" : "NITF",
 class NitfFileHeader(FieldStruct):
     __doc__ = help
     desc = desc
+    # The segment types in the order they appear in the file, along with
+    # the fields giving the number of segments, and the subheader and
+    # data sizes
+    segment_size_fields = [["image", "numi", "lish", "li"],
+                           ["graphic", "nums", "lssh", "ls"],
+                           ["text", "numt", "ltsh", "lt"],
+                           ["des", "numdes", "ldsh", "ld"],
+                           ["res", "numres", "lresh", "lre"]]
+
+    def segment_offsets(self, start=None):
+        '''Return a dict going from the segment type ("image", "graphic",
+        "text", "des" or "res") to a list with (offset, header_size,
+        data_size) for each segment of that type. The offset is where the
+        segment subheader starts in the file.
+
+        This only uses hl and the segment sizes, so we can find a segment
+        without reading any of the segments before it.
+
+        The segments start at the end of the file header (so hl), but you
+        can pass in a different start if needed (e.g., the replacement
+        file header for a streaming file).'''
+        res = {}
+        offset = self.hl if start is None else start
+        for seg_type, num, lsh, l in self.segment_size_fields:
+            res[seg_type] = []
+            if(getattr(self, num) == 0):
+                continue
+            # Use numpy, there can be hundreds of segments
+            d = self.to_numpy(lsh)
+            end = offset + np.cumsum(d[lsh] + d[l])
+            start = np.concatenate(([offset], end[:-1]))
+            res[seg_type] = list(zip(start.tolist(), d[lsh].tolist(),
+                                     d[l].tolist()))
+            offset = int(end[-1])
+        return res
 
     @property
     def security(self):
@@ -3,6 +3,7 @@ from .nitf_segment import (NitfSegment, NitfSharedHeader,
                            NitfImageSegment, NitfGraphicSegment,
                            NitfTextSegment, NitfDesSegment, NitfResSegment)
 from .nitf_des import NitfDesFieldStruct
+from .nitf_field import FieldStruct, BufferWriter
 import copy
 import weakref
 
@@ -113,6 +114,30 @@ class NitfResSegmentJson(NitfSegmentJson, NitfResSegment):
     pass
 
     
+def _register_field_struct_handler():
+    '''A FieldStruct normally pickles just the values of each field (see
+    FieldStruct.__getstate__). For the json files we instead save the
+    string version of the bytes, which is easier to read and merge (and
+    is what we have always used for these files). Register a jsonpickle
+    handler to do this.'''
+    import jsonpickle.handlers
+    import jsonpickle.unpickler
+
+    class FieldStructHandler(jsonpickle.handlers.BaseHandler):
+        def flatten(self, obj, data):
+            fh = BufferWriter()
+            obj.write_to_file(fh)
+            data["py/state"] = { "field_data" : str(fh.getvalue()) }
+            return data
+
+        def restore(self, obj):
+            cls = jsonpickle.unpickler.loadclass(obj["py/object"])
+            res = cls.__new__(cls)
+            res.__setstate__(obj["py/state"])
+            return res
+        
+    jsonpickle.handlers.register(FieldStruct, FieldStructHandler, base=True)
+    
 # I don't think we actually want this to be a NitfFile.
 #class NitfFileJson(NitfFile):
 class NitfFileJson():
@@ -188,6 +213,7 @@ class NitfFileJson():
 
     def read(self, file_name):
         import jsonpickle
+        _register_field_struct_handler()
         (self.file_header,
          self.image_segment,
          self.graphic_segment,
@@ -199,6 +225,7 @@ class NitfFileJson():
         
     def write(self, file_name):
         import jsonpickle
+        _register_field_struct_handler()
         jsonpickle.set_encoder_options('json', sort_keys=True, 
                                        indent=4, separators=(',', ': '))
         with open(file_name, "w") as fh:
@@ -86,6 +86,9 @@ class NitfImagePlaceHolder(NitfImage):
                 #This may go negative on the last loop but that's fine
                 bytes_left = bytes_left - buffer_size
 
+    def write_size(self):
+        return self._data_size
+
 logger = logging.getLogger('nitf_diff')
 class ImagePlaceHolderDiff(NitfDiffHandle):
     def handle_diff(self, d1, d2, nitf_diff):
@@ -202,6 +205,9 @@ class NitfImageReadNumpy(NitfImageWithSubset):
                 #This may go negative on the last loop but that's fine
                 bytes_left = bytes_left - buffer_size
 
+    def write_size(self):
+        return self.data_size
+
 class ImageWithSubsetDiff(NitfDiffHandle):
     def handle_diff(self, d1, d2, nitf_diff):
         if(not isinstance(d1, NitfImageWithSubset) or
@@ -412,6 +418,11 @@ class NitfImageWriteDataOnDemand(NitfImageWithSubset):
                                            buffer = self.mm,
                                            strides = strides,
                                            offset = foff)
+
+    def write_size(self):
+        ih = self.subheader
+        return ih.number_band * ih.nrows * ih.ncols * ih.dtype.itemsize
+
     def flush_update(self):
         '''Flush any updates made to data_written'''
         if(self.data_written is None):
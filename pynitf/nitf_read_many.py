@@ -0,0 +1,159 @@
+# This reads a large number of NITF files in parallel, using a process pool.
+
+from .nitf_file import NitfFile, LazySegmentList
+from .nitf_field import BufferReader, BufferWriter
+from .nitf_tre import read_tre
+import concurrent.futures
+import os
+
+def _read_file_parts(file_name):
+    '''Read the file header, and the subheader of each segment. This is
+    run in the worker process. We parse everything (including the user
+    subheaders and TREs) so any problem with the file is found here, but
+    we only pass back the bytes for the file header and for each
+    subheader. Bytes are cheap to pickle, and the NitfFile created from
+    them in the parent process only parses a subheader when the segment
+    is used (see _nitf_file_from_parts).
+
+    For each segment type we return a list of (offset, header_size,
+    data_size, subheader bytes).'''
+    f = NitfFile()
+    f.read(file_name, lazy=True)
+    # For a streaming file this is the replacement file header. Fields
+    # that haven't changed are written as read, so for a normal file this
+    # is the same bytes as in the file.
+    hfh = BufferWriter()
+    f.file_header.write_to_file(hfh)
+    seg_parts = {}
+    with open(file_name, 'rb') as fh:
+        for seg_type, seg_cls, attr in NitfFile.segment_types:
+            seg_parts[seg_type] = []
+            for offset, header_size, data_size in getattr(f, attr)._offsets:
+                fh.seek(offset)
+                d = fh.read(header_size)
+                seg = seg_cls(header_size=header_size, data_size=data_size,
+                              nitf_file=f)
+                seg._read_subheader(BufferReader(d))
+                seg._read_user_subheader()
+                seg.read_tre(f.des_segment)
+                seg_parts[seg_type].append((offset, header_size, data_size,
+                                            d))
+    return (hfh.getvalue(), seg_parts)
+
+def _nitf_file_from_parts(file_name, parts, lazy):
+    '''Create a NitfFile from the results of _read_file_parts. This is
+    like reading with NitfFile(file_name, lazy=True), except we already
+    have the subheaders in memory. A segment's subheader is parsed the
+    first time the segment is used, and its data read from the file the
+    first time the data is used. If lazy is False, we do this for all
+    the segments right away.'''
+    file_header_data, seg_parts = parts
+    f = NitfFile()
+    f.file_name = file_name
+    f.file_header.read_from_file(BufferReader(file_header_data))
+    for seg_type, seg_cls, attr in NitfFile.segment_types:
+        p = seg_parts[seg_type]
+        setattr(f, attr, LazySegmentList(f, seg_cls, file_name,
+                                         [v[:3] for v in p],
+                                         [v[3] for v in p]))
+    f.tre_list = read_tre(f.file_header, f.des_segment,
+                          [["xhdl", "xhdlofl", "xhd"],
+                           ["udhdl", "udhofl", "udhd"]], lazy=True)
+    if(not lazy):
+        for seg in f.segments():
+            seg.data
+    return f
+
+def _read_file(file_name, func, lazy):
+    '''Function run in the worker process for read_many.'''
+    if(func is not None):
+        return func(NitfFile(file_name, lazy=lazy))
+    return _read_file_parts(file_name)
+
+def _read_result(file_name, res, func, lazy):
+    '''Process the results from _read_file in this process.'''
+    if(func is not None):
+        return res
+    return _nitf_file_from_parts(file_name, res, lazy)
+
+def read_many(file_name_list, workers=None, lazy=True, func=None,
+              return_exceptions=False):
+    '''Read a list of NITF files, parsing the files in a pool of worker
+    processes (os.cpu_count() by default). This is a generator, returning
+    (file_name, NitfFile) for each file as soon as it has been read. Note
+    that this means the files aren't returned in the same order as
+    file_name_list.
+
+    The worker processes read and parse the file header, the file level
+    TREs, and the subheaders and TREs for each segment, so a bad file
+    is found there. Only the raw bytes of the file header and of each
+    subheader get passed back to this process, which is much cheaper
+    than pickling the parsed FieldStruct objects. The NitfFile we
+    create from these parses the file header right away, and a segment's
+    subheader the first time the segment is used, without going back to
+    the file. The segment data (e.g., the image) is read from the file
+    the first time it is used, like NitfFile with lazy=True. If lazy is
+    False, we read all the segments and their data before returning the
+    NitfFile.
+
+    If you only need some information from each file, you can instead
+    pass a function func, so even less needs to be done in this process
+    and passed back. This gets called in the worker process as
+    func(NitfFile(file_name, lazy=lazy)), and we return (file_name, result)
+    with what it returns. The result should be something small that
+    can be pickled, e.g., a dict of the field values you want. func needs
+    to be something that can be pickled, e.g., a function defined at the
+    top level of a module.
+
+    The workers use the default NitfSegmentHookSet and handle sets (e.g.,
+    NitfSegmentDataHandleSet.default_handle_set()), so any TRE classes or
+    handles you need should be registered when pynitf (or your module) is
+    imported. If func isn't given, after_read_hook is called in this
+    process, when a segment is first used.
+
+    If return_exceptions is True, a file we can't read returns
+    (file_name, exception). Otherwise the exception is raised.
+
+    You can pass workers=0 to read the files in this process, which can
+    be useful for debugging.'''
+    if(workers == 0):
+        for fname in file_name_list:
+            try:
+                res = _read_file(fname, func, lazy)
+            except Exception as ex:
+                if(not return_exceptions):
+                    raise
+                yield (fname, ex)
+                continue
+            yield (fname, _read_result(fname, res, func, lazy))
+        return
+    if(workers is None):
+        workers = os.cpu_count()
+    file_name_iter = iter(file_name_list)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as ex:
+        # Only keep a few files per worker in flight, so we don't have
+        # to hold the results for a long list of files in memory
+        running = {}
+        for fname in file_name_iter:
+            running[ex.submit(_read_file, fname, func, lazy)] = fname
+            if(len(running) >= 4 * workers):
+                break
+        while(len(running) > 0):
+            done, _ = concurrent.futures.wait(running,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                fname = running.pop(fut)
+                for fname2 in file_name_iter:
+                    running[ex.submit(_read_file, fname2, func, lazy)] = \
+                        fname2
+                    break
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    if(not return_exceptions):
+                        raise
+                    yield (fname, e)
+                    continue
+                yield (fname, _read_result(fname, res, func, lazy))
+
+__all__ = ["read_many", ]
@@ -6,6 +6,7 @@ from .nitf_text_subheader import NitfTextSubheader
 from .nitf_des_subheader import NitfDesSubheader
 from .nitf_graphic_subheader import NitfGraphicSubheader
 from .nitf_res_subheader import NitfResSubheader
+from .nitf_field import BufferReader, BufferWriter
 import io
 import weakref
 import copy
@@ -31,6 +32,9 @@ class NitfSegment(object):
     _update_file_header_field = (None, None)
     _type_support_tre = False
     _tre_field_list = None
+    # Set to (file_name, offset, seg_index) if the data should be read
+    # the first time it is used, see _read_data_later
+    _data_to_read = None
     def __init__(self, data=None, header_size=None, data_size=None,
                  nitf_file = None, security = None):
         self.data = data
@@ -57,6 +61,28 @@ class NitfSegment(object):
             self.nitf_file.segment_hook_set.after_init_hook(self,
                                                             self.nitf_file)
 
+    @property
+    def data(self):
+        '''The NitfData for the segment (e.g., the image).'''
+        if(self._data_to_read is not None):
+            file_name, offset, seg_index = self._data_to_read
+            self._data_to_read = None
+            with open(file_name, 'rb') as fh:
+                fh.seek(offset)
+                self._data = self._data_handle_set().read_from_file(self, fh, seg_index)
+        return self._data
+
+    @data.setter
+    def data(self, v):
+        self._data_to_read = None
+        self._data = v
+
+    def _read_data_later(self, file_name, offset, seg_index):
+        '''Read the data from the given offset in the file the first
+        time data is used, rather than now. This is used by read_many,
+        where the subheader is read in another process.'''
+        self._data_to_read = (file_name, offset, seg_index)
+
     def primary_key(self):
         '''NITF segments don't actually have a unique key. But in practice
         it sort of does. So for example iid1 for NitfImageSegment is often
@@ -146,11 +172,12 @@ class NitfSegment(object):
                 
         return self.subheader.summary() + res.getvalue()
 
-    def read_tre(self, des_list):
-        '''Read the TREs in a segment.'''
+    def read_tre(self, des_list, lazy=False):
+        '''Read the TREs in a segment. If lazy is True, the TRE fields are
+        converted when they are accessed (see read_tre_data).'''
         if(self._type_support_tre):
             self.tre_list = read_tre(self.subheader,des_list,
-                                     self._tre_field_list)
+                                     self._tre_field_list, lazy=lazy)
 
     def prepare_tre_write(self, seg_index, des_list):
         '''Process the TREs in a segment putting them in the various places
@@ -168,17 +195,46 @@ class NitfSegment(object):
         number. Most readers don't care at all about this, but it can be
         useful for implementing some external code readers (e.g., GDAL
         can read an image segment by the file name and index)'''
-        self.subheader.read_from_file(fh)
+        self._read_subheader(fh)
         self._read_user_subheader()
+        self.data = self._data_handle_set().read_from_file(self, fh, seg_index)
+
+    def _data_handle_set(self):
+        '''The NitfSegmentDataHandleSet to use for reading the data.'''
         if self.nitf_file:
-            hs = self.nitf_file.data_handle_set
-        else:
-            from .nitf_segment_data_handle import NitfSegmentDataHandleSet
-            hs = NitfSegmentDataHandleSet.default_handle_set()
-        self.data = hs.read_from_file(self, fh, seg_index)
+            return self.nitf_file.data_handle_set
+        from .nitf_segment_data_handle import NitfSegmentDataHandleSet
+        return NitfSegmentDataHandleSet.default_handle_set()
+
+    def _read_subheader(self, fh):
+        '''Read the subheader. If we know the header size, we read all
+        of the subheader at once and parse it with a BufferReader.'''
+        if(not self.header_size):
+            self.subheader.read_from_file(fh)
+            return
+        st = fh.tell()
+        buf = BufferReader(fh.read(self.header_size))
+        try:
+            self.subheader.read_from_file(buf)
+        except RuntimeError:
+            # Header size might be wrong, read the file the same way we
+            # would without the buffer so we get the same error (or
+            # maybe we can still read the data)
+            fh.seek(st)
+            self.subheader.read_from_file(fh)
+            return
+        # Leave fh after the subheader, even if the size was wrong
+        if(buf.pos != self.header_size):
+            fh.seek(st + buf.pos)
 
     def _update_file_header(self, fh, seg_index, sz_header, sz_data):
-        '''Update the NITF file header with the segment header and data size.'''
+        '''Update the NITF file header with the segment header and data size.
+
+        If NitfFile.write is holding the file header in memory, we update
+        it there rather than in the file.'''
+        hfh = getattr(self.nitf_file, "_file_header_fh", None)
+        if(hfh is not None):
+            fh = hfh
         self.nitf_file.file_header.update_field(fh,
               self._update_file_header_field[0], sz_header, (seg_index,))
         self.nitf_file.file_header.update_field(fh, 
@@ -195,18 +251,30 @@ class NitfSegment(object):
         if not cls:
             return
         self.user_subheader = cls()
-        fh = io.BytesIO(self.subheader.user_subheader_data)
+        fh = BufferReader(self.subheader.user_subheader_data)
         self.user_subheader.read_from_file(fh)
 
     def _write_user_subheader(self):
         '''Write user subheader to the segment subheader'''
         if(self.user_subheader):
-            fh = io.BytesIO()
+            fh = BufferWriter()
             self.user_subheader.write_to_file(fh)
             self.subheader.user_subheader_data = fh.getvalue()
         else:
             self.subheader.user_subheader_data = ""
 
+    def _write_subheader(self, fh):
+        '''Write the subheader (including any user subheader) to a file,
+        returning the size of the subheader.'''
+        start_pos = fh.tell()
+        if(self.nitf_file):
+            cls = self.nitf_file.user_subheader_handle_set.user_subheader_cls(self)
+            if cls and not isinstance(self.user_subheader, cls):
+                raise RuntimeError("Require user_subheader of type %s" % cls)
+        self._write_user_subheader()
+        self.subheader.write_to_file(fh)
+        return fh.tell() - start_pos
+
     def write_to_file(self, fh, seg_index):
         '''Write to a file. We also update the file header information in 
         the nitf_file passed in with the header and data size for this segment.
@@ -215,14 +283,7 @@ class NitfSegment(object):
         This isn't generally used in real code, but it can be useful for unit
         tests (so testing a segment writing w/o needing a full NitfFile in the
         test).'''
-        start_pos = fh.tell()
-        if(self.nitf_file):
-            cls = self.nitf_file.user_subheader_handle_set.user_subheader_cls(self)
-            if cls and not isinstance(self.user_subheader, cls):
-                raise RuntimeError("Require user_subheader of type %s" % cls)
-        self._write_user_subheader()
-        self.subheader.write_to_file(fh)
-        sz_header = fh.tell() - start_pos
+        sz_header = self._write_subheader(fh)
         start_pos = fh.tell()
 
         try:
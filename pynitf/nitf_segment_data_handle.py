@@ -6,6 +6,7 @@ from .nitf_text_subheader import NitfTextSubheader
 from .nitf_graphic_subheader import NitfGraphicSubheader
 from .nitf_res_subheader import NitfResSubheader
 from .nitf_diff_handle import (NitfDiffHandle, NitfDiffHandleSet)
+from .nitf_field import BufferWriter
 from .priority_handle_set import PriorityHandleSet
 import abc
 import io
@@ -90,9 +91,13 @@ class NitfData(object, metaclass=abc.ABCMeta):
         '''Return the size of the user subheader. This can be used to
         make sure we aren't exceeding the size supported by desshl'''
         if(self.user_subheader):
-            fh = io.BytesIO()
+            # Use the size from the fields if the user subheader doesn't
+            # have any special handling when it is written
+            if(self.user_subheader._has_values_only()):
+                return self.user_subheader.serialized_size()
+            fh = BufferWriter()
             self.user_subheader.write_to_file(fh)
-            return len(fh.getvalue())
+            return len(fh.data)
         else:
             return 0
     
@@ -109,6 +114,14 @@ class NitfData(object, metaclass=abc.ABCMeta):
     def write_to_file(self, fh):
         '''Write data to the given file handle.'''
         raise NotImplementedError
+
+    def write_size(self):
+        '''Return the number of bytes write_to_file will write, or None
+        if we don't know this without actually writing the data. This
+        is used by NitfFile.write_stream so it can fill in the file
+        header before writing the data. The default is None, derived
+        classes should override this if the size is cheap to determine.'''
+        return None
                 
     @property
     def security(self):
@@ -208,6 +221,9 @@ class NitfGraphicRaw(NitfGraphic):
     def write_to_file(self, fh):
         fh.write(self.graphic_data)
 
+    def write_size(self):
+        return len(self.graphic_data)
+
 class NitfResRaw(NitfRes):
     '''A simple writer. Really just meant for testing, since we don'
     have anything "real" that reads or writes reserve data.'''
@@ -225,6 +241,9 @@ class NitfResRaw(NitfRes):
     def write_to_file(self, fh):
         fh.write(self.res_data)
 
+    def write_size(self):
+        return len(self.res_data)
+
 class NitfDataPlaceHolder(NitfData):
     '''Implementation that doesn't actually read any data, useful as a
     final place holder if none of our other NitfData classes can handle
@@ -46,6 +46,9 @@ class NitfTextStr(NitfText):
     def write_to_file(self, fh):
         fh.write(self.string_as_bytes)
 
+    def write_size(self):
+        return len(self.string_as_bytes)
+
 class TextStrDiff(NitfDiffHandle):
     '''Compare two NitfTextStr'''
     def configuration(self, nitf_diff):
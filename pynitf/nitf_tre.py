@@ -4,7 +4,8 @@
 # from word to Excel. For some reason, you can't go directly to Excel. You
 # can then cut and paste from excel to emacs
 
-from .nitf_field import FieldStruct, FieldStructDiff
+from .nitf_field import (FieldStruct, FieldStructDiff, BufferReader,
+                          BufferWriter)
 from .nitf_diff_handle import NitfDiffHandle, NitfDiffHandleSet
 import copy
 import io
@@ -32,7 +33,15 @@ class Tre(FieldStruct):
     def cetag_value(self):
         return self.tre_tag
     def cel_value(self):
+        if(self._size_from_fields()):
+            return self.serialized_size()
         return len(self.tre_bytes())
+    def _size_from_fields(self):
+        '''True if we can get the size of the TRE from the fields (see
+        FieldStruct.serialized_size), without generating the bytes.'''
+        return (not self.tre_implementation_field and
+                type(self).tre_bytes is Tre.tre_bytes and
+                type(self).write_to_file is Tre.write_to_file)
     def tre_bytes(self):
         '''All of the TRE expect for the front two cetag and cel fields'''
         if(self.tre_implementation_field):
@@ -41,7 +50,7 @@ class Tre(FieldStruct):
                 return t
             return t.encode("utf-8")
         else:
-            fh = io.BytesIO()
+            fh = BufferWriter()
             super().write_to_file(fh)
             return fh.getvalue()
     def read_from_tre_bytes(self, bt, nitf_literal=False):
@@ -52,10 +61,10 @@ class Tre(FieldStruct):
             setattr(self, self.tre_implementation_field, self.tre_implementation_class.read_tre_string(t))
             self.update_raw_field()
         else:
-            fh = io.BytesIO(bt)
+            fh = BufferReader(bt)
             super().read_from_file(fh, nitf_literal=nitf_literal)
 
-    def read_from_file(self, fh, delayed_read=False):
+    def read_from_file(self, fh, delayed_read=False, lazy=False):
         tag = fh.read(6).rstrip().decode("utf-8")
         if(tag != self.tre_tag):
             raise RuntimeError("Expected TRE %s but got %s" % (self.tre_tag, tag))
@@ -64,13 +73,18 @@ class Tre(FieldStruct):
             self.read_from_tre_bytes(fh.read(cel))
         else:
             st = fh.tell()
-            super().read_from_file(fh, delayed_read=delayed_read)
+            super().read_from_file(fh, delayed_read=delayed_read, lazy=lazy)
             if(delayed_read):
                 fh.seek(cel, 1)
             sz = fh.tell() - st
             if(sz != cel):
                 raise RuntimeError("TRE length was expected to be %d but was actually %d" % (cel, sz))
     def write_to_file(self, fh):
+        if(isinstance(fh, BufferWriter) and fh.pos == len(fh.data) and
+           not self.tre_implementation_field and
+           type(self).tre_bytes is Tre.tre_bytes):
+            self._write_to_buffer(fh)
+            return
         fh.write("{:6s}".format(self.cetag_value()).encode("utf-8"))
         t = self.tre_bytes()
         v = len(t)
@@ -78,6 +92,25 @@ class Tre(FieldStruct):
             raise RuntimeError("TRE string is too long at size %d" % v)
         fh.write("{:0>5d}".format(v).encode("utf-8"))
         fh.write(t)
+    def _write_to_buffer(self, fh):
+        '''Write the TRE directly to the end of a BufferWriter, and then
+        fill in the length. This avoids generating the TRE bytes
+        separately just to find the length.'''
+        st = fh.pos
+        fh.write("{:6s}".format(self.cetag_value()).encode("utf-8"))
+        fh.write(b"00000")
+        try:
+            super().write_to_file(fh)
+            v = fh.pos - st - 11
+            if(v > 99999):
+                raise RuntimeError("TRE string is too long at size %d" % v)
+        except Exception:
+            # Don't leave a partial TRE in the buffer
+            del fh.data[st:]
+            fh.pos = st
+            raise
+        fh.data[(st + 6):(st + 11)] = b"%05d" % v
+
     def str_hook(self, fh):
         '''Convenient to have a place to add stuff in __str__ for derived
         classes. This gets called after the TRE name is written, but before
@@ -104,8 +137,16 @@ class Tre(FieldStruct):
     
     def update_raw_field(self):
         '''Update the raw fields after a change to tre_implementation_field'''
-        fh = io.BytesIO(self.tre_bytes())
+        fh = BufferReader(self.tre_bytes())
         super().read_from_file(fh, delayed_read=True)
+
+    def _has_values_only(self):
+        # The object in tre_implementation_field gets created by reading
+        # the TRE, so we need to copy and pickle the bytes
+        return (not self.tre_implementation_field and
+                super()._has_values_only())
+        
+FieldStruct._values_only_io.update((Tre.read_from_file, Tre.write_to_file))
         
 class TreUnknown(Tre):
     '''The is a general class to handle TREs that we don't have another 
@@ -117,8 +158,8 @@ class TreUnknown(Tre):
     def cetag_value(self):
         return self.tre_tag
     def cel_value(self):
-        return len(self.tre_bytes())
-    def read_from_file(self, fh):
+        return len(self.tre_bytes)
+    def read_from_file(self, fh, delayed_read=False, lazy=False):
         self.tre_tag = fh.read(6).rstrip().decode("utf-8")
         cel = int(fh.read(5))
         self.tre_bytes = fh.read(cel)
@@ -160,7 +201,7 @@ class TreTagToCls(object):
 
 tre_tag_to_cls = TreTagToCls()        
 
-def read_tre(header, des_list, field_list = []):
+def read_tre(header, des_list, field_list = [], lazy = False):
     '''This reads a TRE for a particular type of header (e.g., NitfFileHeader,
     NitfImageSubheader). The reading is complicated. There are one or
     more base field names to check, each has three fields,
@@ -168,7 +209,10 @@ def read_tre(header, des_list, field_list = []):
     Each of these fields may or may not have TRE data. In addition, there
     is an "overflow" indicator which points to a TRE_OVERFLOW DES to read 
     additional TREs. This function processes through this logic and 
-    reads all the TREs, returning a (possibly empty) list of TREs.'''
+    reads all the TREs, returning a (possibly empty) list of TREs.
+
+    If lazy is True, the TRE fields are converted when they are accessed
+    (see read_tre_data).'''
     tre_list = []
     for h_len, h_ofl, h_data in field_list:
         if(getattr(header, h_len) > 0):
@@ -176,9 +220,9 @@ def read_tre(header, des_list, field_list = []):
             if(des_index > 0):
                 # des_index is 1 based, so subtract 1 to get the des
                 desseg = des_list[getattr(header, h_ofl)-1]
-                t = read_tre_data(desseg.des.data)
+                t = read_tre_data(desseg.des.data, lazy=lazy)
                 tre_list.extend(t)
-            t = read_tre_data(getattr(header, h_data))
+            t = read_tre_data(getattr(header, h_data), lazy=lazy)
             tre_list.extend(t)
     return tre_list
 
@@ -191,20 +235,28 @@ def prepare_tre_write(tre_list, header, des_list, field_list = [],
     The seg_index should be the normal 0 based index used in python for
     lists. We internally translate this too and from the 1 based indexing
     used in the NITF file.'''
-    head_fh = [io.BytesIO() for i in range(len(field_list))]
-    des_fh = io.BytesIO()
+    head_fh = [BufferWriter() for i in range(len(field_list))]
+    des_fh = BufferWriter()
     for tre in tre_list:
-        fht = io.BytesIO()
-        tre.write_to_file(fht)
-        t = fht.getvalue()
-        wrote = False
-        for fh in head_fh:
-            if(len(fh.getvalue()) + len(t) < 99999-3):
-                fh.write(t)
-                wrote = True
+        # If we know the size, we can write the TRE directly to where it
+        # goes. Otherwise write it out to find the size.
+        if(isinstance(tre, Tre) and tre._size_from_fields()):
+            t = None
+            sz = 11 + tre.cel_value()
+        else:
+            fht = BufferWriter()
+            tre.write_to_file(fht)
+            t = fht.data
+            sz = len(t)
+        fh = des_fh
+        for fhh in head_fh:
+            if(len(fhh.data) + sz < 99999-3):
+                fh = fhh
                 break
-        if(not wrote):
-            des_fh.write(t)
+        if(t is None):
+            tre.write_to_file(fh)
+        else:
+            fh.write(t)
     for i in range(len(field_list)):
         h_len, h_offl, h_data = field_list[i]
         if(getattr(header, h_len) > 0):
@@ -212,9 +264,13 @@ def prepare_tre_write(tre_list, header, des_list, field_list = [],
             # from earlier write. We recreate these, so we don't want
             # them
             setattr(header, h_offl, 0)
-        if(len(head_fh[i].getvalue()) > 0):
+        if(len(head_fh[i].data) > 0):
             setattr(header, h_data, head_fh[i].getvalue())
-    if(len(des_fh.getvalue()) > 0):
+        elif(getattr(header, h_len) > 0):
+            # Clear out TREs that have been removed since an earlier
+            # read or write
+            setattr(header, h_data, b'')
+    if(len(des_fh.data) > 0):
         # We have a circular dependency. It is actually real, and isn't
         # something we particularly need to break. Instead, work around by
         # delaying the import
@@ -230,9 +286,14 @@ def prepare_tre_write(tre_list, header, des_list, field_list = [],
         des_list.append(desseg)
         setattr(header, h_offl, len(des_list))
     
-def read_tre_data(data):
-    '''Read a blob of data, and translate into a series of TREs'''
-    fh = io.BytesIO(data)
+def read_tre_data(data, lazy=False):
+    '''Read a blob of data, and translate into a series of TREs.
+
+    If lazy is True, the TRE fields are only converted when they are
+    accessed (see FieldStruct.read_from_file). Note that this means
+    a TRE with a badly formatted field doesn't get read as a TreUnknown,
+    instead we get an error when we access the field.'''
+    fh = BufferReader(data)
     res = []
     while True:
         st = fh.tell()
@@ -244,7 +305,10 @@ def read_tre_data(data):
         try:
             fh.seek(st)
             t = tre_tag_to_cls.tre_object(tre_name)
-            t.read_from_file(fh)
+            if(lazy):
+                t.read_from_file(fh, lazy=True)
+            else:
+                t.read_from_file(fh)
             res.append(t)
         except Exception as e:
             warnings.warn("Trouble reading TRE " + tre_name.decode("utf-8") +
@@ -74,7 +74,7 @@ class TreILLUMA(Tre):
             if (n is not None):
                 setattr(self, attribute_name, float(n.text))
 
-    def read_from_file(self, fh, delayed_read=False):
+    def read_from_file(self, fh, delayed_read=False, lazy=False):
         tag = fh.read(6).rstrip().decode("utf-8")
         if (tag != self.tre_tag):
             raise RuntimeError("Expected TRE %s but got %s" % (self.tre_tag, tag))
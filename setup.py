@@ -12,7 +12,7 @@ setup(name='pynitf',
       license='Copyright 2020, California Institute of Technology. ALL RIGHTS RESERVED. U.S. Government Sponsorship acknowledged.',
       packages=['pynitf'],
       scripts=["bin/nitf_diff", "bin/nitf_info", "bin/nitf_json_delta",
-               "bin/explore_nitf"],
+               "bin/explore_nitf", "bin/nitf_catalog"],
       install_requires=[
           'numpy',
           'docopt'
@@ -0,0 +1,72 @@
+from pynitf.nitf_catalog import *
+from pynitf.nitf_file import NitfFile
+from pynitf_test_support import *
+import os
+
+def create_file(fname, iid1, idatim = "20160101120000", angle_to_north = 270):
+    f = NitfFile()
+    iseg = create_image_seg(f, iid1 = iid1)
+    iseg.subheader.idatim = idatim
+    iseg.subheader.geolo_corner = ("D", [[-118.2, 34.3], [-118.1, 34.3],
+                                         [-118.1, 34.2], [-118.2, 34.2]],
+                                   None)
+    create_tre(f.image_segment[0], angle_to_north)
+    create_image_seg(f, iid1 = "Other")
+    f.write(fname)
+
+def test_nitf_catalog(isolated_dir):
+    os.mkdir("data")
+    os.mkdir("data/sub")
+    create_file("data/a.ntf", "Img A")
+    create_file("data/sub/b.NTF", "Img B", idatim = "20200315000000",
+                angle_to_north = 290)
+    with open("data/sub/bad.ntf", "wb") as fh:
+        fh.write(b"not a nitf file")
+    with open("data/readme.txt", "w") as fh:
+        fh.write("not in the catalog")
+    a = os.path.abspath("data/a.ntf")
+    b = os.path.abspath("data/sub/b.NTF")
+    bad = os.path.abspath("data/sub/bad.ntf")
+    with NitfCatalog("catalog.db",
+                     tre_fields = ["USE00A.angle_to_north"]) as cat:
+        assert cat.build(["data"], workers = 0) == 3
+        assert len(cat) == 3
+        assert cat.errors()[0][0] == bad
+        assert cat.query() == [a, b]
+        assert cat.query(iid1 = "Img*") == [a, b]
+        assert cat.query(iid1 = "Img B") == [b]
+        assert cat.query(after = "2019") == [b]
+        assert cat.query(before = "20200101") == [a, b]
+        assert cat.query(iid1 = "Img*", before = "20200101") == [a]
+        assert cat.query(bbox = (-118.15, 34.0, -117, 35)) == [a, b]
+        assert cat.query(bbox = (-117, 34.0, -116, 35)) == []
+        assert cat.query(tre = {"USE00A.angle_to_north" : 290}) == [b]
+        assert cat.query(tre = {"USE00A.angle_to_north" : "290"}) == [b]
+        # The TRE is only on the first image
+        assert cat.query(iid1 = "Other",
+                         tre = {"USE00A.angle_to_north" : 290}) == []
+        assert cat.query(where = "image.nrows = ? and file.numi = ?",
+                         params = (9, 2)) == [a, b]
+        # Nothing has changed, so nothing is reread
+        assert cat.build(["data"], workers = 0) == 0
+    # Update a file, add a new one, and remove one
+    st = os.stat("data/a.ntf")
+    create_file("data/a.ntf", "Img C", angle_to_north = 290)
+    # The file is the same size, so make sure the mtime changes even with
+    # a coarse file system time resolution
+    os.utime("data/a.ntf", ns = (st.st_atime_ns,
+                                 st.st_mtime_ns + 2 * 10**9))
+    create_file("data/c.nitf", "Img D")
+    os.remove("data/sub/bad.ntf")
+    with NitfCatalog("catalog.db") as cat:
+        assert cat.tre_fields == ["USE00A.angle_to_north"]
+        assert cat.build(["data"], workers = 2) == 2
+        c = os.path.abspath("data/c.nitf")
+        assert cat.query() == [a, c, b]
+        assert cat.errors() == []
+        assert cat.query(iid1 = "Img A") == []
+        assert cat.query(tre = {"USE00A.angle_to_north" : 290}) == [a, b]
+    # Changing the TRE fields rereads everything
+    with NitfCatalog("catalog.db", tre_fields = []) as cat:
+        assert cat.build(["data"], workers = 0) == 3
+        assert cat.query(tre = {"USE00A.angle_to_north" : 290}) == []
@@ -31,6 +31,12 @@ def test_content_header():
     if(False):
         print(h.bytes())
     assert h.bytes() == b'Content-Type: ct\r\nContent-Use: \r\nContent-Length: 10\r\nContent-Description: blah blah\r\nContent-Disposition: caw caw\r\nCanonical-ID: cid\r\nDES-ID1: foo\r\nDES-ID2: this is a foo\r\n'
+    # write_to_file fills in content_headers, so serialized_size needs
+    # to include that
+    sz = h.serialized_size()
+    fh = io.BytesIO()
+    h.write_to_file(fh)
+    assert sz == len(fh.getvalue())
     h2 = DesEXT_DEF_CONTENT.uh_class()
     h2.content_headers = h.bytes()
     h2.parse()
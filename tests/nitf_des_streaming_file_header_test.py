@@ -0,0 +1,119 @@
+from pynitf.nitf_des_streaming_file_header import *
+from pynitf.nitf_file import NitfFile, NitfDesSegment
+from pynitf.nitf_file_header import NitfFileHeader
+from pynitf_test_support import *
+import io
+import filecmp
+
+def test_des_streaming_file_header_basic():
+    h = NitfFileHeader()
+    h.ftitle = "Replacement header"
+    h.numi = 1
+    h.lish[0] = 439
+    h.li[0] = 90
+    d = DesStreamingFileHeader()
+    d.file_header = h
+    fh = io.BytesIO()
+    dseg = NitfDesSegment(d)
+    hs, ds = dseg.write_to_file(fh, 0)
+    assert ds == d.sfh_l1 + 22
+    fh2 = io.BytesIO(fh.getvalue())
+    dseg2 = NitfDesSegment(header_size=hs, data_size=ds)
+    dseg2.read_from_file(fh2)
+    d2 = dseg2.des
+    assert isinstance(d2, DesStreamingFileHeader)
+    assert d2.sfh_l1 == d2.sfh_l2
+    assert d2.sfh_delim1 == b'\x0a\x6e\x1d\x97'
+    assert d2.sfh_delim2 == b'\x0e\xca\x14\xbf'
+    h2 = d2.file_header
+    assert h2.ftitle == "Replacement header"
+    assert h2.numi == 1
+    assert h2.lish[0] == 439
+    assert h2.li[0] == 90
+    print(d2.summary())
+
+def create_streaming_file(fname, fname_normal):
+    '''Create a streaming NITF file. We write a normal file, and then
+    add a STREAMING_FILE_HEADER DES with the file header at the end. In
+    the file header at the start of the file we replace fl and a couple
+    of the segment lengths with 9s.'''
+    f = NitfFile()
+    create_image_seg(f, iid1 = "Image 1")
+    create_image_seg(f, iid1 = "Image 2", row_offset = 20)
+    create_tre(f)
+    create_tre(f.image_segment[1], 290)
+    create_text_segment(f)
+    create_des(f)
+    f.write(fname_normal)
+    h = NitfFile(fname_normal).file_header
+    with open(fname_normal, "rb") as fin:
+        d = fin.read()[h.hl:]
+    # The DES size only depends on the length of the file header, so we
+    # can get it before we fill in the file header values.
+    h.numdes = h.numdes + 1
+    sfh = DesStreamingFileHeader()
+    sfh.file_header = h
+    fh = io.BytesIO()
+    hs, ds = NitfDesSegment(sfh).write_to_file(fh, 0)
+    h.ldsh[h.numdes - 1] = hs
+    h.ld[h.numdes - 1] = ds
+    h.hl = h.serialized_size()
+    h.fl = h.hl + len(d) + hs + ds
+    sfh.file_header = h
+    fh = io.BytesIO()
+    NitfDesSegment(sfh).write_to_file(fh, 0)
+    sfh_seg = fh.getvalue()
+    fh = io.BytesIO()
+    h.write_to_file(fh)
+    with open(fname_normal, "wb") as fout:
+        fout.write(fh.getvalue())
+        fout.write(d)
+        fout.write(sfh_seg)
+    h.fl = 999999999999
+    h.li[1] = 9999999999
+    h.ld[1] = 999999999
+    fh = io.BytesIO()
+    h.write_to_file(fh)
+    with open(fname, "wb") as fout:
+        fout.write(fh.getvalue())
+        fout.write(d)
+        fout.write(sfh_seg)
+
+def test_read_streaming(isolated_dir):
+    create_streaming_file("streaming.ntf", "normal.ntf")
+    fn = NitfFile("normal.ntf")
+    f = NitfFile("streaming.ntf")
+    assert f.file_header.fl != 999999999999
+    assert f.file_header.li[1] == 90
+    assert len(f.image_segment) == 2
+    assert f.image_segment[1].iid1 == "Image 2"
+    assert f.image_segment[1].data[0, 8, 9] == 8 * 20 + 9
+    assert len(f.des_segment) == 2
+    assert isinstance(f.des_segment[1].des, DesStreamingFileHeader)
+    assert str(f) == str(fn)
+    flazy = NitfFile("streaming.ntf", lazy=True)
+    assert flazy.image_segment[1].data[0, 8, 9] == 8 * 20 + 9
+    assert str(flazy) == str(fn)
+    iseg = NitfFile.open_segment("streaming.ntf", "image", 1)
+    assert iseg.data[0, 8, 9] == 8 * 20 + 9
+    # Writing gives a normal file, without the STREAMING_FILE_HEADER DES
+    f.write("z.ntf")
+    f2 = NitfFile("z.ntf")
+    assert len(f2.des_segment) == 1
+    assert f2.image_segment[1].iid1 == "Image 2"
+
+def test_convert_streaming(isolated_dir):
+    create_streaming_file("streaming.ntf", "normal.ntf")
+    convert_streaming_file("streaming.ntf", "z.ntf", chunk_size = 100)
+    f = NitfFile("streaming.ntf")
+    f.write("z2.ntf")
+    assert filecmp.cmp("z.ntf", "z2.ntf", shallow=False)
+    with pytest.raises(RuntimeError):
+        convert_streaming_file("normal.ntf", "z3.ntf")
+    # Not a valid streaming file
+    with open("streaming.ntf", "rb") as fin:
+        d = fin.read()
+    with open("bad.ntf", "wb") as fout:
+        fout.write(d[:-10])
+    with pytest.raises(RuntimeError):
+        NitfFile("bad.ntf")
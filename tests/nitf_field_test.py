@@ -8,6 +8,9 @@ from pynitf_test_support import *
 import copy
 import logging
 import struct
+import pickle
+import numpy as np
+import numpy.testing as npt
 
 @pytest.fixture(scope="function")
 def nitf_diff_field_struct(print_logging):
@@ -28,7 +31,36 @@ def test_float_to_fixed_width():
         for i in range(-7,7):
             print(float_to_fixed_width(pow(10,i), 7))
 
-            
+def test_float_to_fixed_width_search():
+    '''Check that we get the same results as trying each precision in
+    turn, including values where rounding carries into another digit.'''
+    def search(n, max_width):
+        for i in range(max_width - 2, -1, -1):
+            s = '{:.{}f}'.format(n, i)
+            if len(s) <= max_width:
+                return s
+        return None
+    vals = [0.0, -0.0, 0.5, -0.5, 9.5, 99.99999, -9.9999999999, 1e15, 1e20,
+            float("inf"), float("nan"), 5, -7]
+    for k in range(-12, 18):
+        for d in (1, 1.5, 9.5, 9.9995, 9.99999999, 0.9999999999):
+            vals.extend([d * 10 ** k, -d * 10 ** k])
+    rng = np.random.default_rng(1)
+    vals.extend((rng.uniform(-1, 1, 1000) *
+                 10.0 ** rng.integers(-10, 15, 1000)).tolist())
+    for max_width in (2, 3, 7, 12, 21):
+        expect = [search(v, max_width) for v in vals]
+        for v, e in zip(vals, expect):
+            if(e is None):
+                with pytest.raises(RuntimeError):
+                    float_to_fixed_width(v, max_width)
+            else:
+                assert float_to_fixed_width(v, max_width) == e
+        fit = [v for v, e in zip(vals, expect) if e is not None]
+        assert (float_to_fixed_width_array(fit, max_width) ==
+                [e for e in expect if e is not None])
+
+
 def test_nitf_field_basic_str():
     '''Basic str type test for NitfField'''
     f = NitfField(None, "foo", 4, str, None, {})
@@ -789,6 +821,717 @@ def test_loop_conditional(nitf_diff_field_struct):
     assert d.compare_obj(t, t2) == True
     t2.udhofl[2] = 50
     assert d.compare_obj(t, t2) == False
-    
+
+def test_loop_diff_array(caplog):
+    '''Test comparing loops with numpy, and limiting the number of
+    element differences listed.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["num", "", 5, int],
+                [["loop", "f.num"],
+                 ['ival', "", 6, int],
+                 ['fval', "", 12, float],
+                 ['oval', "", 6, int, {"optional" : True}]]]
+    class TestDiff(FieldStructDiff):
+        def __init__(self, config):
+            super().__init__()
+            self.config = config
+        def configuration(self, nitf_diff):
+            return self.config
+    def compare(t1, t2, config = {}):
+        d = NitfDiff()
+        d.handle_set.clear()
+        d.handle_set.add_handle(TestDiff(config), priority_order = 1)
+        d.handle_set.add_handle(AlwaysTrueHandle(), priority_order = 0)
+        caplog.clear()
+        with d.diff_context("Field Structure"):
+            return d.compare_obj(t1, t2)
+    t = TestFieldStruct()
+    t.num = 100
+    for i in range(t.num):
+        t.ival[i] = i
+        t.fval[i] = i * 0.5
+        t.oval[i] = i if i % 2 else None
+    t2 = copy.deepcopy(t)
+    with caplog.at_level(logging.INFO, logger="nitf_diff"):
+        assert compare(t, t2) == True
+        for i in range(0, 100, 5):
+            t2.ival[i] = 1000 + i
+            t2.oval[i + 1] = None
+        t2.fval[3] = 1.5001
+        assert compare(t, t2) == False
+        assert "ival: array had 20 of 100 different" in caplog.text
+        assert "oval: array had 10 of 100 different" in caplog.text
+        assert "fval: array had 1 of 100 different" in caplog.text
+        assert "ival[0]: 0 != 1000" in caplog.text
+        assert "ival[45]: 45 != 1045" in caplog.text
+        assert "ival[50]" not in caplog.text
+        assert "ival: 10 more differences not listed" in caplog.text
+        assert "oval[91]: 91 != None" in caplog.text
+        assert "oval: 0 more" not in caplog.text
+        assert compare(t, t2, {"max_detail" : 2,
+                               "abs_tol" : {"fval" : 1e-3}}) == False
+        assert "ival[5]: 5 != 1005" in caplog.text
+        assert "ival[10]" not in caplog.text
+        assert "ival: 18 more differences not listed" in caplog.text
+        assert "fval" not in caplog.text
+        # Should be the same as math.isclose
+        t2 = copy.deepcopy(t)
+        t2.fval[3] = 1.5 * (1 + 1e-10)
+        t2.fval[4] = 2.0 * (1 + 1e-8)
+        assert compare(t, t2) == False
+        assert "fval: array had 1 of 100 different" in caplog.text
+        assert "fval[4]" in caplog.text
+
 # TODO Add a test like Walt had where we override the equality function
 # for a field to match ignoring case
+
+def test_compiled_expression():
+    '''Size, condition and loop expressions are compiled once and reused'''
+    from pynitf.nitf_field import _compile_expr, _compile_assign
+    class TestFieldStruct(FieldStruct):
+        desc = [["numi", "", 3, int],
+                [["loop", "f.numi"],
+                 ["len", "", 2, int],
+                 ["data", "", "f.len[i1]", None,
+                  {'field_value_class' : BytesFieldData}],
+                 ["flag", "", 1, str, {"condition" : "f.len[i1] > 2"}]]]
+    t = TestFieldStruct()
+    t2 = TestFieldStruct()
+    assert t.field["data"]._size_func is t2.field["data"]._size_func
+    assert _compile_expr("f.len[i1]") is t.field["data"]._size_func
+    assert _compile_assign("f.len[i1]") is _compile_assign("f.len[i1]")
+    t.numi = 2
+    t.data[0] = b"ab"
+    t.data[1] = b"abcd"
+    t.flag[1] = "Y"
+    assert list(t.len) == [2, 4]
+    assert list(t.flag) == [None, "Y"]
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    assert fh.getvalue() == b'00202ab04abcdY'
+    t2.read_from_file(io.BytesIO(fh.getvalue()))
+    assert list(t2.data) == [b"ab", b"abcd"]
+    assert list(t2.flag) == [None, "Y"]
+
+def test_field_struct_codegen():
+    '''Check that the generated read and write functions match the
+    interpreted NitfLoop code.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["fhdr", "", 4, str, {"default" : "NITF"}],
+                ["numi", "", 3, int],
+                [None, None, 2, str],
+                [["loop", "f.numi"],
+                 ["opt", "", 4, int, {"optional" : True,
+                                      "optional_char" : "-"}],
+                 ["numj", "", 3, int],
+                 [["loop", "f.numj[i1]"],
+                  ["flt", "", 8, float],
+                  ["flag", "", 1, str, {"condition" : "f.flt[i1,i2] > 1"}]]],
+                ["dlen", "", 3, int],
+                ["data", "", "f.dlen", None,
+                 {'field_value_class' : BytesFieldData, 'size_offset' : 1}]]
+    t = TestFieldStruct()
+    assert t._codegen() is TestFieldStruct._field_struct_schema.codegen
+    t.numi = 2
+    t.opt[0] = 10
+    t.opt[1] = None
+    t.numj[0] = 1
+    t.numj[1] = 2
+    t.flt[0,0] = 1.5
+    t.flag[0,0] = "Y"
+    t.flt[1,1] = 0.5
+    t.data = b"hello"
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    fh2 = io.BytesIO()
+    t.pseudo_outer_loop.write_to_file(t, fh2)
+    assert fh.getvalue() == fh2.getvalue()
+    assert fh.getvalue() == b'NITF002  0010001' + b'1.500000Y' + \
+        b'----002' + b'0.000000' + b'0.500000' + b'006hello'
+    t2 = TestFieldStruct()
+    t2.read_from_file(io.BytesIO(fh.getvalue()))
+    t3 = TestFieldStruct()
+    t3.pseudo_outer_loop.read_from_file(t3, io.BytesIO(fh.getvalue()))
+    assert list(t2.items()) == list(t3.items())
+    assert list(t2.items()) == [('fhdr', 'NITF'), ('numi', 2),
+                                ('opt', [10, None]), ('numj', [1, 2]),
+                                ('flt', [[1.5], [0.0, 0.5]]),
+                                ('flag', [['Y'], [None, None]]),
+                                ('dlen', 6), ('data', b'hello')]
+    assert t2.get_raw_bytes("opt", (1,)) == b'----'
+    with pytest.raises(RuntimeError):
+        t2.read_from_file(io.BytesIO(fh.getvalue()[:-2]))
+
+def test_field_struct_fixed_run():
+    '''Check handling of runs of fixed width fields, which are read
+    and written all at once.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["fhdr", "", 4, str, {"default" : "NITF"}],
+                ["clevel", "", 2, int],
+                [None, None, 2, str],
+                ["flt", "", 8, float],
+                ["flag", "", 1, str, {"condition" : "f.clevel > 1"}],
+                ["numi", "", 3, int]]
+    t = TestFieldStruct()
+    g = t._codegen()
+    assert g.read_source.count(" = read(") == 3
+    assert g.write_source.count(" write(") == 3
+    t.clevel = 3
+    t.flt = 1.5
+    t.flag = "Y"
+    t.numi = 7
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    assert fh.getvalue() == b'NITF03  1.500000Y007'
+    t2 = TestFieldStruct()
+    t2.read_from_file(io.BytesIO(fh.getvalue()))
+    assert list(t2.items()) == list(t.items())
+    assert t2.get_raw_bytes("flt") == b'1.500000'
+    # File locations are still tracked for each field
+    assert t.field["flt"].fh_loc[()] == 8
+    with pytest.raises(RuntimeError) as e:
+        t2.read_from_file(io.BytesIO(fh.getvalue()[:10]))
+    assert "8 bytes for field flt" in str(e.value)
+
+def test_field_struct_schema():
+    '''Check that the description is shared between objects of the same
+    class, but the values aren't.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["numi", "", 3, int],
+                [["loop", "f.numi"],
+                 ["flt", "", 8, float, {"frmt" : lambda v: "%08.3f" % v}],
+                 ["flag", "", 1, str, {"condition" : "f.flt[i1] > 1"}]]]
+    t1 = TestFieldStruct()
+    t2 = TestFieldStruct()
+    assert t1.pseudo_outer_loop is t2.pseudo_outer_loop
+    assert type(t1.field["flt"]) is type(t2.field["flt"])
+    assert isinstance(t1.field["flt"], NitfField)
+    t1.numi = 2
+    t1.flt[0] = 1.5
+    t1.flag[0] = "Y"
+    t1.flt[1] = 0.5
+    assert t2.numi == 0
+    assert t1.field["flt"].shape(()) == 2
+    assert t1.field["flt"].to_list() == [1.5, 0.5]
+    fh = io.BytesIO()
+    t1.write_to_file(fh)
+    assert fh.getvalue() == b'0020001.500Y0000.500'
+    t2.read_from_file(io.BytesIO(fh.getvalue()))
+    assert list(t2.items()) == list(t1.items())
+    assert NitfField.is_shape_equal(t1.field["flag"], t2.field["flag"])
+    # Values can be pickled now, no lambdas in them
+    t3 = pickle.loads(pickle.dumps(t1.field["flag"].value_dict))
+    assert t3 == {(0,): "Y"}
+    assert t3[(1,)] == ""
+
+def test_field_as_array():
+    '''Test storing looped numeric fields as numpy arrays.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["n", "", 2, int],
+                ["m", "", 1, int],
+                [["loop", "f.n"],
+                 ["x", "", 12, float, {"frmt" : "%12.4f"}],
+                 ["k", "", 3, int],
+                 ["dt", "", 2, None, {'field_value_class' : IntFieldData,
+                                      'size_not_updated' : True}],
+                 [["loop", "f.m"],
+                  ["c", "", 6, float]]],
+                [["loop", "f.n"],
+                 ["nv", "", 1, int],
+                 [["loop", "f.nv[i1]"],
+                  ["v", "", 1, int]]]]
+    t = TestFieldStruct()
+    t.n = 3
+    t.m = 2
+    t.x.set_array([1.5, 2.5, 3.5])
+    a = t.k.as_array()
+    # Change values through the array
+    a[:] = [7, 8, 9]
+    t.dt.set_array([10, 11, 12])
+    t.c.set_array(np.arange(6).reshape(3,2) * 0.5)
+    assert t.x[1] == 2.5
+    assert t.k[2] == 9
+    assert t.c[2,1] == 2.5
+    assert t.k.as_array() is a
+    for i in range(3):
+        t.nv[i] = i
+    with pytest.raises(RuntimeError):
+        t.v.as_array()
+    with pytest.raises(RuntimeError):
+        t.x.set_array([1.0, 2.0])
+    with pytest.raises(RuntimeError):
+        t.field["n"].as_array()
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    t2 = TestFieldStruct()
+    t2.read_from_file(io.BytesIO(fh.getvalue()))
+    assert list(t2.items()) == list(t.items())
+    npt.assert_allclose(t2.c.as_array(), [[0, 0.5], [1, 1.5], [2, 2.5]])
+    npt.assert_allclose(t2.x.as_array(), [1.5, 2.5, 3.5])
+    assert t2.dt.as_array().tolist() == [10, 11, 12]
+    # Setting an element updates the array
+    t2.x[0] = 10
+    npt.assert_allclose(t2.x.as_array(), [10, 2.5, 3.5])
+    # Changing the loop size is handled
+    t2.n = 4
+    assert t2.x[3] == 0.0
+    assert t2.x.as_array().shape == (4,)
+
+def test_field_struct_array_loop():
+    '''Test loops of fixed width numbers, which get read and written
+    all at once.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["n", "", 2, int],
+                [["loop", "f.n"],
+                 ["k", "", 3, int],
+                 ["x", "", 10, float, {"frmt" : "%+010.3lf"}],
+                 ["y", "", 8, float],
+                 ["z", "", 6, float, {"frmt" : lambda v: "%.1f" % v}]],
+                ["m", "", 2, int]]
+    t = TestFieldStruct()
+    assert "_c" in t._codegen().read_source
+    assert "for i1" not in t._codegen().read_source
+    t.n = 3
+    t.k.set_array([1, 20, 300])
+    t.x.set_array([1.5, -2.5, 3.25])
+    for i in range(3):
+        t.y[i] = i * 0.5
+        t.z[i] = i + 0.5
+    t.m = 5
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    fh2 = io.BytesIO()
+    t.pseudo_outer_loop.write_to_file(t, fh2)
+    assert fh.getvalue() == fh2.getvalue()
+    assert t.field["x"].fh_loc[(1,)] == 2 + 27 + 3
+    t2 = TestFieldStruct()
+    t2.read_from_file(io.BytesIO(fh.getvalue()))
+    assert list(t2.items()) == list(t.items())
+    assert t2.x.as_array() is t2.x.value_dict.array
+    assert t2.get_raw_bytes("x", (1,)) == b"-00002.500"
+    t2.x[1] = 4.0
+    assert t2.get_raw_bytes("x", (1,)) == b"+00004.000"
+    # Values that need the slower code
+    t2.k[0] = "12"
+    fh = io.BytesIO()
+    t2.write_to_file(fh)
+    fh2 = io.BytesIO()
+    t2.pseudo_outer_loop.write_to_file(t2, fh2)
+    assert fh.getvalue() == fh2.getvalue()
+    t2.k[0] = 1000
+    with pytest.raises(RuntimeError):
+        t2.write_to_file(io.BytesIO())
+    # Bad data gives the same error as the normal code
+    d = fh.getvalue()
+    d = d[:5] + b"  abc  " + d[12:]
+    with pytest.raises(Exception) as e:
+        t2.read_from_file(io.BytesIO(d))
+    assert e.value.args[1] == 'x'
+    with pytest.raises(RuntimeError):
+        t2.read_from_file(io.BytesIO(fh.getvalue()[:30]))
+
+def test_field_struct_lazy_read():
+    '''Test a lazy read, where we convert the fields when accessed.'''
+    desc = [["n", "", 2, int],
+            ["flag", "", 1, str],
+            ["s", "", 5, str, {"condition" : "f.flag == 'Y'"}],
+            ["opt", "", 4, int, {"optional" : True}],
+            [["loop", "f.n"],
+             ["k", "", 3, int],
+             ["x", "", 8, float]],
+            [["loop", "f.n"],
+             ["name", "", 4, str]],
+            ["bad", "", 3, int]]
+    class TestFieldStruct(FieldStruct):
+        pass
+    TestFieldStruct.desc = desc
+    t = TestFieldStruct()
+    t.n = 2
+    t.flag = "Y"
+    t.s = "abc"
+    t.opt = None
+    for i, (k, x, nm) in enumerate(((1, 1.5, "wxy"), (2, -2.25, "z"))):
+        t.k[i] = k
+        t.x[i] = x
+        t.name[i] = nm
+    t.bad = 123
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    d = fh.getvalue()[:-3] + b"12x"
+    for t2 in (TestFieldStruct(), FieldStruct(desc)):
+        t2.read_from_file(io.BytesIO(d), lazy=True)
+        # Only fields needed for the layout have been converted
+        assert len(t2.field["s"].value_dict) == 0
+        assert len(t2.field["x"].value_dict) == 0
+        assert t2.field["n"].value_dict[()] == 2
+        assert t2.get_raw_bytes("x", (1,)) == b"-2.25000"
+        for nm in ("n", "flag", "s", "opt"):
+            assert getattr(t2, nm) == getattr(t, nm)
+        assert t2.k.to_list() == t.k.to_list()
+        assert t2.x.as_array().tolist() == [1.5, -2.25]
+        assert t2.name.to_list() == ["wxy", "z"]
+        # Error parsing a field is only reported when it is accessed
+        with pytest.raises(RuntimeError):
+            t2.bad
+        t2.bad = 123
+        fh = io.BytesIO()
+        t2.write_to_file(fh)
+        assert fh.getvalue() == d[:-3] + b"123"
+
+def test_field_struct_copy_pickle():
+    '''Test deepcopy and pickle, which copy the field values directly.'''
+    from pynitf.nitf_tre_rsmpca import TreRSMPCA
+    t = TreRSMPCA()
+    t.rsn = 1
+    t.csn = 1
+    t.rnrmo = 2881.0
+    t.rntrms = 3
+    t.rdtrms = 2
+    for i in range(3):
+        t.rnpcf[i] = 0.5 * i
+    t.rdpcf.set_array([1.0, -2.0])
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    d = fh.getvalue()
+    t2 = copy.deepcopy(t)
+    t3 = pickle.loads(pickle.dumps(t))
+    for t4 in (t2, t3):
+        fh = io.BytesIO()
+        t4.write_to_file(fh)
+        assert fh.getvalue() == d
+    # The copies have their own values
+    t2.rnrmo = 10.0
+    t2.rdpcf.as_array()[0] = 3.0
+    assert t.rnrmo == 2881.0
+    assert t.rdpcf[0] == 1.0
+    # Lazy read, with some of the fields not converted yet
+    tlazy = TreRSMPCA()
+    tlazy.read_from_file(io.BytesIO(d), lazy=True)
+    assert tlazy.rnpcf[1] == 0.5
+    for t4 in (copy.deepcopy(tlazy), pickle.loads(pickle.dumps(tlazy))):
+        assert t4.rnpcf.to_list() == [0.0, 0.5, 1.0]
+        assert t4.rdpcf.to_list() == [1.0, -2.0]
+        assert t4.rnrmo == 2881.0
+        fh = io.BytesIO()
+        t4.write_to_file(fh)
+        assert fh.getvalue() == d
+    assert copy.deepcopy(tlazy).get_raw_bytes("rnrmo") == \
+        tlazy.get_raw_bytes("rnrmo")
+    # Values that aren't formatted the way we would write them are
+    # written back out exactly as read
+    fs = FieldStruct([["mean_gsd", "", 5, float], ["n", "", 3, int],
+                      [["loop", "f.n"], ["v", "", 4, float]]])
+    d2 = b"  7.5002 1.5  2."
+    fs.read_from_file(io.BytesIO(d2))
+    for fs2 in (copy.deepcopy(fs), pickle.loads(pickle.dumps(fs))):
+        assert fs2.mean_gsd == 7.5
+        assert fs2.v.to_list() == [1.5, 2.0]
+        fh = io.BytesIO()
+        fs2.write_to_file(fh)
+        assert fh.getvalue() == d2
+    # Pickles written by older versions have the bytes as a string
+    t4 = TreRSMPCA.__new__(TreRSMPCA)
+    t4.__setstate__({"field_data" : str(d)})
+    assert t4.rnpcf.to_list() == [0.0, 0.5, 1.0]
+    
+def test_field_struct_serialized_size():
+    '''Test getting the size of a FieldStruct without writing it.'''
+    desc = [["n", "", 2, int],
+            ["flag", "", 1, str],
+            ["s", "", 5, str, {"condition" : "f.flag == 'Y'"}],
+            [["loop", "f.n"],
+             ["x", "", 8, float],
+             ["m", "", 1, int],
+             [["loop", "f.m[i1]"],
+              ["k", "", 3, int]]],
+            [["loop", "f.n"],
+             ["y", "", 4, float]],
+            ["dl", "", 3, int],
+            ["d", "", "f.dl", None, {'field_value_class' : BytesFieldData}]]
+    class TestFieldStruct(FieldStruct):
+        pass
+    TestFieldStruct.desc = desc
+    def write_size(t):
+        fh = io.BytesIO()
+        t.write_to_file(fh)
+        return len(fh.getvalue())
+    for t in (TestFieldStruct(), FieldStruct(desc)):
+        assert t.serialized_size() == write_size(t) == 6
+        t.flag = "Y"
+        t.n = 2
+        t.m[1] = 3
+        t.d = b"hello"
+        assert t.serialized_size() == write_size(t) == 51
+        # Setting a value that doesn't change the layout keeps the
+        # cached size
+        t.x[0] = 2.0
+        assert t.serialized_size() == 51
+        t.m.as_array()[0] = 1
+        assert t.serialized_size() == write_size(t) == 54
+        fh = io.BytesIO()
+        t.write_to_file(fh)
+        t2 = TestFieldStruct()
+        t2.read_from_file(io.BytesIO(fh.getvalue()), lazy=True)
+        assert t2.serialized_size() == 54
+    
+def test_field_struct_passthrough():
+    '''Test writing fields we haven't changed since reading with the
+    bytes we read.'''
+    desc = [["a", "", 6, float],
+            [None, None, 3, str],
+            ["n", "", 2, int],
+            [["loop", "f.n"],
+             ["x", "", 6, float],
+             ["y", "", 3, int]],
+            ["sl", "", 2, int],
+            ["s", "", "f.sl", str]]
+    class TestFieldStruct(FieldStruct):
+        pass
+    TestFieldStruct.desc = desc
+    d = b"1.50  xyz02 1.5  0012.00  00203abc"
+    def write(t):
+        fh = io.BytesIO()
+        t.write_to_file(fh)
+        return fh.getvalue()
+    for t in (TestFieldStruct(), FieldStruct(desc)):
+        for fh in (io.BytesIO(d), BufferReader(d)):
+            for lazy in (False, True):
+                t.read_from_file(fh, lazy=lazy)
+                fh.seek(0)
+                assert write(t) == d
+                assert t.modified_fields() == []
+                t.x[1] = 3.0
+                t.a = 1.5
+                assert write(t) == b"1.5000xyz02 1.5  0013.000000203abc"
+                assert t.modified_fields() == ["a", "x"]
+                # Raw bytes that are no longer the right size get
+                # reformatted
+                t.sl = 4
+                assert write(t) == b"1.5000xyz02 1.5  0013.000000204abc "
+                t.read_from_file(BufferReader(d))
+                t.x.as_array()
+                assert t.modified_fields() == ["x"]
+                assert write(t) == b"1.50  xyz021.50000012.000000203abc"
+    t = TestFieldStruct()
+    t.n = 1
+    t.x[0] = 1
+    assert t.modified_fields() == ["n", "x"]
+    
+def test_loop_shape_cache():
+    '''Test caching the loop shapes and keys.'''
+    desc = [["flag", "", 1, str],
+            ["n", "", 1, int, {"condition" : "f.flag == 'Y'"}],
+            [["loop", "f.n"],
+             ["m", "", 1, int],
+             [["loop", "f.m[i1]"],
+              ["x", "", 2, int]]]]
+    class TestFieldStruct(FieldStruct):
+        pass
+    TestFieldStruct.desc = desc
+    for t in (TestFieldStruct(), FieldStruct(desc)):
+        t.flag = "Y"
+        t.n = 2
+        t.m[0] = 1
+        t.m[1] = 2
+        for k in ((0,0), (1,0), (1,1)):
+            t.x[k] = 10 + k[0] + k[1]
+        assert [k for k, v in t.x.items()] == [(0,0), (1,0), (1,1)]
+        assert t.x.to_list() == [[10], [11, 12]]
+        assert len(t._loop_cache) > 0
+        # Changing a field a shape depends on clears the cache, even
+        # if it is only used in the condition of a count
+        t.flag = "N"
+        assert len(t._loop_cache) == 0
+        assert t.x.to_list() == []
+        t.flag = "Y"
+        t.m[1] = 1
+        assert list(t.x.items()) == [((0,0), 10), ((1,0), 11)]
+        with pytest.raises(IndexError):
+            t.x[1,1]
+        fh = io.BytesIO()
+        t.write_to_file(fh)
+        assert fh.getvalue() == b"Y2110111"
+        t.read_from_file(io.BytesIO(b"Y1301020304"))
+        assert t.x.to_list() == [[1, 2, 3]]
+        # Once the array for a shape field has been handed out, we
+        # can't cache the shapes any longer
+        t.m.as_array()[0] = 2
+        assert t._loop_cache is None
+        assert t.x.to_list() == [[1, 2]]
+    
+def test_field_attribute():
+    '''Test the attributes added to a FieldStruct class for each 
+    field.'''
+    desc = [["n", "", 2, int],
+            ["flag", "", 1, str],
+            ["s", "", 5, str, {"condition" : "f.flag == 'Y'"}],
+            ["p", "", 3, int],
+            [["loop", "f.n"],
+             ["x", "", 4, float]]]
+    class TestFieldStruct(FieldStruct):
+        @property
+        def p(self):
+            return "property"
+    TestFieldStruct.desc = desc
+    t = TestFieldStruct()
+    assert "n" in TestFieldStruct.__dict__
+    assert isinstance(TestFieldStruct.__dict__["p"], property)
+    # Existing class attributes are left alone
+    assert t.p == "property"
+    t.p = 10
+    assert t.p == "property"
+    assert t.field["p"][()] == 10
+    t.n = 2
+    t.flag = "N"
+    assert t.s is None
+    with pytest.raises(RuntimeError):
+        t.s = "hi"
+    t.flag = "Y"
+    t.s = "hi"
+    assert (t.n, t.s) == (2, "hi")
+    with pytest.raises(RuntimeError):
+        t.x = 1.0
+    t.x[1] = 2.5
+    assert t.x[1] == 2.5
+    # An explicit description doesn't use the class attributes
+    t2 = TestFieldStruct([["n", "", 2, int], ["n2", "", 2, int]])
+    t2.n = 3
+    t2.n2 = 4
+    assert (t2.n, t2.n2) == (3, 4)
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    t3 = TestFieldStruct()
+    fh.seek(0)
+    t3.read_from_file(fh, delayed_read=True)
+    assert t3.n == 2
+    assert t3.x[1] == 2.5
+    
+def test_to_numpy():
+    '''Test getting the fields of a loop as a numpy structured array.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["n", "", 1, int],
+                [["loop", "f.n"],
+                 ["x", "", 5, float],
+                 ["k", "", 2, int]],
+                [["loop", "f.n"],
+                 ["name", "", 3, str],
+                 ["flag", "", 1, str],
+                 ["v", "", 2, int, {"condition" : "f.flag[i1] == 'Y'"}],
+                 ["m", "", 1, int],
+                 [["loop", "f.m[i1]"],
+                  ["w", "", 3, float]]]]
+    d = b"31.50001-2.25023.0  03ab Y1211.0a  N0b  Y0332.02.02.5"
+    for lazy in (False, True):
+        t = TestFieldStruct()
+        t.read_from_file(io.BytesIO(d), lazy=lazy)
+        a = t.to_numpy("k")
+        assert a.dtype.names == ("x", "k")
+        assert a.dtype["k"] == np.int64
+        npt.assert_almost_equal(a["x"], [1.5, -2.25, 3.0])
+        assert a["k"].tolist() == [1, 2, 3]
+        a = t.to_numpy("name")
+        assert a["name"].tolist() == ["ab", "a", "b"]
+        # v is conditional, so NaN when it isn't present
+        assert a.dtype["v"] == np.float64
+        npt.assert_almost_equal(a["v"], [12, np.nan, 3])
+        a = t.to_numpy("w")
+        assert a.dtype.names == ("i1", "w")
+        assert a["i1"].tolist() == [0, 2, 2, 2]
+        npt.assert_almost_equal(a["w"], [1.0, 2.0, 2.0, 2.5])
+        assert list(t.to_numpy().keys()) == ["x", "name", "w"]
+        # Changed values are used, rather than the raw bytes
+        t.k[1] = 5
+        assert t.to_numpy("x")["k"].tolist() == [1, 5, 3]
+    with pytest.raises(RuntimeError):
+        t.to_numpy("n")
+    
+def test_buffer_reader():
+    '''Test reading a FieldStruct from a BufferReader.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["fhdr", "", 4, str, {"default" : "NITF"}],
+                ["clevel", "", 2, int],
+                [None, None, 2, str],
+                ["flag", "", 1, str, {"condition" : "f.clevel > 1"}],
+                ["n", "", 1, int],
+                [["loop", "f.n"],
+                 ["x", "", 5, float],
+                 ["y", "", 5, float]],
+                ["udhdl", "", 5, int],
+                ["udhd", "", "f.udhdl", None,
+                 {'field_value_class' : BytesFieldData,
+                  'size_offset' : 3}],
+                ["s", "", "f.clevel", str]]
+    d = b"NITF03  Y21.5002.5003.5004.50000006\0\1\2abc"
+    for buf in (d, bytearray(d), memoryview(d), memoryview(b"xx" + d)[2:]):
+        fh = BufferReader(buf)
+        assert isinstance(fh.data, bytes)
+        t = TestFieldStruct()
+        t.read_from_file(fh)
+        assert fh.tell() == len(d)
+        t2 = TestFieldStruct()
+        t2.read_from_file(io.BytesIO(d))
+        assert list(t.items()) == list(t2.items())
+        assert t.udhd == b"\0\1\2"
+        assert t.y[1] == 4.5
+    # Same error as reading a file
+    for i in (5, 10, 20, 40):
+        with pytest.raises(RuntimeError) as e:
+            TestFieldStruct().read_from_file(io.BytesIO(d[:i]))
+        with pytest.raises(RuntimeError) as e2:
+            TestFieldStruct().read_from_file(BufferReader(d[:i]))
+        assert str(e.value) == str(e2.value)
+    fh = BufferReader(d, 4)
+    assert fh.read(2) == b"03"
+    assert fh.seek(-3, io.SEEK_END) == len(d) - 3
+    assert fh.read() == b"abc"
+    assert fh.read(5) == b""
+    assert fh.seek(-2, io.SEEK_CUR) == len(d) - 2
+    with pytest.raises(ValueError):
+        fh.seek(-1)
+
+def test_buffer_writer():
+    '''Test writing a FieldStruct to a BufferWriter.'''
+    class TestFieldStruct(FieldStruct):
+        desc = [["fhdr", "", 4, str, {"default" : "NITF"}],
+                ["clevel", "", 2, int],
+                [None, None, 2, str],
+                ["n", "", 1, int],
+                [["loop", "f.n"],
+                 ["x", "", 5, float],
+                 ["y", "", 5, float]],
+                ["udhdl", "", 5, int],
+                ["udhd", "", "f.udhdl", None,
+                 {'field_value_class' : BytesFieldData,
+                  'size_offset' : 3}],
+                ["s", "", "f.clevel", str]]
+    t = TestFieldStruct()
+    t.clevel = 3
+    t.n = 2
+    t.x.set_array([1.5, 3.5])
+    t.y.set_array([2.5, 4.5])
+    t.udhd = b"\0\1\2"
+    t.s = "abc"
+    fh = io.BytesIO()
+    fh.write(b"12345")
+    t.write_to_file(fh)
+    loc = copy.deepcopy(dict((nm, t.field[nm].fh_loc) for nm in t.field))
+    fh2 = BufferWriter(offset=5)
+    t.write_to_file(fh2)
+    assert fh2.getvalue() == fh.getvalue()[5:]
+    assert fh2.tell() == len(fh.getvalue())
+    for nm in t.field:
+        assert t.field[nm].fh_loc == loc[nm]
+    # Update is done in place
+    t.update_field(fh2, "clevel", 4)
+    assert fh2.getvalue()[4:6] == b"04"
+    assert fh2.tell() == len(fh.getvalue())
+    fh2.seek(0, io.SEEK_END)
+    fh2.write(b"ab")
+    fh2.seek(-1, io.SEEK_CUR)
+    fh2.write(b"cd")
+    assert fh2.getvalue()[-3:] == b"acd"
+    # Not at the end, so written the normal way
+    fh2.seek(5)
+    t.write_to_file(fh2)
+    assert (fh2.getvalue()[:len(fh.getvalue())-5] ==
+            b"NITF04" + fh.getvalue()[11:])
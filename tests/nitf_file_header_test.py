@@ -61,17 +61,13 @@ def test_write():
             t.write_to_file(fh)
     assert fh.getvalue() == b'NITF02.1003BF01          20021216151629                                                                                U                                                                                                                                                                      00000000000\x00\x00\x00                                          0000000000000000000000000000000000000000000000'
 
-# Note this doesn't currently work. We may rework FieldStruct stuff to fix
-# this, so leave the test in place for use later.
-# TODO Add support for pickle and/or dill
-@skip(reason="pickling doesn't yet work for NitfFileHeader")
 def test_pickle():
     '''Test pickling of NitfFileHeader'''
     t = NitfFileHeader()
     with open(unit_test_data + "sample.ntf", 'rb') as fh:
         t.read_from_file(fh)
     p = pickle.dumps(t)
-    t2 = pickle.load(t)
+    t2 = pickle.loads(p)
     d = NitfDiff()
     assert d.compare_obj(t, t2) == True
     
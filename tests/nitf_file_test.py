@@ -10,6 +10,7 @@ import json
 import numpy as np
 import filecmp
 import gc
+import weakref
 
 # Turn on debug messages
 #pynitf.nitf_field.DEBUG = True
@@ -74,6 +75,18 @@ def test_read_tre():
     if(False):
         print(f)
         
+def test_rewrite_unchanged(isolated_dir):
+    '''Writing a file we read without changing anything should give
+    the same bytes, even where the file formats values differently
+    than we would (e.g., the floats in USE00A).'''
+    f = NitfFile(unit_test_data + "test_use00a.ntf")
+    assert f.image_segment[0].subheader.modified_fields() == []
+    f.write("z.ntf")
+    with open(unit_test_data + "test_use00a.ntf", "rb") as fh:
+        d = fh.read()
+    with open("z.ntf", "rb") as fh:
+        assert fh.read() == d
+    
 def test_basic_write(isolated_dir):
     f = NitfFile()
     create_image_seg(f)
@@ -93,13 +106,17 @@ def test_basic_write(isolated_dir):
     check_tre(f2.image_segment[0].tre_list[0], 290)
     print_diag(f2)
 
+class TreBig(Tre):
+    '''A really big TRE, used to force the use of the second place in the
+    header for TREs or the TRE overflow DES.'''
+    desc = [["big_field", "", 99999-20, str]]
+    tre_tag = "BIGTRE"
+
+tre_tag_to_cls.add_cls(TreBig)
+
 def test_large_tre_write(isolated_dir):
     '''Repeat of test_basic_write, but also include a really big TRE that
     forces the use of the second place in the header for TREs'''
-    class TreBig(Tre):
-        desc = [["big_field", "", 99999-20, str],]
-        tre_tag = "BIGTRE"
-    tre_tag_to_cls.add_cls(TreBig)    
     f = NitfFile()
     create_image_seg(f)
     f.tre_list.append(TreBig())
@@ -139,10 +156,6 @@ def test_large_tre_write(isolated_dir):
 def test_tre_overflow_write(isolated_dir):
     '''Repeat of test_basic_write, but also include two really big TREs that
     forces the use of the DES TRE overflow for TREs'''
-    class TreBig(Tre):
-        desc = [["big_field", "", 99999-20, str]]
-        tre_tag = "BIGTRE"
-    tre_tag_to_cls.add_cls(TreBig)    
     f = NitfFile()
     create_image_seg(f)
     f.tre_list.append(TreBig())
@@ -191,6 +204,256 @@ def test_tre_overflow_write(isolated_dir):
     assert filecmp.cmp("z.ntf", "z2.ntf", shallow=False)
 
 
+def test_lazy_read(isolated_dir):
+    '''Test reading a file with lazy=True, where we only read segments
+    when they are accessed.'''
+    f = NitfFile()
+    for i in range(5):
+        create_image_seg(f, iid1 = "Image %d" % i, bias = i)
+    f.image_segment[3].tre_list.append(TreBig())
+    f.image_segment[3].tre_list.append(TreBig())
+    create_tre(f.image_segment[3], 290)
+    create_tre(f)
+    create_graphic_segment(f)
+    create_text_segment(f)
+    create_des(f)
+    create_res_segment(f)
+    f.write("z.ntf")
+    f2 = NitfFile()
+    f2.data_handle_set.add_handle(NitfGraphicRaw)
+    f2.data_handle_set.add_handle(NitfResRaw)
+    f2.read("z.ntf", lazy=True)
+    assert len(f2.tre_list) == 1
+    check_tre(f2.tre_list[0])
+    assert len(f2.image_segment) == 5
+    assert len(f2.des_segment) == 2
+    assert not any(f2.image_segment.is_read(i) for i in range(5))
+    assert f2.image_segment[1].iid1 == "Image 1"
+    assert f2.image_segment[-1].iid1 == "Image 4"
+    assert [f2.image_segment.is_read(i) for i in range(5)] == \
+        [False, True, False, False, True]
+    assert not f2.des_segment.is_read(0)
+    # Reading the TREs reads the TRE_OVERFLOW DES, but not the other DES
+    iseg = f2.image_segment[3]
+    assert len(iseg.tre_list) == 3
+    # The TREs are read lazily, so the fields are converted when used
+    assert () not in iseg.find_one_tre("USE00A").field["mean_gsd"].value_dict
+    check_tre(iseg.find_one_tre("USE00A"), 290)
+    assert not f2.des_segment.is_read(0)
+    assert f2.des_segment.is_read(1)
+    img = f2.image_segment[2].data
+    assert img[0, 8, 9] == 89
+    assert [iseg.iid1 for iseg in f2.image_segment[1:3]] == \
+        ["Image 1", "Image 2"]
+    f3 = NitfFile()
+    f3.data_handle_set.add_handle(NitfGraphicRaw)
+    f3.data_handle_set.add_handle(NitfResRaw)
+    f3.read("z.ntf")
+    assert str(f2) == str(f3)
+    f2.write("z2.ntf")
+    f3.write("z3.ntf")
+    assert filecmp.cmp("z2.ntf", "z3.ntf", shallow=False)
+
+def test_open_segment(isolated_dir):
+    '''Test reading a single segment from a file.'''
+    f = NitfFile()
+    for i in range(5):
+        create_image_seg(f, iid1 = "Image %d" % i, row_offset = i + 1)
+    f.image_segment[3].tre_list.append(TreBig())
+    f.image_segment[3].tre_list.append(TreBig())
+    create_tre(f.image_segment[3], 290)
+    create_tre(f)
+    create_text_segment(f)
+    create_des(f)
+    f.write("z.ntf")
+    iseg = NitfFile.open_segment("z.ntf", "image", 2)
+    assert iseg.iid1 == "Image 2"
+    assert iseg.data[0, 8, 9] == 8 * 3 + 9
+    assert len(iseg.tre_list) == 0
+    assert not iseg.nitf_file.des_segment.is_read(1)
+    iseg = NitfFile.open_segment("z.ntf", "image", 3)
+    assert len(iseg.tre_list) == 3
+    check_tre(iseg.find_one_tre("USE00A"), 290)
+    assert not iseg.nitf_file.des_segment.is_read(0)
+    assert iseg.nitf_file.des_segment.is_read(1)
+    assert not iseg.nitf_file.image_segment.is_read(3)
+    f2 = NitfFile("z.ntf")
+    assert str(iseg) == str(f2.image_segment[3])
+    tseg = NitfFile.open_segment("z.ntf", "text", -1)
+    assert tseg.subheader.textid == "ID12345"
+    dseg = NitfFile.open_segment("z.ntf", "des", 0)
+    assert dseg.des.num_att == 5
+    with pytest.raises(IndexError):
+        NitfFile.open_segment("z.ntf", "image", 5)
+    with pytest.raises(RuntimeError):
+        NitfFile.open_segment("z.ntf", "bad_type", 0)
+    # The NitfFile used to read the segment should be cleaned up with
+    # the segment, without needing the garbage collector
+    gc.collect()
+    fref = weakref.ref(iseg.nitf_file)
+    del iseg
+    assert fref() is None
+
+def test_write_stream(isolated_dir):
+    '''Test writing to a file handle that only supports write.'''
+    class WriteOnly(object):
+        def __init__(self):
+            self.d = []
+        def write(self, d):
+            self.d.append(bytes(d))
+    f = NitfFile()
+    create_image_seg(f, iid1 = "Image 1")
+    # Unknown size, so this gets written to a temporary file first
+    create_image_seg(f, iid1 = "Image 2", row_offset = 20)
+    f.image_segment[1].data.write_size = lambda : None
+    f.tre_list.append(TreBig())
+    f.tre_list.append(TreBig())
+    create_tre(f)
+    create_tre(f.image_segment[0], 290)
+    create_graphic_segment(f)
+    create_text_segment(f)
+    create_des(f)
+    create_res_segment(f)
+    f.write("z.ntf")
+    fh = WriteOnly()
+    f.write_stream(fh, spool_size = 10)
+    with open("z.ntf", "rb") as fin:
+        assert b''.join(fh.d) == fin.read()
+    assert len(f.des_segment) == 1
+    f2 = NitfFile()
+    f2.data_handle_set.add_handle(NitfGraphicRaw)
+    f2.data_handle_set.add_handle(NitfResRaw)
+    f2.read("z.ntf")
+    with open("z2.ntf", "wb") as fout:
+        f2.write_stream(fout)
+    f2.write("z3.ntf")
+    assert filecmp.cmp("z2.ntf", "z3.ntf", shallow=False)
+    # Error if write_size is wrong
+    f.text_segment[0].data.write_size = lambda : 1
+    with pytest.raises(RuntimeError):
+        f.write_stream(WriteOnly())
+
+def test_open_for_update(isolated_dir):
+    '''Test updating a file in place.'''
+    f = NitfFile()
+    for i in range(3):
+        create_image_seg(f, iid1 = "Image %d" % i, row_offset = i + 1)
+    f.image_segment[1].tre_list.append(TreBig())
+    f.image_segment[1].tre_list.append(TreBig())
+    create_tre(f.image_segment[1], 290)
+    create_tre(f)
+    create_text_segment(f)
+    create_des(f)
+    f.write("z.ntf")
+    with pytest.raises(RuntimeError):
+        NitfFile("z.ntf").update()
+    # Same size changes, including the TRE in the TRE_OVERFLOW DES
+    f2 = NitfFile.open_for_update("z.ntf")
+    f2.file_header.ftitle = "New title"
+    f2.image_segment[0].iid1 = "New 0"
+    f2.image_segment[1].find_one_tre("USE00A").angle_to_north = 100
+    f2.update()
+    assert os.path.getsize("z.ntf") == f2.file_header.fl
+    f3 = NitfFile("z.ntf")
+    assert f3.file_header.ftitle == "New title"
+    assert f3.image_segment[0].iid1 == "New 0"
+    check_tre(f3.image_segment[1].find_one_tre("USE00A"), 100)
+    assert f3.image_segment[2].data[0, 8, 9] == 8 * 3 + 9
+    # Change the size of the file header and an image subheader
+    create_tre(f2, 100)
+    create_tre(f2.image_segment[0])
+    f2.update()
+    assert os.path.getsize("z.ntf") == f2.file_header.fl
+    f3 = NitfFile("z.ntf")
+    assert len(f3.tre_list) == 2
+    check_tre(f3.tre_list[1], 100)
+    assert len(f3.image_segment[0].tre_list) == 1
+    check_tre(f3.image_segment[1].find_one_tre("USE00A"), 100)
+    for i in range(3):
+        assert f3.image_segment[i].data[0, 8, 9] == 8 * (i + 1) + 9
+    assert f3.text_segment[0].subheader.textid == "ID12345"
+    assert f3.des_segment[0].des.num_att == 5
+    # Segments not yet read use the updated offsets
+    assert f2.text_segment[0].subheader.textid == "ID12345"
+    # Undoing the changes gives the same file as writing it
+    f2.tre_list.pop()
+    f2.image_segment[0].tre_list.pop()
+    f2.update()
+    f.file_header.ftitle = "New title"
+    f.image_segment[0].iid1 = "New 0"
+    f.image_segment[1].find_one_tre("USE00A").angle_to_north = 100
+    f.write("z2.ntf")
+    assert filecmp.cmp("z.ntf", "z2.ntf", shallow=False)
+    # Can't add a TRE_OVERFLOW DES
+    f2.image_segment[0].tre_list.append(TreBig())
+    f2.image_segment[0].tre_list.append(TreBig())
+    create_tre(f2.image_segment[0])
+    with pytest.raises(RuntimeError):
+        f2.update()
+
+def test_append_segments(isolated_dir):
+    '''Test adding segments to an existing file.'''
+    def create_file(f):
+        create_image_seg(f, iid1 = "Image 0", row_offset = 1)
+        create_image_seg(f, iid1 = "Image 1", row_offset = 2)
+        create_tre(f)
+        create_text_segment(f)
+        create_des(f)
+    def add_segments(f):
+        iseg = create_image_seg(f, iid1 = "Image 2", row_offset = 3)
+        create_tre(iseg, 290)
+        create_text_segment(f, first_name = "Monty")
+        # Unknown size, so this gets written to a temporary file first
+        f.text_segment[-1].data.write_size = lambda : None
+        create_des(f, q = 0.2)
+        create_res_segment(f)
+    f = NitfFile()
+    create_file(f)
+    f.write("z.ntf")
+    f2 = NitfFile.open_for_update("z.ntf")
+    add_segments(f2)
+    assert not f2.image_segment.is_read(0)
+    # A failed update leaves the file and file header alone, so we can
+    # call update again
+    f.write("zorig.ntf")
+    fl = f2.file_header.fl
+    tseg = f2.text_segment[-1]
+    def write_fail(fh):
+        raise RuntimeError("Write failed")
+    tseg.data.write_to_file = write_fail
+    with pytest.raises(RuntimeError):
+        f2.update()
+    assert f2.file_header.fl == fl
+    assert f2.file_header.numt == 1
+    assert tseg.header_size is None
+    assert filecmp.cmp("z.ntf", "zorig.ntf", shallow=False)
+    del tseg.data.write_to_file
+    f2.update()
+    assert os.path.getsize("z.ntf") == f2.file_header.fl
+    assert not f2.image_segment.is_read(0)
+    f3 = NitfFile()
+    f3.data_handle_set.add_handle(NitfResRaw)
+    f3.read("z.ntf")
+    assert [iseg.iid1 for iseg in f3.image_segment] == \
+        ["Image 0", "Image 1", "Image 2"]
+    for i in range(3):
+        assert f3.image_segment[i].data[0, 8, 9] == 8 * (i + 1) + 9
+    check_tre(f3.image_segment[2].find_one_tre("USE00A"), 290)
+    assert len(f3.text_segment) == 2
+    assert len(f3.des_segment) == 2
+    assert f3.res_segment[0].data.res_data == b'fake res data'
+    f4 = NitfFile()
+    create_file(f4)
+    add_segments(f4)
+    f4.write("z2.ntf")
+    assert filecmp.cmp("z.ntf", "z2.ntf", shallow=False)
+    # Same thing, using append_segments
+    f.write("z3.ntf")
+    f5 = NitfFile()
+    add_segments(f5)
+    NitfFile.append_segments("z3.ntf", list(f5.segments()))
+    assert filecmp.cmp("z3.ntf", "z2.ntf", shallow=False)
+
 def test_field_value_exception_write(isolated_dir):
     '''This makes sure that malformed DES will throw out RuntimeError exception.'''
 
@@ -392,11 +655,9 @@ def test_nitf_sample_nitf(nitf_sample_files):
         print(fname + ":")
         print(f.summary())
 
-# This is a streaming file, which we don't currently support
+# This is a streaming file
 flist2 = ["ns3321a.nsf",]
 
-# TODO Add support for this
-@skip(reason="don't support NITF streaming yet")        
 def test_nitf_sample_nitf_streaming(nitf_sample_files):
     for fname in flist2:
         f = NitfFile(nitf_sample_files + "/SampleFiles/" + fname)
@@ -0,0 +1,82 @@
+from pynitf.nitf_read_many import *
+from pynitf.nitf_read_many import _read_file_parts
+from pynitf.nitf_file import NitfFile
+from pynitf_test_support import *
+import pickle
+import filecmp
+
+def create_files(n):
+    fname_list = []
+    for i in range(n):
+        f = NitfFile()
+        create_image_seg(f, iid1 = "Image %d" % i, row_offset = i + 1)
+        create_image_seg(f, iid1 = "Second")
+        create_tre(f)
+        create_tre(f.image_segment[0], 290)
+        create_text_segment(f, first_name = "Name %d" % i)
+        create_des(f)
+        fname = "z%d.ntf" % i
+        f.write(fname)
+        fname_list.append(fname)
+    return fname_list
+
+def test_read_file_parts(isolated_dir):
+    fname, = create_files(1)
+    parts = pickle.loads(pickle.dumps(_read_file_parts(fname)))
+    file_header_data, seg_parts = parts
+    with open(fname, "rb") as fh:
+        d = fh.read()
+    assert d.startswith(file_header_data)
+    assert len(seg_parts["image"]) == 2
+    offset, header_size, data_size, subheader_data = seg_parts["image"][0]
+    assert d[offset:(offset+header_size)] == subheader_data
+    assert len(seg_parts["des"]) == 1
+
+def test_read_many(isolated_dir):
+    fname_list = create_files(5)
+    res = dict(read_many(fname_list, workers=2))
+    assert sorted(res.keys()) == sorted(fname_list)
+    for i, fname in enumerate(fname_list):
+        f = res[fname]
+        assert f.image_segment[0].iid1 == "Image %d" % i
+        assert f.image_segment[0].tre_list[0].angle_to_north == 290
+        assert not f.image_segment[0]._data_to_read is None
+        assert f.image_segment[0].data[0, 8, 9] == 8 * (i + 1) + 9
+        assert str(f) == str(NitfFile(fname))
+    # Segments are only parsed when used, and are written out the same
+    # as when we read the file directly, including values that aren't
+    # formatted the way we would write them
+    with open(fname_list[0], "rb") as fh:
+        d = fh.read()
+    with open(fname_list[0], "wb") as fh:
+        fh.write(d.replace(b"105.2", b"  7.5"))
+    fname, f = next(read_many(fname_list[:1], workers=1))
+    assert not f.image_segment.is_read(0)
+    assert f.image_segment[0].tre_list[0].mean_gsd == 7.5
+    f.write("out1.ntf")
+    NitfFile(fname).write("out2.ntf")
+    assert filecmp.cmp("out1.ntf", "out2.ntf", shallow=False)
+    for fname, f in read_many(fname_list, workers=0, lazy=False):
+        assert all(seg._data_to_read is None for seg in f.segments())
+        assert str(f) == str(NitfFile(fname))
+
+def image_ids(f):
+    return [iseg.iid1 for iseg in f.image_segment]
+
+def test_read_many_func(isolated_dir):
+    fname_list = create_files(3)
+    res = dict(read_many(fname_list, workers=2, func=image_ids))
+    for i, fname in enumerate(fname_list):
+        assert res[fname] == ["Image %d" % i, "Second"]
+
+def test_read_many_error(isolated_dir):
+    fname_list = create_files(2)
+    with open("bad.ntf", "wb") as fh:
+        fh.write(b"not a nitf file")
+    fname_list.append("bad.ntf")
+    res = dict(read_many(fname_list, workers=2, return_exceptions=True))
+    assert isinstance(res["bad.ntf"], Exception)
+    assert isinstance(res["z1.ntf"], NitfFile)
+    with pytest.raises(Exception):
+        for fname, f in read_many(fname_list, workers=2):
+            pass
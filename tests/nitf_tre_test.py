@@ -1,8 +1,10 @@
-from pynitf.nitf_tre import Tre, read_tre_data
+from pynitf.nitf_tre import Tre, read_tre_data, prepare_tre_write
+from pynitf.nitf_field import BufferWriter
 from pynitf.nitf_file_header import NitfFileHeader
 from pynitf.nitf_image_subheader import NitfImageSubheader
 from pynitf_test_support import *
 import io
+import warnings
 
 def test_tre():
     # This is part of USE00A, but we give it a different name so it
@@ -26,6 +28,36 @@ def test_tre():
     assert t2.angle_to_north == 270
     assert_almost_equal(t2.mean_gsd, 105.2)
     assert t.dynamic_range == 2047
+    # Writing to a BufferWriter fills in the length after writing the TRE
+    fh = BufferWriter()
+    fh.write(b"abc")
+    t.write_to_file(fh)
+    assert fh.getvalue() == b'abcUSETST00014270105.2 02047'
+    t.angle_to_north = 2700
+    with pytest.raises(RuntimeError):
+        t.write_to_file(fh)
+    # Partial TRE is removed
+    assert fh.getvalue() == b'abcUSETST00014270105.2 02047'
+
+def test_prepare_tre_write():
+    class TestUSE00A(Tre):
+        desc = [["angle_to_north", "Angle to North", 3, int],
+                ["data", "Data", 40000, str]]
+        tre_tag = "USETST"
+    t = TestUSE00A()
+    t.angle_to_north = 270
+    t.data = "x"
+    h = NitfImageSubheader()
+    des_list = []
+    prepare_tre_write([t] * 5, h, des_list,
+                      [["ixshdl", "ixofl", "ixshd"], ["udidl", "udofl", "udid"]])
+    fh = io.BytesIO()
+    t.write_to_file(fh)
+    assert h.ixshd == fh.getvalue() * 2
+    assert h.udid == fh.getvalue() * 2
+    assert len(des_list) == 1
+    assert des_list[0].data.data == fh.getvalue()
+    assert t.cel_value() == len(fh.getvalue()) - 11
     
 def test_tre_read():
     '''Read a file that has a TRE in it'''
@@ -48,5 +80,16 @@ def test_tre_read():
     assert t.max_lp_seg == 6287
     assert_almost_equal(t.sun_el, 68.5)
     assert_almost_equal(t.sun_az, 131.3)
+    # Lazy read only converts the fields when they are accessed
+    tlazy, = read_tre_data(t2.ixshd, lazy=True)
+    assert () not in tlazy.field["mean_gsd"].value_dict
+    assert_almost_equal(tlazy.mean_gsd, 105.2)
+    assert tlazy.rev_num == 3317
+    # An unknown TRE is read as a TreUnknown, without a warning
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        tunk, = read_tre_data(b'FOOBAR00003abc', lazy=True)
+    assert tunk.tre_tag == 'FOOBAR'
+    assert tunk.tre_bytes == b'abc'
     
 